@@ -0,0 +1,295 @@
+# admission.py
+# Admission control and per-caller rate limiting (DEFECT 034).
+#
+# Per worker, requests fall into two classes:
+#
+#   new calls   : /ivr/start (and "start" on /ivr/ws)
+#   in-progress : every other /ivr/ request of a call that is already live
+#
+# In-progress requests share MAX_IN_FLIGHT slots; when all are busy they
+# queue for the next free slot instead of failing. New calls are refused at
+# once with 503 + Retry-After when MAX_LIVE_CALLS calls are live, when
+# START_MAX_IN_FLIGHT requests are in flight, or when anything is queued.
+# Live calls are counted in the call-state store, so MAX_LIVE_CALLS caps
+# this worker with the memory store but the whole host with the sqlite one. The slots above START_MAX_IN_FLIGHT are therefore only ever
+# used by callers already in a call: a burst of new calls is shed before it
+# slows down anyone's keypresses.
+#
+# Separately, each caller number gets a token bucket (CALLER_RATE_PER_MINUTE,
+# CALLER_BURST) on call start; an empty bucket means 429 + Retry-After.
+#
+#   memory : buckets in this process (per worker)
+#   sqlite : buckets in a small shared SQLite file (every worker on the host)
+#
+# Pick one with RATE_LIMIT_BACKEND=memory|sqlite (default: memory).
+
+import asyncio
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+import fast_json
+import metrics
+from ivr_logging import get_logger
+
+log = get_logger("call")
+
+
+# ==================== TOKEN BUCKETS ====================
+def _refill(tokens: float, updated: float, now: float, rate: float, burst: float) -> float:
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+class RateLimiter:
+    """Token bucket per key: `burst` tokens, refilled at `rate` tokens per second."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+
+    def _decide(self, tokens: float):
+        """(tokens left, seconds to wait): wait is 0.0 when a token was taken."""
+        if tokens >= 1:
+            return tokens - 1, 0.0
+        return tokens, (1 - tokens) / self.rate
+
+    async def acquire(self, key: str) -> float:
+        """Takes a token. Returns 0.0, or how many seconds until one is available."""
+        raise NotImplementedError
+
+    def reset(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class InMemoryRateLimiter(RateLimiter):
+    """Per-process buckets. Idle keys are evicted past `max_keys` (an evicted key starts full again)."""
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        super().__init__(rate, burst)
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict() # <--- key -> (tokens, updated)
+
+    async def acquire(self, key):
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens, wait = self._decide(_refill(tokens, updated, now, self.rate, self.burst))
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def reset(self):
+        self._buckets.clear()
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """Buckets shared by every worker on the host through one small SQLite file."""
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str, rate: float, burst: float):
+        super().__init__(rate, burst)
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _acquire(self, key):
+        now = time.time() # <--- Wall clock: shared between processes
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE") # <--- Read-modify-write under the file's write lock
+        try:
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = _refill(row[0], row[1], now, self.rate, self.burst) if row else self.burst
+            tokens, wait = self._decide(tokens)
+            conn.execute(
+                "INSERT INTO rate_buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now),
+            )
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                # A bucket idle long enough to be full again is the same as no row
+                conn.execute("DELETE FROM rate_buckets WHERE updated < ?", (now - self.burst / self.rate,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    async def acquire(self, key):
+        return await asyncio.to_thread(self._acquire, key)
+
+    def reset(self):
+        self._conn().execute("DELETE FROM rate_buckets")
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def create_rate_limiter() -> Optional[RateLimiter]:
+    """Builds the limiter selected by RATE_LIMIT_BACKEND (None if CALLER_RATE_PER_MINUTE is 0)."""
+    per_minute = float(os.environ.get("CALLER_RATE_PER_MINUTE", "10"))
+    if per_minute <= 0:
+        return None
+    rate, burst = per_minute / 60, float(os.environ.get("CALLER_BURST", "5"))
+    backend = os.environ.get("RATE_LIMIT_BACKEND", "memory").lower()
+    if backend == "memory":
+        return InMemoryRateLimiter(rate, burst)
+    if backend == "sqlite":
+        return SQLiteRateLimiter(os.environ.get("RATE_LIMIT_SQLITE_PATH", "./ivr_rate_limit.db"), rate, burst)
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND '{backend}' (expected 'memory' or 'sqlite')")
+
+
+# ==================== ADMISSION ====================
+class Rejected(Exception):
+    """A request turned away: HTTP status, Retry-After seconds and the reason (for metrics)."""
+
+    def __init__(self, status_code: int, retry_after: int, reason: str, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+        self.detail = detail
+
+    @property
+    def headers(self) -> dict:
+        return {"Retry-After": str(self.retry_after)}
+
+
+class AdmissionController:
+    def __init__(self, live_calls: Callable[[], Awaitable[int]], max_live_calls: int = 500,
+                 max_in_flight: int = 100, start_max_in_flight: int = 75, retry_after: int = 2,
+                 rate_limiter: Optional[RateLimiter] = None):
+        self.live_calls = live_calls
+        self.max_live_calls = max_live_calls
+        self.max_in_flight = max_in_flight
+        self.start_max_in_flight = min(start_max_in_flight, max_in_flight)
+        self.retry_after = retry_after
+        self.rate_limiter = rate_limiter
+        self.in_flight = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(max_in_flight) if max_in_flight > 0 else None
+
+    # ---------- In-flight slots ----------
+    async def _enter(self) -> None:
+        if self._slots is not None:
+            if self._slots.locked():
+                self.waiting += 1
+                try:
+                    await self._slots.acquire()
+                finally:
+                    self.waiting -= 1
+            else:
+                await self._slots.acquire()
+        self.in_flight += 1
+        metrics.IN_FLIGHT.set(self.in_flight)
+
+    def _leave(self) -> None:
+        self.in_flight -= 1
+        metrics.IN_FLIGHT.set(self.in_flight)
+        if self._slots is not None:
+            self._slots.release()
+
+    # ---------- New calls ----------
+    async def check_new_call(self) -> None:
+        """Raises Rejected (503) when this worker should not take another call right now."""
+        if self.start_max_in_flight > 0 and (self.waiting or self.in_flight >= self.start_max_in_flight):
+            self._reject(Rejected(503, self.retry_after, "in_flight", "Too many requests in progress, try again shortly"))
+        if self.max_live_calls > 0 and await self.live_calls() >= self.max_live_calls:
+            self._reject(Rejected(503, self.retry_after, "live_calls", "Too many calls in progress, try again shortly"))
+
+    async def check_caller(self, caller_number: str) -> None:
+        """Raises Rejected (429) when this caller number has no token left."""
+        if self.rate_limiter is None:
+            return
+        wait = await self.rate_limiter.acquire(caller_number or "")
+        if wait > 0:
+            self._reject(Rejected(429, max(1, math.ceil(wait)), "rate_limited", "Too many calls from this number, try again later"))
+
+    def _reject(self, rejected: Rejected):
+        metrics.ADMISSION_REJECTED.inc(rejected.reason)
+        log.info("call_rejected", extra={"reason": rejected.reason, "in_flight": self.in_flight, "waiting": self.waiting})
+        raise rejected
+
+    # ---------- Requests ----------
+    async def run(self, new_call: bool, handler: Callable[[], Awaitable]):
+        """Runs one request in an in-flight slot (new calls are checked first, and never queue)."""
+        if new_call:
+            await self.check_new_call()
+        await self._enter()
+        try:
+            return await handler()
+        finally:
+            self._leave()
+
+    def close(self) -> None:
+        if self.rate_limiter is not None:
+            self.rate_limiter.close()
+
+
+def create_admission_controller(live_calls: Callable[[], Awaitable[int]]) -> AdmissionController:
+    return AdmissionController(
+        live_calls,
+        max_live_calls=int(os.environ.get("MAX_LIVE_CALLS", "500")),
+        max_in_flight=int(os.environ.get("MAX_IN_FLIGHT", "100")),
+        start_max_in_flight=int(os.environ.get("START_MAX_IN_FLIGHT", "75")),
+        retry_after=int(os.environ.get("ADMISSION_RETRY_AFTER_SECONDS", "2")),
+        rate_limiter=create_rate_limiter(),
+    )
+
+
+# ==================== HTTP ====================
+NEW_CALL_PATHS = frozenset({"/ivr/start"})
+
+
+class AdmissionMiddleware:
+    """Plain ASGI middleware: every /ivr/ HTTP request runs in an admission slot; /ivr/start may be refused."""
+
+    def __init__(self, app, controller: Callable[[], AdmissionController]):
+        self.app = app
+        self.controller = controller # <--- Looked up per request, so tests / reloads can swap it
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or not path.startswith("/ivr/"):
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.controller().run(path in NEW_CALL_PATHS, lambda: self.app(scope, receive, send))
+        except Rejected as rejected:
+            await send_rejection(send, rejected)
+
+
+async def send_rejection(send, rejected: Rejected) -> None:
+    body = fast_json.dumps({"status": "rejected", "detail": rejected.detail})
+    await send({
+        "type": "http.response.start",
+        "status": rejected.status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(rejected.retry_after).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
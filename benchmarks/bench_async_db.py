@@ -0,0 +1,167 @@
+# benchmarks/bench_async_db.py
+# Blocking Session vs AsyncSession under concurrent callers.
+#
+# Each simulated caller runs the per-keypress pattern the DTMF handler used:
+# load the CallHistory row, append a digit to input_buffer, commit.
+#
+#   blocking : sync Session used inside `async def` (the old handler behaviour)
+#   async    : AsyncSession from database.py (the current handler behaviour)
+#
+# A slow database is simulated by sleeping inside the DB driver's cursor, so
+# the blocking path stalls the event loop exactly like a slow Postgres round
+# trip would, while the async path sleeps in the driver's worker thread.
+#
+# Keypresses arrive on a fixed schedule (open loop) and latency is measured
+# from the scheduled arrival, so time spent waiting for a stalled event loop
+# counts against the caller, just as it does for a real HTTP request.
+#
+# Usage:
+#   python benchmarks/bench_async_db.py --callers 50 --keypresses 10 --latency-ms 5
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("TESTING", "true")
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from database import Base, CallHistory
+
+LATENCY_S = 0.0
+
+
+class SlowCursor(sqlite3.Cursor):
+    def execute(self, *args, **kwargs):
+        time.sleep(LATENCY_S)
+        return super().execute(*args, **kwargs)
+
+
+class SlowConnection(sqlite3.Connection):
+    def cursor(self, factory=SlowCursor):
+        return super().cursor(factory)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def seed_calls(db_path, callers):
+    engine = create_engine(f"sqlite:///{db_path}")
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+    with sessionmaker(bind=engine)() as db:
+        for i in range(callers):
+            db.add(CallHistory(call_id=f"BENCH_{i}", caller_number="+1Bench"))
+        db.commit()
+    engine.dispose()
+
+
+async def open_loop(caller, callers, keypresses, interval):
+    """Fires every caller's keypresses on a fixed schedule; returns latencies from scheduled arrival."""
+    latencies = []
+    base = time.perf_counter()
+
+    async def one_keypress(i, due):
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        await caller(i)
+        latencies.append(time.perf_counter() - due)
+
+    tasks = []
+    for k in range(keypresses):
+        for i in range(callers):
+            # Spread callers evenly across each interval
+            due = base + k * interval + (i / callers) * interval
+            tasks.append(one_keypress(i, due))
+    wall = time.perf_counter()
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - wall
+
+
+async def run_blocking(db_path, callers, keypresses, interval):
+    engine = create_engine(
+        f"sqlite:///{db_path}",
+        connect_args={"check_same_thread": False, "factory": SlowConnection},
+        pool_size=callers,
+    )
+    SessionLocal = sessionmaker(bind=engine, autoflush=False)
+
+    async def caller(i):
+        db = SessionLocal()
+        try:
+            call = db.query(CallHistory).filter(CallHistory.call_id == f"BENCH_{i}").first()
+            call.input_buffer = (call.input_buffer or "") + "1"
+            db.commit()
+        finally:
+            db.close()
+
+    results = await open_loop(caller, callers, keypresses, interval)
+    engine.dispose()
+    return results
+
+
+async def run_async(db_path, callers, keypresses, interval):
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{db_path}",
+        connect_args={"factory": SlowConnection},
+        pool_size=callers,
+    )
+    SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+    async def caller(i):
+        async with SessionLocal() as db:
+            result = await db.execute(select(CallHistory).filter(CallHistory.call_id == f"BENCH_{i}"))
+            call = result.scalars().first()
+            call.input_buffer = (call.input_buffer or "") + "1"
+            await db.commit()
+
+    results = await open_loop(caller, callers, keypresses, interval)
+    await engine.dispose()
+    return results
+
+
+def report(label, latencies, wall):
+    ms = [x * 1000 for x in latencies]
+    print(
+        f"{label:<9} ops={len(ms):>6}  throughput={len(ms) / wall:>8.1f}/s  "
+        f"p50={statistics.median(ms):>8.2f}ms  p95={percentile(ms, 95):>8.2f}ms  p99={percentile(ms, 99):>8.2f}ms"
+    )
+
+
+def main():
+    global LATENCY_S
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--callers", type=int, default=50)
+    parser.add_argument("--keypresses", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="simulated per-statement DB latency")
+    parser.add_argument("--interval-ms", type=float, default=1000.0, help="gap between one caller's keypresses")
+    args = parser.parse_args()
+    LATENCY_S = args.latency_ms / 1000
+
+    db_path = os.path.join(tempfile.gettempdir(), f"ivr_bench_async_{os.getpid()}.db")
+    interval = args.interval_ms / 1000
+    print(f"callers={args.callers} keypresses={args.keypresses} latency={args.latency_ms}ms/statement interval={args.interval_ms}ms")
+    try:
+        seed_calls(db_path, args.callers)
+        report("blocking", *asyncio.run(run_blocking(db_path, args.callers, args.keypresses, interval)))
+        seed_calls(db_path, args.callers)
+        report("async", *asyncio.run(run_async(db_path, args.callers, args.keypresses, interval)))
+    finally:
+        if os.path.exists(db_path):
+            os.remove(db_path)
+
+
+if __name__ == "__main__":
+    main()
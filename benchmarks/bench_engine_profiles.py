@@ -0,0 +1,88 @@
+# benchmarks/bench_engine_profiles.py
+# Throughput of concurrent DTMF traffic under each database engine profile.
+#
+# For every profile a fresh uvicorn is started (same code, different
+# DB_ENGINE_PROFILE) and loaded with keypad-only call flows from
+# load_ivr.py (PNR status, cancel, frequent flyer):
+#
+#   stock : SQLAlchemy / SQLite defaults (rollback journal, synchronous=FULL,
+#           Postgres pool 5 + 10 overflow, no pre-ping or recycle)
+#   tuned : database.py profile (WAL, synchronous=NORMAL, mmap + cache
+#           pragmas; Postgres pool from DB_POOL_* variables)
+#
+# SQLite always runs on a throwaway file. Pass --postgres-url to also compare
+# the two profiles against a Postgres database (its data is left in place).
+#
+# Usage:
+#   python benchmarks/bench_engine_profiles.py --callers 50 --duration 15
+#   python benchmarks/bench_engine_profiles.py --postgres-url postgresql://user:pw@localhost/ivr
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_ivr import (CANCEL_PNR_COUNT, free_port, parse_mix, percentile, prepare_database,  # noqa: E402
+                      run_load, start_local_server, wait_until_ready)
+
+PROFILES = ("stock", "tuned")
+DTMF_MIX = "pnr_status=3,manage_cancel=1,frequent_flyer=2"
+
+
+def run_profile(profile, args, postgres_url=None):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    db_path = None if postgres_url else os.path.join(tempfile.gettempdir(), f"ivr_profile_{profile}_{os.getpid()}.db")
+    available = {"pnr_status", "frequent_flyer"} if postgres_url else {"pnr_status", "manage_cancel", "frequent_flyer"}
+    mix = parse_mix(DTMF_MIX, available)
+
+    server = start_local_server(db_path, port, extra_env={"DB_ENGINE_PROFILE": profile, "LOG_LEVEL": "WARNING"},
+                                database_url=postgres_url)
+    try:
+        wait_until_ready(base_url, server)
+        if db_path:
+            prepare_database(db_path, CANCEL_PNR_COUNT)
+        ctx, wall = asyncio.run(run_load(base_url, args.callers, args.duration, mix, 0.0, args.seed))
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        if db_path:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+    dtmf_ms = [seconds * 1000 for endpoint, _, seconds in ctx.samples if endpoint == "/ivr/dtmf"]
+    return {
+        "requests": len(ctx.samples),
+        "rps": len(ctx.samples) / wall,
+        "errors": sum(ctx.errors.values()),
+        "p50": statistics.median(dtmf_ms) if dtmf_ms else 0.0,
+        "p95": percentile(dtmf_ms, 95) if dtmf_ms else 0.0,
+        "p99": percentile(dtmf_ms, 99) if dtmf_ms else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare database engine profiles under concurrent DTMF traffic")
+    parser.add_argument("--callers", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--postgres-url", help="also compare the profiles against this Postgres database")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    backends = [("sqlite", None)] + ([("postgres", args.postgres_url)] if args.postgres_url else [])
+    print(f"callers={args.callers} duration={args.duration}s mix={DTMF_MIX}")
+    print(f"\n{'backend':<10} {'profile':<8} {'requests':>9} {'req/s':>9} {'errors':>7} {'dtmf p50':>10} {'p95':>9} {'p99':>9}")
+    for backend, url in backends:
+        for profile in PROFILES:
+            r = run_profile(profile, args, url)
+            print(f"{backend:<10} {profile:<8} {r['requests']:>9} {r['rps']:>9.1f} {r['errors']:>7} "
+                  f"{r['p50']:>8.2f}ms {r['p95']:>7.2f}ms {r['p99']:>7.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
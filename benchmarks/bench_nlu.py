@@ -0,0 +1,158 @@
+# benchmarks/bench_nlu.py
+# Utterances per second: legacy per-request NLU closures vs the nlu module.
+#
+# The legacy functions below are the pre-nlu.py code from handle_voice_input
+# (minus the print() calls), kept here only for comparison.
+#
+# Usage:
+#   python benchmarks/bench_nlu.py --seconds 2
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import nlu
+
+UTTERANCES = {
+    "pnr": ["my pnr is 8 5 5 6 7 8", "six three one one one one", "ai one two three four", "two four one two three four please"],
+    "flight": ["book flight one zero one", "6e204", "flight number ai one zero one", "uh one zero one"],
+    "age": ["forty five", "my age is 30", "I am twenty years old", "seventy two"],
+}
+
+
+# ==================== LEGACY (closures rebuilt per request) ====================
+def legacy_request(kind, text):
+    """Mimics one old handle_voice_input call: define the closures, then use one."""
+    FILLER_WORDS = [
+        'my', 'is', 'uh', 'um', 'please', 'can', 'get', 'space', 'dot', 'dash', 'want', 'to', 'like'
+    ]
+
+    def map_spoken_pnr(spoken_text):
+        letter_map = {
+            'a': '2', 'b': '2', 'c': '2', 'd': '3', 'e': '3', 'f': '3',
+            'g': '4', 'h': '4', 'i': '4', 'j': '5', 'k': '5', 'l': '5',
+            'm': '6', 'n': '6', 'o': '6', 'p': '7', 'q': '7', 'r': '7', 's': '7',
+            't': '8', 'u': '8', 'v': '8', 'w': '9', 'x': '9', 'y': '9', 'z': '9'
+        }
+        num_word_map = {
+            "one": "1", "two": "2", "three": "3", "four": "4", 
+            "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9", "zero": "0"
+        }
+
+        for word in FILLER_WORDS + ['pnr', 'number']:
+            spoken_text = spoken_text.replace(word, ' ')
+
+        for word, digit in num_word_map.items():
+            spoken_text = spoken_text.replace(word, digit)
+        
+        cleaned_text = re.sub(r'[.\s,-]+', '', spoken_text)
+        
+        chars = re.findall(r'([a-zA-Z0-9])', cleaned_text)
+        alphanumeric_pnr = "".join(chars)
+        
+        if len(alphanumeric_pnr) == 6:
+            numeric_pnr = ""
+            for char in alphanumeric_pnr:
+                if char.isalpha(): 
+                    numeric_pnr += letter_map.get(char, '') 
+                elif char.isdigit():
+                    numeric_pnr += char
+            
+            if len(numeric_pnr) == 6:
+                return numeric_pnr
+        
+        digit_match = re.search(r'(\d{6})', alphanumeric_pnr)
+        if digit_match:
+             return digit_match.group(1)
+             
+        return None
+
+    def map_spoken_flight_number(spoken_text):
+        num_word_map = {
+            "one": "1", "two": "2", "three": "3", "four": "4", 
+            "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9", "zero": "0"
+        }
+
+        for word in FILLER_WORDS + ['flight', 'book', 'number']:
+            spoken_text = spoken_text.replace(word, ' ')
+
+        for word, digit in num_word_map.items():
+            spoken_text = spoken_text.replace(word, digit)
+        
+        cleaned_text = re.sub(r'[\s.-]+', '', spoken_text) 
+        
+        flight_match = re.search(r'([a-zA-Z0-9]{2}\d{2,4})', cleaned_text, re.IGNORECASE)
+        if flight_match:
+            flight_num_str = flight_match.group(1).upper()
+            return flight_num_str
+
+        cleaned_digits = re.sub(r'[^0-9]+', '', cleaned_text)
+        if cleaned_digits:
+            flight_num_str = "AI" + cleaned_digits # Assume AI prefix
+            return flight_num_str
+        return None
+
+    def map_spoken_age(spoken_text):
+        for word in FILLER_WORDS + ['age', 'years', 'old']:
+            spoken_text = spoken_text.replace(word, ' ')
+
+        num_word_map = {
+            "one": "1", "two": "2", "three": "3", "four": "4", 
+            "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9", "zero": "0",
+            "ten": "10", "eleven": "11", "twelve": "12", "thirteen": "13", "fourteen": "14", "fifteen": "15",
+            "sixteen": "16", "seventeen": "17", "eighteen": "18", "nineteen": "19", "twenty": "20",
+            "thirty": "30", "forty": "40", "fifty": "50", "sixty": "60", "seventy": "70", "eighty": "80", "ninety": "90"
+        }
+        for word, digit in num_word_map.items():
+            spoken_text = spoken_text.replace(word, digit)
+
+        age_match = re.search(r'(\d{1,3})', spoken_text)
+        if age_match:
+            age = int(age_match.group(1))
+            if 0 < age < 120:
+                return age
+        return None
+
+    if kind == "pnr":
+        return map_spoken_pnr(text)
+    if kind == "flight":
+        return map_spoken_flight_number(text)
+    return map_spoken_age(text)
+
+
+# ==================== NEW ====================
+NEW = {"pnr": nlu.extract_pnr, "flight": nlu.extract_flight_number, "age": nlu.extract_age}
+
+def new_request(kind, text):
+    return NEW[kind](text)
+
+
+def rate(func, seconds):
+    corpus = [(kind, text.lower()) for kind, texts in UTTERANCES.items() for text in texts]
+    done = 0
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        for kind, text in corpus:
+            func(kind, text)
+        done += len(corpus)
+    return done / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=2.0, help="run time per variant")
+    args = parser.parse_args()
+
+    before = rate(legacy_request, args.seconds)
+    after = rate(new_request, args.seconds)
+    print(f"legacy  {before:>12,.0f} utterances/s")
+    print(f"nlu.py  {after:>12,.0f} utterances/s  ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# benchmarks/bench_seat_inventory.py
+# Booking one seat on a flight that already has N bookings.
+#
+#   legacy : the old confirm_booking: load every booking of the flight, then
+#            rewrite seats_available on each of them (O(bookings) per booking)
+#   flights: reserve_seat(): one conditional UPDATE on the flights row
+#
+# Usage:
+#   python benchmarks/bench_seat_inventory.py --bookings 100000 --rounds 20
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("TESTING", "true")
+
+from sqlalchemy import Column, Integer, String, create_engine, insert, select
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from database import Base, Booking, Flight
+from ivr_simulator_backend import reserve_seat
+
+FLIGHT = "AI101"
+
+# The pre-normalization schema, kept here only for comparison
+LegacyBase = declarative_base()
+
+class LegacyBooking(LegacyBase):
+    __tablename__ = "legacy_bookings"
+    id = Column(Integer, primary_key=True)
+    pnr_key = Column(String(6), unique=True, index=True)
+    flight = Column(String(10), index=True)
+    status = Column(String(20))
+    route = Column(String(100))
+    time = Column(String(50))
+    seats_available = Column(Integer)
+    passenger_name = Column(String(100))
+
+
+def seed(db_path, bookings):
+    engine = create_engine(f"sqlite:///{db_path}")
+    Base.metadata.create_all(bind=engine)
+    LegacyBase.metadata.create_all(bind=engine)
+    seats = bookings * 2
+    with engine.begin() as conn:
+        conn.execute(insert(Flight), [{"flight": FLIGHT, "route": "Mumbai to Delhi", "time": "Today", "status": "On Time", "seats_available": seats}])
+        rows = [{"pnr_key": f"{i:06d}", "flight": FLIGHT, "status": "Confirmed", "passenger_name": "Bench"} for i in range(bookings)]
+        conn.execute(insert(Booking), rows)
+        for row in rows:
+            row.update(route="Mumbai to Delhi", time="Today", seats_available=seats)
+        conn.execute(insert(LegacyBooking), rows)
+    engine.dispose()
+
+
+async def bench_legacy(Session, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        async with Session() as db:
+            all_bookings_for_flight = (await db.execute(select(LegacyBooking).filter(LegacyBooking.flight == FLIGHT))).scalars().all()
+            new_seat_count = all_bookings_for_flight[0].seats_available - 1
+            for b in all_bookings_for_flight:
+                b.seats_available = new_seat_count
+            await db.commit()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def bench_flights(Session, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        async with Session() as db:
+            await reserve_seat(db, FLIGHT)
+            await db.commit()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(label, timings):
+    ms = [t * 1000 for t in timings]
+    print(f"{label:<8} rounds={len(ms):>4}  mean={statistics.mean(ms):>10.2f}ms  median={statistics.median(ms):>10.2f}ms  max={max(ms):>10.2f}ms")
+
+
+async def run(db_path, rounds):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+    Session = async_sessionmaker(bind=engine, expire_on_commit=False)
+    report("legacy", await bench_legacy(Session, rounds))
+    report("flights", await bench_flights(Session, rounds))
+    await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bookings", type=int, default=100_000, help="existing bookings on the flight")
+    parser.add_argument("--rounds", type=int, default=20, help="seats booked per variant")
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.gettempdir(), f"ivr_bench_seats_{os.getpid()}.db")
+    try:
+        print(f"Seeding {args.bookings:,} bookings on {FLIGHT}...")
+        seed(db_path, args.bookings)
+        asyncio.run(run(db_path, args.rounds))
+    finally:
+        if os.path.exists(db_path):
+            os.remove(db_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# benchmarks/bench_serialization.py
+# Response encoding cost per IVR response, old path vs new.
+#
+#   legacy   : jsonable_encoder() + json.dumps(), what FastAPI did for the
+#              ad-hoc dicts before the endpoints declared response models
+#   model    : validate into IvrResponse / CallStartResponse + pydantic-core
+#              dump_json (the response-model fast path)
+#   prepared : the bytes pre-encoded at startup (static menu transitions and
+#              the /ivr/start welcome prompt)
+#
+# Payloads are the real ones: the main-menu prompt (the longest, sent on
+# almost every call), a sub-menu transition and a PNR status answer.
+#
+# Usage:
+#   python benchmarks/bench_serialization.py --seconds 1
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+import fast_json  # noqa: E402
+from ivr_simulator_backend import (MENU_GRAPH, START_CALL_BODY_TAIL, CallStartResponse, IvrResponse,  # noqa: E402
+                                   transition_bodies)
+
+CALL_ID = "CALL_179220753160900000000"
+
+
+def legacy(payload):
+    return json.dumps(jsonable_encoder(payload), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def model_encoder(model):
+    adapter = TypeAdapter(model)
+    return lambda payload: adapter.dump_json(adapter.validate_python(payload), exclude_unset=True)
+
+
+def cases():
+    main = MENU_GRAPH[MENU_GRAPH.root]
+    baggage = next(option for option in main.options.values() if option.action == "goto_menu" and option.target != "main")
+    back = next(option for node in MENU_GRAPH.nodes.values() for option in node.options.values()
+                if option.action == "goto_menu" and option.target == "main")
+    ivr = model_encoder(IvrResponse)
+    start = model_encoder(CallStartResponse)
+    pnr_status = {
+        "status": "pnr_found", "message": "Your PNR AI1234: Flight AI101 from Mumbai to Delhi is Confirmed. Passenger: R. Kumar. "
+                                          "There are currently 30 seats available on this flight. This call will now end.",
+        "pnr_info": {"pnr_display": "AI1234", "flight": "AI101", "status": "Confirmed", "route": "Mumbai to Delhi",
+                     "time": "Today 6:00 PM", "seats_available": 30},
+        "call_action": "hangup",
+    }
+    return [
+        ("/ivr/start (welcome prompt)", {"call_id": CALL_ID, "status": "connected", "prompt": main.prompt}, start,
+         lambda: b'{"call_id":' + fast_json.dumps(CALL_ID) + b"," + START_CALL_BODY_TAIL),
+        ("back to main menu", fast_json.menu_payload("main", main.prompt, back.message), ivr,
+         lambda: fast_json.prepared_body(transition_bodies.response("main", back.message))),
+        (f"main -> {baggage.target}", fast_json.menu_payload(baggage.target, MENU_GRAPH[baggage.target].prompt, baggage.message), ivr,
+         lambda: fast_json.prepared_body(transition_bodies.response(baggage.target, baggage.message))),
+        ("PNR status (dynamic)", pnr_status, ivr, None),
+    ]
+
+
+def rate(fn, seconds):
+    count, deadline = 0, time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(200):
+            fn()
+        count += 200
+    return count / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Response encoding throughput: legacy vs response model vs pre-encoded")
+    parser.add_argument("--seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    print(f"orjson: {'yes' if fast_json.orjson else 'no (json fallback)'}   prepared transitions: {len(transition_bodies)}")
+    print(f"\n{'response':<30} {'bytes':>6} {'legacy/s':>11} {'model/s':>11} {'prepared/s':>11} {'speedup':>8}")
+    for name, payload, model, prepared in cases():
+        body = legacy(payload)
+        assert json.loads(model(payload)) == json.loads(body)
+        if prepared:
+            assert json.loads(prepared()) == json.loads(body)
+        legacy_rate = rate(lambda: legacy(payload), args.seconds)
+        model_rate = rate(lambda: model(payload), args.seconds)
+        prepared_rate = rate(prepared, args.seconds) if prepared else None
+        best = prepared_rate or model_rate
+        print(f"{name:<30} {len(body):>6} {legacy_rate:>11,.0f} {model_rate:>11,.0f} "
+              f"{(f'{prepared_rate:,.0f}' if prepared_rate else '-'):>11} {best / legacy_rate:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
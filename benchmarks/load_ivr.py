@@ -0,0 +1,303 @@
+# benchmarks/load_ivr.py
+# Concurrent caller load generator for the IVR backend.
+#
+# N simulated callers (asyncio + httpx) each dial in, walk a scripted call
+# flow, hang up and dial again until the run is over:
+#
+#   pnr_status    : 1, PNR on the keypad, #                       (DTMF)
+#   pnr_voice     : "flight status", spoken PNR                    (voice)
+#   manage_cancel : 2, PNR, #, 2 (cancel)                          (DTMF)
+#   booking       : 5, spoken flight, spoken name, age #, gender, confirm
+#   frequent_flyer: 6, FF number #, PIN #, 1 (points)              (DTMF)
+#
+# By default it starts its own uvicorn on a throwaway SQLite file, seeds one
+# spare booking per cancel and plenty of seats, and stops it afterwards.
+# Admission control and per-caller rate limits are switched off there, so
+# the run measures the handlers rather than 503s and 429s.
+# Pass --url to load an already running server instead (manage_cancel is
+# then left out, since it needs PNRs this tool created).
+#
+# Reports throughput plus p50/p95/p99 latency per endpoint and per menu
+# (the menu the caller was in when the request was sent).
+#
+# Usage:
+#   python benchmarks/load_ivr.py --callers 50 --duration 30
+#   python benchmarks/load_ivr.py --url http://127.0.0.1:8000 --callers 20 --duration 10
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CANCEL_PNR_BASE = 900000   # spare bookings seeded for manage_cancel: 900000, 900001, ...
+CANCEL_PNR_COUNT = 90000
+
+# Spawned servers: no admission control or caller rate limits (see admission.py)
+NO_ADMISSION_ENV = {
+    "CALLER_RATE_PER_MINUTE": "0",
+    "MAX_LIVE_CALLS": "0",
+    "MAX_IN_FLIGHT": "0",
+    "START_MAX_IN_FLIGHT": "0",
+}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# ==================== CALL FLOWS ====================
+# A flow is a list of (kind, value) steps:
+#   ("dtmf", "1")       -> POST /ivr/dtmf, one key
+#   ("keys", "241234#") -> one POST /ivr/dtmf per key
+#   ("voice", "text")   -> POST /ivr/process_voice
+def flow_pnr_status(rng, ctx):
+    return [("dtmf", "1"), ("keys", rng.choice(["241234", "855678", "631111", "222222"]) + "#")]
+
+def flow_pnr_voice(rng, ctx):
+    return [("voice", "I want to check my flight status"), ("voice", "my pnr is two four one two three four")]
+
+def flow_manage_cancel(rng, ctx):
+    return [("dtmf", "2"), ("keys", f"{ctx.next_cancel_pnr()}#"), ("dtmf", "2")]
+
+def flow_booking(rng, ctx):
+    return [
+        ("dtmf", "5"),
+        ("voice", rng.choice(["book flight one zero one", "flight six e two zero four", "qf068"])),
+        ("voice", "my name is load tester"),
+        ("keys", f"{rng.randint(18, 80)}#"),
+        ("dtmf", rng.choice("123")),
+        ("dtmf", "1"),
+    ]
+
+def flow_frequent_flyer(rng, ctx):
+    return [("dtmf", "6"), ("keys", "111222333#"), ("keys", "1234#"), ("dtmf", "1")]
+
+FLOWS = {
+    "pnr_status": flow_pnr_status,
+    "pnr_voice": flow_pnr_voice,
+    "manage_cancel": flow_manage_cancel,
+    "booking": flow_booking,
+    "frequent_flyer": flow_frequent_flyer,
+}
+
+DEFAULT_MIX = "pnr_status=4,pnr_voice=2,manage_cancel=1,booking=2,frequent_flyer=1"
+
+
+def parse_mix(text, available):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in FLOWS:
+            raise SystemExit(f"Unknown flow '{name}' (expected one of {', '.join(FLOWS)})")
+        if name in available:
+            mix[name] = float(weight or 1)
+    if not mix:
+        raise SystemExit("No flows left to run")
+    return mix
+
+
+# ==================== CALLERS ====================
+class LoadContext:
+    """Shared state for one run: recorded samples and the PNRs left to cancel."""
+
+    def __init__(self, client, mix, think_s):
+        self.client = client
+        self.mix_names = list(mix)
+        self.mix_weights = list(mix.values())
+        self.think_s = think_s
+        self.samples = []          # (endpoint, menu, seconds)
+        self.errors = defaultdict(int)
+        self.flows_done = defaultdict(int)
+        self._cancel_pnr = CANCEL_PNR_BASE
+
+    def next_cancel_pnr(self):
+        pnr = self._cancel_pnr
+        self._cancel_pnr += 1
+        return pnr
+
+    async def post(self, endpoint, payload, menu):
+        start = time.perf_counter()
+        try:
+            response = await self.client.post(endpoint, json=payload)
+        except httpx.HTTPError as e:
+            self.errors[f"{endpoint} {type(e).__name__}"] += 1
+            return None
+        self.samples.append((endpoint, menu, time.perf_counter() - start))
+        if response.status_code != 200:
+            self.errors[f"{endpoint} HTTP {response.status_code}"] += 1
+            return None
+        return response.json()
+
+
+async def run_call(ctx, rng, flow_name):
+    """Dials in, walks one scripted flow and makes sure the call is hung up."""
+    started = await ctx.post("/ivr/start", {"caller_number": f"+1Load{rng.randint(0, 9999):04d}"}, "(new call)")
+    if not started:
+        return
+    call_id, menu = started["call_id"], "main"
+    ended = False
+
+    for kind, value in FLOWS[flow_name](rng, ctx):
+        presses = list(value) if kind == "keys" else [value]
+        for press in presses:
+            if kind == "voice":
+                data = await ctx.post("/ivr/process_voice", {"call_id": call_id, "text": press, "current_menu": menu}, menu)
+            else:
+                data = await ctx.post("/ivr/dtmf", {"call_id": call_id, "digit": press, "current_menu": menu}, menu)
+            if data is None:
+                break
+            menu = data.get("current_menu", menu)
+            if data.get("status") in ("call_ended", "transferring"):
+                ended = True
+                break
+            if ctx.think_s:
+                await asyncio.sleep(ctx.think_s)
+        if ended:
+            break
+
+    if not ended:
+        await ctx.post("/ivr/end", {"call_id": call_id}, menu)
+    ctx.flows_done[flow_name] += 1
+
+
+async def caller_loop(ctx, seed, deadline):
+    rng = random.Random(seed)
+    while time.perf_counter() < deadline:
+        flow_name = rng.choices(ctx.mix_names, ctx.mix_weights)[0]
+        await run_call(ctx, rng, flow_name)
+
+
+async def run_load(base_url, callers, duration, mix, think_s, seed):
+    limits = httpx.Limits(max_connections=callers, max_keepalive_connections=callers)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30.0) as client:
+        ctx = LoadContext(client, mix, think_s)
+        deadline = time.perf_counter() + duration
+        wall = time.perf_counter()
+        await asyncio.gather(*(caller_loop(ctx, seed + i, deadline) for i in range(callers)))
+        return ctx, time.perf_counter() - wall
+
+
+# ==================== LOCAL SERVER ====================
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_local_server(db_path, port, extra_env=None, database_url=None):
+    env = dict(os.environ, DATABASE_URL=database_url or f"sqlite:///{db_path}", **NO_ADMISSION_ENV, **(extra_env or {}))
+    env.pop("TESTING", None) # <--- Run the real startup (create tables + seed)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "ivr_simulator_backend:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+
+
+def wait_until_ready(base_url, server, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"uvicorn exited early:\n{server.stderr.read().decode(errors='replace')}")
+        try:
+            if httpx.get(f"{base_url}/readyz", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit("uvicorn did not become ready in time")
+
+
+def prepare_database(db_path, cancel_pnrs):
+    """Adds spare bookings for manage_cancel and enough seats for every booking attempt."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    with conn:
+        conn.execute("UPDATE flights SET seats_available = 1000000 WHERE status != 'Cancelled'")
+        conn.executemany(
+            "INSERT OR IGNORE INTO bookings (pnr_key, pnr_display, flight, status, passenger_name, passenger_age, passenger_gender) "
+            "VALUES (?, ?, 'AI101', 'Confirmed', 'Load Tester', 30, 'Other')",
+            [(str(CANCEL_PNR_BASE + i), f"LT{i:05d}") for i in range(cancel_pnrs)],
+        )
+    conn.close()
+
+
+# ==================== REPORT ====================
+def report_group(title, samples, key_index):
+    groups = defaultdict(list)
+    for sample in samples:
+        groups[sample[key_index]].append(sample[2] * 1000)
+    print(f"\n{title:<28} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for key, ms in sorted(groups.items(), key=lambda item: -len(item[1])):
+        print(
+            f"{key:<28} {len(ms):>7} {statistics.median(ms):>7.2f}ms {percentile(ms, 95):>7.2f}ms "
+            f"{percentile(ms, 99):>7.2f}ms {max(ms):>7.2f}ms"
+        )
+
+
+def report(ctx, wall):
+    total = len(ctx.samples)
+    calls = sum(ctx.flows_done.values())
+    print(f"\nrequests={total}  throughput={total / wall:.1f} req/s  calls={calls} ({calls / wall:.1f} calls/s)  wall={wall:.1f}s")
+    print("flows: " + ", ".join(f"{name}={count}" for name, count in sorted(ctx.flows_done.items())))
+    if ctx.errors:
+        print("errors: " + ", ".join(f"{name}={count}" for name, count in sorted(ctx.errors.items())))
+    if total:
+        report_group("endpoint", ctx.samples, 0)
+        report_group("menu", ctx.samples, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent caller load generator for the IVR backend")
+    parser.add_argument("--callers", type=int, default=20, help="simultaneous callers")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to keep dialling")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="pause between one caller's requests")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="flow weights, e.g. 'pnr_status=3,booking=1'")
+    parser.add_argument("--url", help="load an already running server instead of starting one")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    server, db_path = None, None
+    if args.url:
+        base_url = args.url.rstrip("/")
+        mix = parse_mix(args.mix, set(FLOWS) - {"manage_cancel"})
+    else:
+        mix = parse_mix(args.mix, set(FLOWS))
+        db_path = os.path.join(tempfile.gettempdir(), f"ivr_load_{os.getpid()}.db")
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        print(f"Starting uvicorn on {base_url} with SQLite {db_path}...")
+        server = start_local_server(db_path, port)
+
+    try:
+        if server:
+            wait_until_ready(base_url, server)
+            prepare_database(db_path, CANCEL_PNR_COUNT)
+        print(f"callers={args.callers} duration={args.duration}s think={args.think_ms}ms mix={mix}")
+        ctx, wall = asyncio.run(run_load(base_url, args.callers, args.duration, mix, args.think_ms / 1000, args.seed))
+        report(ctx, wall)
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=10)
+        if db_path:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+# benchmarks/replay_calls.py
+# Replays recorded calls against a fresh backend: a production-shaped
+# regression benchmark.
+#
+#   extract : ended calls from call_history + call_events (and call_archive)
+#             -> a sessions file (JSONL, one call per line)
+#   run     : re-drives sessions (from a database or a sessions file) with the
+#             recorded timing, --speed times faster (0 = no waiting at all)
+#
+# A session is one call: when it started, the menu path it took and its
+# timed steps. Keys that chose a menu option are replayed as /ivr/dtmf
+# presses (a spoken intent is recorded as the key it resolved to). Entries
+# (PNR, FF number, age, flight) go to /ivr/dtmf_entry, names and spoken
+# flight codes to /ivr/process_voice. PINs are never recorded: they are
+# looked up in the reference data by the FF number entered before them.
+# Calls recorded before entries were logged fall back to the values left in
+# the call's final state; steps with no value at all count as "incomplete".
+#
+# By default `run` starts its own uvicorn on a throwaway SQLite file loaded
+# with the reference data (flights, bookings, frequent flyers) of --db, or of
+# --reference (a database URL or bulk_load.py files). Admission control and
+# per-caller rate limits are switched off there, since replaying faster than
+# real time would trip them. Pass --url to replay against an already
+# running server.
+#
+# A session "diverges" when the replayed call leaves the recorded menu path
+# (or hangs itself up where the recording did not). Replay of that call
+# stops at the first divergent step. The report gives p50/p95/p99 latency per
+# endpoint and per menu, how far the sender fell behind schedule, and the
+# divergent calls.
+#
+# Usage:
+#   python benchmarks/replay_calls.py extract --db sqlite:///./ivr.db --since 2026-10-01 --out sessions.jsonl
+#   python benchmarks/replay_calls.py run --sessions sessions.jsonl --reference sqlite:///./ivr.db --speed 10
+#   python benchmarks/replay_calls.py run --db sqlite:///./ivr.db --limit 2000 --speed 0 --fail-on-divergence
+
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine, select  # noqa: E402
+
+from bulk_load import CHUNK_SIZE, MODELS, load_tables, read_rows, table_for_path  # noqa: E402
+from call_archive import decode_payload  # noqa: E402
+from call_events import EVENT_ENTRY, EVENT_INPUT, EVENT_MENU, EVENT_NOTE  # noqa: E402
+from call_reaper import IDLE_NOTE  # noqa: E402
+from database import CallArchive, CallEvent, CallHistory, FrequentFlyer, MenuId  # noqa: E402
+from load_ivr import free_port, report_group, start_local_server, wait_until_ready  # noqa: E402
+
+CALLER_HANGUP_NOTES = {"Call ended by user.", "Caller disconnected.", IDLE_NOTE}
+PAGE_SIZE = 500
+
+# Entry menus of MENU_STRUCTURE, kept here so the tool doesn't import (and start up) the app
+PNR_INPUT_MENUS = frozenset({
+    "flight_status_pnr", "manage_booking_pnr", "check_in_pnr_for_checkin",
+    "check_in_pnr_for_boardingpass", "refunds_pnr_for_status", "refunds_pnr_for_receipt",
+})
+ENTRY_MENUS = PNR_INPUT_MENUS | {"frequent_flyer_number", "frequent_flyer_pin", "booking_ask_flight", "booking_ask_age"}
+SECRET_ENTRY_MENUS = frozenset({"frequent_flyer_pin"})
+NAME_MENU, AFTER_NAME_MENU = "booking_ask_name", "booking_ask_age" # <--- The spoken name step
+
+# Where a call's final state kept each entry (calls recorded before EVENT_ENTRY)
+STATE_FALLBACK = {menu: "active_pnr" for menu in PNR_INPUT_MENUS}
+STATE_FALLBACK.update({
+    "booking_ask_flight": "booking_flight",
+    "booking_ask_age": "booking_age",
+    "booking_ask_name": "booking_name",
+    "frequent_flyer_number": "active_ff_number",
+})
+
+
+# ==================== SESSIONS ====================
+def build_session(call_id, caller_number, start, end, state, events):
+    """events: (kind, menu name, value, seconds after start) in order."""
+    steps, path, note = [], [], None
+    menu, pending, named = None, None, False
+    for kind, menu_name, value, at in events:
+        at = max(0.0, at or 0.0)
+        if kind == EVENT_MENU:
+            if menu == NAME_MENU and not named and menu_name == AFTER_NAME_MENU:
+                steps.append([at, "voice", _name_text(state.get(STATE_FALLBACK[NAME_MENU])), menu])
+            path.append(menu_name)
+            menu, pending, named = menu_name, None, False
+        elif kind == EVENT_ENTRY:
+            if menu == NAME_MENU:
+                steps.append([at, "voice", _name_text(value), menu])
+                named = True
+            else:
+                pending = value
+        elif kind == EVENT_INPUT:
+            if value == "#" and menu in ENTRY_MENUS:
+                steps.append([at, *_entry_step(menu, pending, state), menu])
+                pending = None
+            else:
+                steps.append([at, "dtmf", value, menu])
+        elif kind == EVENT_NOTE:
+            note = value
+    return {
+        "call_id": call_id, "caller_number": caller_number, "start": start.isoformat(),
+        "end_at": (end - start).total_seconds() if end else (steps[-1][0] if steps else 0.0),
+        "path": path, "caller_hung_up": note in CALLER_HANGUP_NOTES or note is None, "steps": steps,
+    }
+
+
+def _name_text(name):
+    return f"my name is {name}" if name else None
+
+
+def _entry_step(menu, value, state):
+    if menu in SECRET_ENTRY_MENUS:
+        return "pin", None
+    if value is None and STATE_FALLBACK.get(menu):
+        value = state.get(STATE_FALLBACK[menu])
+    value = None if value is None else str(value)
+    if value is not None and not value.isdigit():
+        return "voice", f"flight {value}" # <--- A flight code such as "6E204" was spoken, not keyed
+    return "entry", value
+
+
+def _hot_sessions(conn, menu_names, filters, limit):
+    """Ended calls still in call_history, oldest first, PAGE_SIZE at a time."""
+    query = select(CallHistory).where(CallHistory.end_time.is_not(None), *filters(CallHistory))
+    query = query.order_by(CallHistory.start_time, CallHistory.id).limit(limit)
+    page, pages = [], conn.execution_options(yield_per=PAGE_SIZE).execute(query).mappings()
+    for row in pages:
+        page.append(row)
+        if len(page) == PAGE_SIZE:
+            yield from _hot_page(conn, menu_names, page)
+            page = []
+    yield from _hot_page(conn, menu_names, page)
+
+
+def _hot_page(conn, menu_names, calls):
+    if not calls:
+        return
+    events = defaultdict(list)
+    for call_pk, kind, menu_id, value, at in conn.execute(
+        select(CallEvent.call_pk, CallEvent.kind, CallEvent.menu_id, CallEvent.value, CallEvent.at)
+        .where(CallEvent.call_pk.in_([call["id"] for call in calls]))
+        .order_by(CallEvent.call_pk, CallEvent.seq, CallEvent.id)
+    ):
+        events[call_pk].append((kind, menu_id, value, at))
+    for call in calls:
+        start = call["start_time"]
+        timeline = [(kind, menu_names.get(menu_id), value, (at - start).total_seconds() if at else None)
+                    for kind, menu_id, value, at in events[call["id"]]]
+        if timeline:
+            yield build_session(call["call_id"], call["caller_number"], start, call["end_time"], dict(call), timeline)
+
+
+def _archived_sessions(conn, menu_names, filters, limit):
+    query = select(CallArchive).where(*filters(CallArchive)).order_by(CallArchive.start_time, CallArchive.id).limit(limit)
+    for row in conn.execution_options(yield_per=PAGE_SIZE).execute(query).mappings():
+        data = decode_payload(row["payload"])
+        timeline = [(kind, menu_names.get(menu_id), value, None if ms is None else ms / 1000)
+                    for kind, menu_id, value, ms in data["e"]]
+        if timeline:
+            yield build_session(row["call_id"], row["caller_number"], row["start_time"], row["end_time"], data["s"], timeline)
+
+
+def read_sessions(url, since=None, until=None, limit=None):
+    """Sessions of ended calls in [since, until), hot and archived, in start order."""
+    def filters(model):
+        return [clause for clause in (model.start_time >= since if since else None,
+                                      model.start_time < until if until else None) if clause is not None]
+
+    engine = create_engine(url)
+    try:
+        with engine.connect() as conn:
+            menu_names = dict(conn.execute(select(MenuId.id, MenuId.name)).all())
+            merged = heapq.merge(_archived_sessions(conn, menu_names, filters, limit),
+                                 _hot_sessions(conn, menu_names, filters, limit), key=lambda s: s["start"])
+            for count, session in enumerate(merged):
+                if limit is not None and count >= limit:
+                    break
+                yield session
+    finally:
+        engine.dispose()
+
+
+def load_sessions(path, limit=None):
+    with open(path, encoding="utf-8") as f:
+        for count, line in enumerate(f):
+            if limit is not None and count >= limit:
+                break
+            if line.strip():
+                yield json.loads(line)
+
+
+# ==================== REFERENCE DATA ====================
+def reference_sources(reference):
+    """bulk_load sources from a database URL (streamed) or a list of bulk_load files."""
+    if isinstance(reference, str):
+        engine = create_engine(reference)
+
+        def rows(model):
+            with engine.connect() as conn:
+                for row in conn.execution_options(yield_per=CHUNK_SIZE).execute(select(model.__table__)).mappings():
+                    yield dict(row)
+        return {name: rows(model) for name, model in MODELS.items()}
+    return {table_for_path(path): read_rows(path, table_for_path(path)) for path in reference}
+
+
+def load_pins(url, ff_numbers):
+    """FF number -> PIN for the numbers replayed sessions entered."""
+    pins, numbers = {}, sorted(ff_numbers)
+    engine = create_engine(url)
+    with engine.connect() as conn:
+        for i in range(0, len(numbers), PAGE_SIZE):
+            pins.update(conn.execute(select(FrequentFlyer.ff_number, FrequentFlyer.pin)
+                                     .where(FrequentFlyer.ff_number.in_(numbers[i:i + PAGE_SIZE]))).all())
+    engine.dispose()
+    return pins
+
+
+def entered_ff_numbers(sessions):
+    return {value for session in sessions for _, kind, value, menu in session["steps"]
+            if menu == "frequent_flyer_number" and kind == "entry" and value}
+
+
+# ==================== REPLAY ====================
+class ReplayContext:
+    def __init__(self, client, speed, pins):
+        self.client = client
+        self.speed = speed
+        self.pins = pins
+        self.samples = []          # (endpoint, menu, seconds)
+        self.lag = []              # seconds each request was sent behind schedule
+        self.errors = defaultdict(int)
+        self.results = []
+
+    async def wait_until(self, due):
+        """Sleeps until `due` (perf_counter); records how late we are if already past it."""
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.lag.append(max(0.0, -delay))
+
+    async def post(self, endpoint, payload, menu):
+        start = time.perf_counter()
+        try:
+            response = await self.client.post(endpoint, json=payload)
+        except httpx.HTTPError as e:
+            self.errors[f"{endpoint} {type(e).__name__}"] += 1
+            return None
+        self.samples.append((endpoint, menu, time.perf_counter() - start))
+        if response.status_code != 200:
+            self.errors[f"{endpoint} HTTP {response.status_code}"] += 1
+            return None
+        return response.json()
+
+
+def collapse(path):
+    """Drops repeats (re-entering the menu you are in shows up once in a response stream)."""
+    return [menu for i, menu in enumerate(path) if i == 0 or menu != path[i - 1]]
+
+
+async def replay_session(ctx, session, due):
+    """Re-drives one call from `due` (perf_counter) on; returns its result."""
+    scale = 1 / ctx.speed if ctx.speed else 0.0
+    result = {"call_id": session["call_id"], "recorded": collapse(session["path"]), "replayed": ["main"],
+              "diverged_at": None, "incomplete": False}
+    await ctx.wait_until(due)
+    started = await ctx.post("/ivr/start", {"caller_number": session["caller_number"] or ""}, "(new call)")
+    if not started:
+        result["diverged_at"] = "start"
+        return result
+    call_id, menu, ended, ff_number = started["call_id"], "main", False, None
+
+    for index, (at, kind, value, step_menu) in enumerate(session["steps"]):
+        if step_menu != menu:
+            result["diverged_at"] = f"step {index} ({kind} in {step_menu}, replay in {menu})"
+            break
+        if kind == "pin":
+            value = ctx.pins.get(ff_number)
+        if value is None:
+            result["incomplete"] = True
+            value = "" if kind in ("entry", "pin") else "(unknown)"
+        await ctx.wait_until(due + at * scale)
+        if kind == "dtmf":
+            data = await ctx.post("/ivr/dtmf", {"call_id": call_id, "digit": value, "current_menu": menu}, menu)
+        elif kind == "voice":
+            data = await ctx.post("/ivr/process_voice", {"call_id": call_id, "text": value, "current_menu": menu}, menu)
+        else:
+            if menu == "frequent_flyer_number":
+                ff_number = value
+            data = await ctx.post("/ivr/dtmf_entry", {"call_id": call_id, "digits": f"{value}#", "current_menu": menu}, menu)
+        if data is None:
+            result["diverged_at"] = f"step {index} (request failed)"
+            break
+        menu = data.get("current_menu", menu)
+        if menu != result["replayed"][-1]:
+            result["replayed"].append(menu)
+        if data.get("status") in ("call_ended", "transferring") or data.get("call_action") == "hangup":
+            ended = True
+            break
+
+    if not ended:
+        await ctx.wait_until(due + session["end_at"] * scale)
+        await ctx.post("/ivr/end", {"call_id": call_id}, menu)
+    if result["diverged_at"] is None:
+        if result["replayed"] != result["recorded"]:
+            result["diverged_at"] = "menu path"
+        elif ended == session["caller_hung_up"]:
+            result["diverged_at"] = "call ended itself" if ended else "call did not end itself"
+    return result
+
+
+async def run_replay(base_url, sessions, speed, pins, concurrency_limit, transport=None):
+    limits = httpx.Limits(max_connections=concurrency_limit, max_keepalive_connections=concurrency_limit)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30.0, transport=transport) as client:
+        ctx = ReplayContext(client, speed, pins)
+        first = datetime.fromisoformat(sessions[0]["start"])
+        wall = time.perf_counter()
+        tasks = []
+        for session in sessions:
+            offset = (datetime.fromisoformat(session["start"]) - first).total_seconds()
+            tasks.append(asyncio.create_task(replay_session(ctx, session, wall + (offset / speed if speed else 0.0))))
+        ctx.results = await asyncio.gather(*tasks)
+        return ctx, time.perf_counter() - wall
+
+
+# ==================== REPORT ====================
+def report(ctx, wall, show):
+    total = len(ctx.samples)
+    diverged = [r for r in ctx.results if r["diverged_at"]]
+    incomplete = sum(r["incomplete"] for r in ctx.results)
+    print(f"\nsessions={len(ctx.results)}  diverged={len(diverged)}  incomplete={incomplete}  "
+          f"requests={total}  throughput={total / wall:.1f} req/s  wall={wall:.1f}s")
+    if ctx.lag:
+        lag_ms = sorted(lag * 1000 for lag in ctx.lag)
+        print(f"schedule lag: p50={lag_ms[len(lag_ms) // 2]:.1f}ms  max={lag_ms[-1]:.1f}ms")
+    if ctx.errors:
+        print("errors: " + ", ".join(f"{name}={count}" for name, count in sorted(ctx.errors.items())))
+    if total:
+        report_group("endpoint", ctx.samples, 0)
+        report_group("menu", ctx.samples, 1)
+    if diverged:
+        print(f"\ndivergent calls (first {min(show, len(diverged))}):")
+        for result in diverged[:show]:
+            print(f"  {result['call_id']}: {result['diverged_at']}\n"
+                  f"    recorded {' > '.join(result['recorded'])}\n"
+                  f"    replayed {' > '.join(result['replayed'])}")
+    return diverged
+
+
+def write_jsonl(path, rows):
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, separators=(",", ":")) + "\n")
+            count += 1
+    return count
+
+
+# ==================== CLI ====================
+def _when(text):
+    return datetime.fromisoformat(text) if text else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded IVR calls against a fresh backend")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    extract = commands.add_parser("extract", help="write ended calls out as a sessions file")
+    run = commands.add_parser("run", help="replay sessions and report latency and divergence")
+    for sub in (extract, run):
+        sub.add_argument("--db", help="database URL to read calls from")
+        sub.add_argument("--since", help="only calls started at or after this (ISO date/time)")
+        sub.add_argument("--until", help="only calls started before this (ISO date/time)")
+        sub.add_argument("--limit", type=int, help="at most this many calls (the oldest first)")
+    extract.add_argument("--out", required=True, help="sessions file to write (JSONL)")
+    run.add_argument("--sessions", help="sessions file written by `extract`")
+    run.add_argument("--speed", type=float, default=1.0, help="time compression: 10 = ten times faster, 0 = no waiting")
+    run.add_argument("--reference", nargs="+", help="reference data: a database URL or bulk_load.py files (default: --db)")
+    run.add_argument("--url", help="replay against an already running server instead of starting one")
+    run.add_argument("--connections", type=int, default=100, help="most concurrent HTTP connections")
+    run.add_argument("--show", type=int, default=10, help="divergent calls to print")
+    run.add_argument("--divergences", help="write every divergent call to this JSONL file")
+    run.add_argument("--fail-on-divergence", action="store_true", help="exit 1 if any call diverged")
+    args = parser.parse_args(argv)
+
+    if args.command == "extract":
+        if not args.db:
+            parser.error("extract needs --db")
+        count = write_jsonl(args.out, read_sessions(args.db, _when(args.since), _when(args.until), args.limit))
+        print(f"{count} sessions -> {args.out}")
+        return 0
+
+    if bool(args.db) == bool(args.sessions):
+        parser.error("run needs exactly one of --db and --sessions")
+    if args.db:
+        sessions = list(read_sessions(args.db, _when(args.since), _when(args.until), args.limit))
+    else:
+        sessions = [s for s in load_sessions(args.sessions, args.limit)
+                    if (not args.since or s["start"] >= args.since) and (not args.until or s["start"] < args.until)]
+    if not sessions:
+        raise SystemExit("No sessions to replay")
+    reference = args.reference or ([args.db] if args.db else None)
+    if reference and len(reference) == 1 and "://" in reference[0]:
+        reference = reference[0]
+
+    server, db_path = None, None
+    if args.url:
+        base_url = args.url.rstrip("/")
+        pins = load_pins(reference, entered_ff_numbers(sessions)) if isinstance(reference, str) else {}
+    else:
+        db_path = os.path.join(tempfile.gettempdir(), f"ivr_replay_{os.getpid()}.db")
+        if reference:
+            print("Loading reference data...")
+            local = create_engine(f"sqlite:///{db_path}")
+            load_tables(local, reference_sources(reference), skip_existing=True)
+            local.dispose()
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        print(f"Starting uvicorn on {base_url} with SQLite {db_path}...")
+        server = start_local_server(db_path, port) # <--- No admission control or rate limits (NO_ADMISSION_ENV)
+
+    try:
+        if server:
+            wait_until_ready(base_url, server)
+            pins = load_pins(f"sqlite:///{db_path}", entered_ff_numbers(sessions))
+        span = (datetime.fromisoformat(sessions[-1]["start"]) - datetime.fromisoformat(sessions[0]["start"])).total_seconds()
+        print(f"sessions={len(sessions)} recorded span={span:.0f}s speed={args.speed or 'max'}")
+        ctx, wall = asyncio.run(run_replay(base_url, sessions, args.speed, pins, args.connections))
+        diverged = report(ctx, wall, args.show)
+        if args.divergences:
+            write_jsonl(args.divergences, diverged)
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=10)
+        if db_path:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+    return 1 if diverged and args.fail_on_divergence else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+# bulk_load.py
+# Streaming bulk loader for flights, bookings and frequent flyers, plus a
+# synthetic data generator for production-sized test databases.
+#
+# Rows are read from CSV or JSONL files (or straight from the generator) and
+# inserted CHUNK_SIZE at a time with Core executemany INSERTs, one
+# transaction per chunk. Nothing holds more than one chunk in memory, so a
+# million bookings load in the same footprint as a hundred.
+#
+# --rebuild-indexes drops each table's non-unique secondary indexes before
+# the load and recreates them afterwards (unique ones stay: they guard the
+# data). --skip-existing turns rows whose key already exists into no-ops.
+# stat_counters rows for the loaded tables are recounted at the end.
+#
+# Usage:
+#   python bulk_load.py generate --bookings 500000 --out data/          # flights/bookings/frequent_flyers.jsonl
+#   python bulk_load.py load data/flights.jsonl data/bookings.jsonl data/frequent_flyers.jsonl --rebuild-indexes
+#   python bulk_load.py load --synthetic 500000 --rebuild-indexes         # generate straight into DATABASE_URL
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List
+
+from sqlalchemy import Integer, delete, insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import Base, Booking, Flight, FrequentFlyer, StatCounter, engine, init_stat_counters
+from id_allocator import PNR_SPACE, pnr_for_index
+
+CHUNK_SIZE = 5000
+
+# Load order matters: bookings reference flights
+MODELS = {"flights": Flight, "bookings": Booking, "frequent_flyers": FrequentFlyer}
+STAT_COUNTERS = {"bookings": ("bookings", "cancellations"), "frequent_flyers": ("ff_accounts",)}
+
+
+# ==================== READING ====================
+def table_for_path(path: str) -> str:
+    """`bookings.jsonl`, `bookings-0001.csv` -> bookings"""
+    stem = os.path.basename(path).split(".")[0]
+    for name in MODELS:
+        if stem.startswith(name):
+            return name
+    raise ValueError(f"Can't tell which table '{path}' is for (name it after one of: {', '.join(MODELS)})")
+
+
+def read_rows(path: str, table_name: str) -> Iterator[dict]:
+    """Streams rows from a CSV (header row) or JSONL file, typed for the table."""
+    columns = {column.name for column in MODELS[table_name].__table__.columns}
+    integers = {column.name for column in MODELS[table_name].__table__.columns if isinstance(column.type, Integer)}
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield {key: (None if value == "" else int(value) if key in integers else value)
+                       for key, value in row.items() if key in columns}
+        else:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    yield {key: value for key, value in row.items() if key in columns}
+
+
+def chunked(rows: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# ==================== LOADING ====================
+def _insert(bind, table, skip_existing: bool):
+    if not skip_existing:
+        return insert(table)
+    dialect = {"sqlite": sqlite, "postgresql": postgresql}.get(bind.dialect.name)
+    if dialect is None:
+        raise ValueError(f"--skip-existing is not supported on {bind.dialect.name}")
+    return dialect.insert(table).on_conflict_do_nothing()
+
+
+def secondary_indexes(table_name: str) -> list:
+    return [index for index in MODELS[table_name].__table__.indexes if not index.unique]
+
+
+def bulk_load(bind, table_name: str, rows: Iterable[dict], chunk_size: int = CHUNK_SIZE,
+              skip_existing: bool = False) -> int:
+    """Inserts `rows` chunk by chunk, one transaction each. Returns the rows sent."""
+    table = MODELS[table_name].__table__
+    statement = _insert(bind, table, skip_existing)
+    loaded = 0
+    for chunk in chunked(rows, chunk_size):
+        with bind.begin() as conn:
+            conn.execute(statement, chunk)
+        loaded += len(chunk)
+    return loaded
+
+
+def load_tables(bind, sources: Dict[str, Iterable[dict]], chunk_size: int = CHUNK_SIZE,
+                rebuild_indexes: bool = False, skip_existing: bool = False, progress=None) -> Dict[str, int]:
+    """Loads each table's rows (in MODELS order), then recounts its stat counters."""
+    Base.metadata.create_all(bind=bind)
+    loaded = {}
+    for table_name in MODELS:
+        if table_name not in sources:
+            continue
+        dropped = secondary_indexes(table_name) if rebuild_indexes else []
+        for index in dropped:
+            index.drop(bind, checkfirst=True)
+        started = time.perf_counter()
+        try:
+            loaded[table_name] = bulk_load(bind, table_name, sources[table_name], chunk_size, skip_existing)
+        finally:
+            for index in dropped:
+                index.create(bind, checkfirst=True) # <--- One sorted build instead of millions of inserts
+        if progress:
+            progress(table_name, loaded[table_name], time.perf_counter() - started)
+
+    names = [name for table_name in loaded for name in STAT_COUNTERS.get(table_name, ())]
+    if names:
+        with bind.begin() as conn:
+            conn.execute(delete(StatCounter).where(StatCounter.name.in_(names)))
+        init_stat_counters(bind) # <--- Recounted once, from the loaded data
+    return loaded
+
+
+# ==================== SYNTHETIC DATA ====================
+AIRLINES = [("AI", 30), ("6E", 35), ("UK", 12), ("SG", 8), ("QP", 5), ("EK", 4), ("BA", 3), ("QF", 2), ("SQ", 1)]
+CITIES = ["Mumbai", "Delhi", "Bangalore", "Chennai", "Kolkata", "Hyderabad", "Goa", "Pune", "Ahmedabad", "Kochi",
+          "Jaipur", "Lucknow", "Dubai", "Singapore", "London", "Sydney", "Doha", "Bangkok"]
+FLIGHT_STATUSES = [("Confirmed", 55), ("On Time", 25), ("Delayed", 10), ("Boarding", 6), ("Cancelled", 4)]
+FIRST_INITIALS = "ABCDEFGHJKLMNPRSTV"
+LAST_NAMES = ["Kumar", "Sharma", "Patel", "Singh", "Reddy", "Iyer", "Nair", "Gupta", "Das", "Banerjee", "Khan",
+              "Fernandes", "Menon", "Rao", "Chen", "Smith", "Al-Jaber", "Muthuraj", "Joshi", "Pillai"]
+FF_MIN, FF_SPACE, FF_MULTIPLIER = 100000000, 900000000, 7919 * 104729 # <--- Multiplier coprime with the space
+
+
+def _weighted(choices):
+    values, weights = zip(*choices)
+    return values, weights
+
+
+def generate_flights(count: int, rng: random.Random) -> Iterator[dict]:
+    airlines, airline_weights = _weighted(AIRLINES)
+    statuses, status_weights = _weighted(FLIGHT_STATUSES)
+    numbers = {} # <--- 4-digit flight numbers, so they never clash with the 3-digit seed flights
+    for _ in range(count):
+        airline = rng.choices(airlines, airline_weights)[0]
+        numbers[airline] = numbers.get(airline, 1000) + rng.randint(1, 9)
+        origin, destination = rng.sample(CITIES, 2)
+        status = rng.choices(statuses, status_weights)[0]
+        hour, minute = rng.randint(0, 23), rng.choice((0, 10, 15, 20, 30, 40, 45, 50))
+        yield {
+            "flight": f"{airline}{numbers[airline]}",
+            "route": f"{origin} to {destination}",
+            "time": f"{rng.choice(('Today', 'Tomorrow'))} {(hour % 12) or 12}:{minute:02d} {'AM' if hour < 12 else 'PM'}",
+            "status": status,
+            "seats_available": 0 if status in ("Cancelled", "Boarding") else rng.randint(0, 180),
+        }
+
+
+def generate_bookings(count: int, flights: List[dict], rng: random.Random) -> Iterator[dict]:
+    """PNRs come from the END of the allocator's sequence, so live bookings rarely have to skip them."""
+    if count > PNR_SPACE:
+        raise ValueError(f"At most {PNR_SPACE} bookings fit in the 6-digit PNR space")
+    # Popularity is Zipf-like: a few busy flights, a long tail of quiet ones
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(flights) + 1)))
+    for i in range(count):
+        flight = rng.choices(flights, cum_weights=cum_weights)[0]
+        pnr = pnr_for_index(PNR_SPACE - 1 - i)
+        cancelled = flight["status"] == "Cancelled" or rng.random() < 0.06
+        age = min(90, max(1, int(rng.gauss(38, 14))))
+        yield {
+            "pnr_key": pnr,
+            "pnr_display": flight["flight"][:2] + pnr[2:],
+            "flight": flight["flight"],
+            "status": "Cancelled" if cancelled else flight["status"],
+            "passenger_name": f"{rng.choice(FIRST_INITIALS)}. {rng.choice(LAST_NAMES)}",
+            "passenger_age": age,
+            "passenger_gender": rng.choices(("Male", "Female", "Other"), (49, 49, 2))[0],
+        }
+
+
+def generate_frequent_flyers(count: int, rng: random.Random) -> Iterator[dict]:
+    for i in range(count):
+        yield {
+            "ff_number": str(FF_MIN + (i * FF_MULTIPLIER + 271828) % FF_SPACE),
+            "pin": f"{rng.randint(0, 9999):04d}",
+            "name": rng.choice(LAST_NAMES),
+            "points": int(rng.paretovariate(1.5) * 1000), # <--- Most members have little, a few have a lot
+        }
+
+
+def synthetic_sources(bookings: int, flights: int = None, frequent_flyers: int = None,
+                      seed: int = 1) -> Dict[str, Iterable[dict]]:
+    """Generators for a dataset of `bookings` PNRs; flights and members scale with it by default."""
+    rng = random.Random(seed)
+    flight_rows = list(generate_flights(flights or max(20, bookings // 500), rng)) # <--- Small: kept for the bookings
+    return {
+        "flights": iter(flight_rows),
+        "bookings": generate_bookings(bookings, flight_rows, rng),
+        "frequent_flyers": generate_frequent_flyers(frequent_flyers if frequent_flyers is not None else bookings // 4, rng),
+    }
+
+
+def write_rows(path: str, rows: Iterable[dict]) -> int:
+    written = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = None
+        for row in rows:
+            if path.endswith(".csv"):
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+            else:
+                f.write(json.dumps(row, separators=(",", ":")) + "\n")
+            written += 1
+    return written
+
+
+# ==================== CLI ====================
+def _report(table_name, count, seconds):
+    print(f"{table_name:<16} {count:>10} rows  {seconds:>7.1f}s  {count / seconds if seconds else 0:>10.0f} rows/s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-load or generate flights, bookings and frequent flyers")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="write a synthetic dataset to files")
+    gen.add_argument("--bookings", type=int, required=True)
+    gen.add_argument("--flights", type=int)
+    gen.add_argument("--frequent-flyers", type=int)
+    gen.add_argument("--seed", type=int, default=1)
+    gen.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    gen.add_argument("--out", default=".")
+
+    load = commands.add_parser("load", help="load files (or a synthetic dataset) into DATABASE_URL")
+    load.add_argument("files", nargs="*", help="CSV/JSONL files named after their table, e.g. bookings.csv")
+    load.add_argument("--synthetic", type=int, metavar="BOOKINGS", help="generate this many bookings instead of reading files")
+    load.add_argument("--seed", type=int, default=1)
+    load.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    load.add_argument("--rebuild-indexes", action="store_true", help="drop secondary indexes during the load")
+    load.add_argument("--skip-existing", action="store_true", help="ignore rows whose key already exists")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        os.makedirs(args.out, exist_ok=True)
+        sources = synthetic_sources(args.bookings, args.flights, args.frequent_flyers, args.seed)
+        for table_name, rows in sources.items():
+            path = os.path.join(args.out, f"{table_name}.{args.format}")
+            print(f"{path}: {write_rows(path, rows)} rows")
+        return
+
+    if args.synthetic:
+        sources = synthetic_sources(args.synthetic, seed=args.seed)
+    elif args.files:
+        sources = {}
+        for path in args.files:
+            table_name = table_for_path(path)
+            if table_name in sources:
+                parser.error(f"More than one file for {table_name}")
+            sources[table_name] = read_rows(path, table_name)
+    else:
+        parser.error("Pass files to load or --synthetic N")
+    load_tables(engine, sources, args.chunk_size, args.rebuild_indexes, args.skip_existing, progress=_report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+# call_archive.py
+# Hot/archive split for call history.
+#
+#   call_history + call_events : live calls and recently ended ones (hot)
+#   call_archive               : ended calls older than ARCHIVE_AFTER_DAYS
+#
+# The archiver moves calls over in batches of ARCHIVE_BATCH_SIZE, one short
+# transaction each (insert archive rows, delete their events, delete the
+# calls), so it never holds locks on the hot tables for long. An archived
+# call is ONE row: its state and events are packed into `payload`
+# (zlib-compressed JSON, menus as small-int IDs, event times as ms offsets
+# from the call start). Archive rows older than ARCHIVE_RETENTION_DAYS are
+# purged, also in batches (0 = keep forever).
+#
+# Live lookups (get_active_call, end_call_logic, the reaper) only ever touch
+# call_history. read_call_history() is the one reader that spans both.
+
+import asyncio
+import json
+import zlib
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from call_events import EVENT_MENU, HISTORY_INPUTS, load_history
+from call_state import CallState
+from database import CallArchive, CallEvent, CallHistory, MenuId
+from ivr_logging import get_logger
+
+log = get_logger("db")
+
+PAYLOAD_VERSION = 1
+
+
+# ==================== ENCODING ====================
+def encode_payload(call: CallHistory, events: List[tuple]) -> bytes:
+    """events: (kind, menu_id, value, at) in order."""
+    start = call.start_time
+    data = {
+        "v": PAYLOAD_VERSION,
+        "s": {name: getattr(call, name) for name in CallState.FLUSH_FIELDS
+              if name != "last_activity" and getattr(call, name) not in (None, "")},
+        "e": [
+            [kind, menu_id, value, int((at - start).total_seconds() * 1000) if at and start else None]
+            for kind, menu_id, value, at in events
+        ],
+    }
+    if call.menu_path or call.inputs:
+        data["legacy"] = [call.menu_path or [], call.inputs or []] # <--- Calls from before call_events
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode(), 9)
+
+
+def decode_payload(payload: bytes) -> dict:
+    return json.loads(zlib.decompress(payload))
+
+
+# ==================== READING ====================
+async def read_call_history(db: AsyncSession, call_id: str) -> Optional[dict]:
+    """One call's record and history, from the hot tables or the archive."""
+    call = await db.scalar(select(CallHistory).filter(CallHistory.call_id == call_id))
+    if call is not None:
+        menu_path, inputs = await load_history(db, call)
+        return {
+            "call_id": call.call_id, "caller_number": call.caller_number,
+            "start_time": call.start_time, "end_time": call.end_time,
+            "state": {name: getattr(call, name) for name in CallState.FLUSH_FIELDS},
+            "menu_path": menu_path, "inputs": inputs, "archived": False,
+        }
+
+    archived = await db.scalar(select(CallArchive).filter(CallArchive.call_id == call_id))
+    if archived is None:
+        return None
+    data = decode_payload(archived.payload)
+    if data["e"]:
+        menu_names = dict((await db.execute(select(MenuId.id, MenuId.name))).all())
+        menu_path = [menu_names.get(menu_id, f"menu#{menu_id}") for kind, menu_id, _, _ in data["e"] if kind == EVENT_MENU]
+        inputs = [value for kind, _, value, _ in data["e"] if kind in HISTORY_INPUTS]
+    else:
+        menu_path, inputs = data.get("legacy", [[], []])
+    return {
+        "call_id": archived.call_id, "caller_number": archived.caller_number,
+        "start_time": archived.start_time, "end_time": archived.end_time,
+        "state": data["s"], "menu_path": menu_path, "inputs": inputs, "archived": True,
+    }
+
+
+# ==================== ARCHIVER ====================
+class CallArchiver:
+    def __init__(self, session_factory, archive_after_days: float = 30, retention_days: float = 365,
+                 batch_size: int = 1000, interval: float = 3600.0):
+        self.session_factory = session_factory
+        self.archive_after = timedelta(days=archive_after_days)
+        self.retention = timedelta(days=retention_days) if retention_days > 0 else None
+        self.batch_size = batch_size
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def archive_batch(self, now: Optional[datetime] = None) -> int:
+        """Moves up to batch_size old ended calls into call_archive. Returns how many."""
+        cutoff = (now or datetime.now()) - self.archive_after
+        async with self.session_factory() as db:
+            calls = (await db.execute(
+                select(CallHistory)
+                .where(CallHistory.end_time.is_not(None), CallHistory.end_time < cutoff)
+                .order_by(CallHistory.end_time)
+                .limit(self.batch_size)
+            )).scalars().all()
+            if not calls:
+                return 0
+            pks = [call.id for call in calls]
+
+            events = {}
+            for call_pk, kind, menu_id, value, at in (await db.execute(
+                select(CallEvent.call_pk, CallEvent.kind, CallEvent.menu_id, CallEvent.value, CallEvent.at)
+                .where(CallEvent.call_pk.in_(pks))
+                .order_by(CallEvent.call_pk, CallEvent.seq, CallEvent.id)
+            )).all():
+                events.setdefault(call_pk, []).append((kind, menu_id, value, at))
+
+            await db.execute(insert(CallArchive), [
+                {"call_id": call.call_id, "caller_number": call.caller_number, "start_time": call.start_time,
+                 "end_time": call.end_time, "payload": encode_payload(call, events.get(call.id, []))}
+                for call in calls
+            ])
+            await db.execute(delete(CallEvent).where(CallEvent.call_pk.in_(pks)))
+            await db.execute(delete(CallHistory).where(CallHistory.id.in_(pks)))
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Another worker archived the same calls first
+                await db.rollback()
+                return 0
+        return len(calls)
+
+    async def purge_batch(self, now: Optional[datetime] = None) -> int:
+        """Deletes up to batch_size archive rows past the retention period."""
+        if self.retention is None:
+            return 0
+        cutoff = (now or datetime.now()) - self.retention
+        async with self.session_factory() as db:
+            expired = select(CallArchive.id).where(CallArchive.end_time < cutoff).limit(self.batch_size)
+            result = await db.execute(delete(CallArchive).where(CallArchive.id.in_(expired.scalar_subquery())))
+            await db.commit()
+            return result.rowcount
+
+    async def run_once(self, now: Optional[datetime] = None) -> dict:
+        """Archives, then purges, batch after batch until nothing is left."""
+        archived = purged = 0
+        while True:
+            moved = await self.archive_batch(now)
+            archived += moved
+            if moved < self.batch_size:
+                break
+            await asyncio.sleep(0) # <--- Let requests run between batches
+        while True:
+            deleted = await self.purge_batch(now)
+            purged += deleted
+            if deleted < self.batch_size:
+                break
+            await asyncio.sleep(0)
+        if archived or purged:
+            log.info("call_archive_run", extra={"archived": archived, "purged": purged})
+        return {"archived": archived, "purged": purged}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                log.warning("call_archive_failed", extra={"error": str(e)})
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
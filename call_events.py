@@ -0,0 +1,136 @@
+# call_events.py
+# Append-only call history.
+#
+# Every menu change, key press and status note of a call is one small row in
+# call_events (menus stored as small-int IDs from the menus table). Rows are
+# buffered per process and inserted in bulk by the call-state flusher, or
+# straight away for a call that is ending. menu_path / inputs are only
+# rebuilt when someone actually reads a call's history (load_history).
+# Entries (the PNR behind a '#', a spoken name) are kept for
+# benchmarks/replay_calls.py but are not part of `inputs`.
+
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import CallEvent, CallHistory, MenuId
+
+EVENT_MENU = 1   # caller entered a menu (menu_id)
+EVENT_INPUT = 2  # caller pressed an option key (value)
+EVENT_NOTE = 3   # status message recorded when the call ended (value)
+EVENT_ENTRY = 4  # PNR / flight / age / name / FF number submitted in an entry menu (value; None for PINs)
+
+HISTORY_INPUTS = (EVENT_INPUT, EVENT_NOTE) # <--- What `inputs` has always listed
+
+_events_table = CallEvent.__table__
+
+
+# ==================== MENU IDS ====================
+class MenuIds:
+    """Menu name <-> small int, loaded from (and extended in) the menus table."""
+
+    def __init__(self):
+        self.by_name: Dict[str, int] = {}
+        self.by_id: Dict[int, str] = {}
+
+    async def load(self, session_factory, names: Iterable[str]) -> None:
+        """Reads the menus table and adds any menu it doesn't know yet."""
+        names = list(names)
+        while True:
+            async with session_factory() as db:
+                rows = (await db.execute(select(MenuId.id, MenuId.name))).all()
+                known = {name: menu_id for menu_id, name in rows}
+                missing = [name for name in names if name not in known]
+                next_id = max(known.values(), default=0) + 1
+                for offset, name in enumerate(missing):
+                    known[name] = next_id + offset
+                if missing:
+                    try:
+                        await db.execute(insert(MenuId), [{"id": known[name], "name": name} for name in missing])
+                        await db.commit()
+                    except IntegrityError:
+                        # Another worker added menus at the same moment: re-read
+                        await db.rollback()
+                        continue
+            self.by_name = known
+            self.by_id = {menu_id: name for name, menu_id in known.items()}
+            return
+
+
+# ==================== WRITE BUFFER ====================
+class EventBuffer:
+    """Events recorded by this process that are not in call_events yet."""
+
+    def __init__(self, menu_ids: MenuIds):
+        self.menu_ids = menu_ids
+        self._rows: List[dict] = []
+
+    def _add(self, call, kind, menu_id=None, value=None):
+        self._rows.append({
+            "call_pk": call.id, "seq": call.event_seq, "kind": kind,
+            "menu_id": menu_id, "value": value, "at": datetime.now(),
+        })
+        call.event_seq += 1
+
+    def menu(self, call, menu_name: str) -> None:
+        self._add(call, EVENT_MENU, menu_id=self.menu_ids.by_name[menu_name])
+
+    def input(self, call, digit: str) -> None:
+        self._add(call, EVENT_INPUT, value=digit)
+
+    def entry(self, call, value) -> None:
+        self._add(call, EVENT_ENTRY, value=None if value is None else str(value)[:200])
+
+    def note(self, call, message: str) -> None:
+        self._add(call, EVENT_NOTE, value=message[:200])
+
+    def take(self) -> List[dict]:
+        rows, self._rows = self._rows, []
+        return rows
+
+    def take_for(self, call_pk: int) -> List[dict]:
+        """Removes and returns the pending events of one call (used when it ends)."""
+        mine = [row for row in self._rows if row["call_pk"] == call_pk]
+        if mine:
+            self._rows = [row for row in self._rows if row["call_pk"] != call_pk]
+        return mine
+
+    def requeue(self, rows: List[dict]) -> None:
+        """Puts back events whose insert failed."""
+        self._rows[:0] = rows
+
+    def __len__(self):
+        return len(self._rows)
+
+
+async def write_events(db: AsyncSession, rows: List[dict]) -> None:
+    """One executemany INSERT. Does not commit."""
+    if rows:
+        await db.execute(insert(_events_table), rows)
+
+
+async def next_event_seq(db: AsyncSession, call_pk: int) -> int:
+    """Where a call's event numbering continues when its live state was lost."""
+    last = await db.scalar(select(func.max(CallEvent.seq)).where(CallEvent.call_pk == call_pk))
+    return 0 if last is None else last + 1
+
+
+# ==================== READING HISTORY ====================
+async def load_history(db: AsyncSession, call: CallHistory) -> Tuple[List[str], List[str]]:
+    """Rebuilds (menu_path, inputs) for one call from its events."""
+    rows = (await db.execute(
+        select(CallEvent.kind, MenuId.name, CallEvent.value)
+        .outerjoin(MenuId, MenuId.id == CallEvent.menu_id)
+        .where(CallEvent.call_pk == call.id)
+        .order_by(CallEvent.seq, CallEvent.id)
+    )).all()
+    if not rows:
+        # Recorded before call_events existed
+        return list(call.menu_path or []), list(call.inputs or [])
+
+    menu_path = [name for kind, name, _ in rows if kind == EVENT_MENU]
+    inputs = [value for kind, _, value in rows if kind in HISTORY_INPUTS]
+    return menu_path, inputs
@@ -0,0 +1,109 @@
+# call_reaper.py
+# Ends calls that were abandoned without /ivr/end.
+#
+# A caller who just hangs up (or a frontend that crashes) used to leave the
+# call active forever. Every CALL_REAPER_INTERVAL_SECONDS this task ends,
+# in ONE set-based UPDATE, every call whose last_activity is older than
+# CALL_IDLE_TIMEOUT_SECONDS, and appends an "Idle timeout" note to each.
+# The sweep reads the partial index ix_call_history_active (active calls
+# only), so it stays cheap however large call_history grows.
+#
+# Safe with several workers: the UPDATE only matches calls that are still
+# active, so each abandoned call is ended by exactly one of them.
+
+import asyncio
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import func, insert, literal, select, update
+
+import stats
+from call_events import EVENT_NOTE, EventBuffer
+from call_state import CallStateFlusher, CallStateStore
+from database import CallEvent, CallHistory
+from history_writer import HistoryWriter
+from ivr_logging import get_logger
+
+log = get_logger("call")
+
+IDLE_NOTE = "Idle timeout"
+
+
+class IdleCallReaper:
+    def __init__(self, session_factory, store: CallStateStore, flusher: CallStateFlusher,
+                 event_buffer: EventBuffer, history_writer: HistoryWriter,
+                 timeout: float = 900.0, interval: float = 60.0):
+        self.session_factory = session_factory
+        self.store = store
+        self.flusher = flusher
+        self.event_buffer = event_buffer
+        self.history_writer = history_writer
+        self.timeout = timeout
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def sweep(self, now: Optional[datetime] = None) -> List[str]:
+        """Ends every call idle past the timeout. Returns their call IDs."""
+        now = now or datetime.now()
+        # Write this worker's pending last_activity / events first, so a call
+        # that is merely waiting for its flush is not mistaken for an idle one
+        await self.flusher.flush()
+
+        table = CallHistory.__table__
+        statement = (
+            update(table)
+            .where(table.c.end_time.is_(None))
+            .where(table.c.last_activity < now - timedelta(seconds=self.timeout))
+            .values(end_time=now)
+            .returning(table.c.id, table.c.call_id)
+        )
+        ending = self.history_writer.pending_call_pks()
+        if ending:
+            statement = statement.where(table.c.id.not_in(ending)) # <--- Already ended, just not committed yet
+        async with self.session_factory() as db:
+            reaped = (await db.execute(statement)).all()
+            if not reaped:
+                await db.rollback()
+                return []
+
+            # The note goes after the call's last event, for all of them in one INSERT ... SELECT
+            events = CallEvent.__table__
+            next_seq = (
+                select(func.coalesce(func.max(events.c.seq) + 1, 0))
+                .where(events.c.call_pk == table.c.id)
+                .scalar_subquery()
+            )
+            await db.execute(insert(events).from_select(
+                ["call_pk", "seq", "kind", "value", "at"],
+                select(table.c.id, next_seq, literal(EVENT_NOTE), literal(IDLE_NOTE), literal(now))
+                .where(table.c.id.in_([row.id for row in reaped])),
+            ))
+            await stats.bump(db, "calls_ended", len(reaped))
+            await db.commit()
+
+        for row in reaped:
+            self.event_buffer.take_for(row.id) # <--- Anything buffered since the flush belongs to an ended call
+            await self.store.delete(row.call_id)
+        log.info("idle_calls_ended", extra={"calls": len(reaped), "timeout_s": self.timeout})
+        return [row.call_id for row in reaped]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                log.warning("idle_sweep_failed", extra={"error": str(e)})
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
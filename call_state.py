@@ -0,0 +1,342 @@
+# call_state.py
+# Live call state, kept out of the database on the hot path.
+#
+# Every keypress used to SELECT the CallHistory row, mutate it and COMMIT.
+# Now the live state sits in a CallStateStore and is written back to
+# CallHistory in the background (write-behind) and once more at call end.
+#
+#   memory : dict in this process. Fastest; only safe with ONE worker.
+#   sqlite : small shared SQLite file. Safe across gunicorn workers on one host.
+#
+# Pick one with CALL_STATE_BACKEND=memory|sqlite (default: memory).
+#
+# A flush that loses the database connection puts everything back for the
+# next one; any other error makes it write call by call, dropping (and
+# logging) only the calls that still fail on their own.
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import update, bindparam
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from database import CallHistory
+from call_events import EventBuffer, write_events
+from ivr_logging import get_logger
+
+log = get_logger("db")
+
+
+# ==================== CALL STATE ====================
+class CallState:
+    """Plain-Python copy of the state columns of one CallHistory row."""
+
+    # Columns written back to CallHistory by the flusher (end_time is only
+    # ever written by end_call_logic, so a late flush can't "re-open" a call).
+    # The path/input history is not here: it goes to call_events.
+    FLUSH_FIELDS = (
+        "current_menu", "input_buffer", "last_activity",
+        "active_pnr", "active_ff_number",
+        "booking_flight", "booking_name", "booking_age", "booking_gender",
+    )
+
+    ROW_FIELDS = ("id", "call_id", "caller_number", "start_time", "end_time") + FLUSH_FIELDS
+
+    # event_seq: number of the call's next call_events row
+    __slots__ = ROW_FIELDS + ("event_seq",)
+
+    def __init__(self, id, call_id, caller_number=None, start_time=None, end_time=None,
+                 current_menu="main", input_buffer="", last_activity=None,
+                 active_pnr=None, active_ff_number=None, booking_flight=None,
+                 booking_name=None, booking_age=None, booking_gender=None, event_seq=0):
+        self.id = id
+        self.call_id = call_id
+        self.caller_number = caller_number
+        self.start_time = start_time
+        self.end_time = end_time
+        self.current_menu = current_menu
+        self.input_buffer = input_buffer or ""
+        self.last_activity = last_activity
+        self.active_pnr = active_pnr
+        self.active_ff_number = active_ff_number
+        self.booking_flight = booking_flight
+        self.booking_name = booking_name
+        self.booking_age = booking_age
+        self.booking_gender = booking_gender
+        self.event_seq = event_seq
+
+    @classmethod
+    def from_row(cls, row: CallHistory, event_seq: int = 0) -> "CallState":
+        return cls(event_seq=event_seq, **{name: getattr(row, name) for name in cls.ROW_FIELDS})
+
+    def to_dict(self) -> dict:
+        data = {name: getattr(self, name) for name in self.__slots__}
+        for name in DATETIME_FIELDS:
+            if data[name] is not None:
+                data[name] = data[name].isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CallState":
+        data = dict(data)
+        for name in DATETIME_FIELDS:
+            if data.get(name):
+                data[name] = datetime.fromisoformat(data[name])
+        return cls(**data)
+
+    def flush_params(self) -> dict:
+        """Bind parameters for the write-behind UPDATE."""
+        params = {name: getattr(self, name) for name in self.FLUSH_FIELDS}
+        params["_id"] = self.id
+        return params
+
+
+DATETIME_FIELDS = ("start_time", "end_time", "last_activity")
+
+
+# ==================== STORES ====================
+class CallStateStore:
+    """Where live call state is kept between requests."""
+
+    async def get(self, call_id: str) -> Optional[CallState]:
+        raise NotImplementedError
+
+    async def put(self, state: CallState) -> None:
+        """Saves the state and marks it dirty for the next background flush."""
+        raise NotImplementedError
+
+    async def delete(self, call_id: str) -> None:
+        raise NotImplementedError
+
+    async def take_dirty(self) -> List[CallState]:
+        """Returns every dirty state and marks them clean, atomically."""
+        raise NotImplementedError
+
+    async def mark_dirty(self, call_ids: List[str]) -> None:
+        """Re-queues states whose flush failed."""
+        raise NotImplementedError
+
+    async def count(self) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class InMemoryCallStateStore(CallStateStore):
+    """Hot, per-process store. Only correct when every request for a call reaches the same process."""
+
+    def __init__(self):
+        self._states: Dict[str, CallState] = {}
+        self._dirty = set()
+
+    async def get(self, call_id):
+        return self._states.get(call_id)
+
+    async def put(self, state):
+        self._states[state.call_id] = state
+        self._dirty.add(state.call_id)
+
+    async def delete(self, call_id):
+        self._states.pop(call_id, None)
+        self._dirty.discard(call_id)
+
+    async def take_dirty(self):
+        dirty, self._dirty = self._dirty, set()
+        return [self._states[call_id] for call_id in dirty if call_id in self._states]
+
+    async def mark_dirty(self, call_ids):
+        self._dirty.update(call_id for call_id in call_ids if call_id in self._states)
+
+    async def count(self):
+        return len(self._states)
+
+
+class SQLiteCallStateStore(CallStateStore):
+    """Store shared by every worker on the host through one small SQLite file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS call_state ("
+            " call_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " dirty INTEGER NOT NULL DEFAULT 1)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_call_state_dirty ON call_state (dirty) WHERE dirty = 1")
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread: asyncio.to_thread may use any pool thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _get(self, call_id):
+        row = self._conn().execute("SELECT data FROM call_state WHERE call_id = ?", (call_id,)).fetchone()
+        return CallState.from_dict(json.loads(row[0])) if row else None
+
+    def _put(self, state):
+        self._conn().execute(
+            "INSERT INTO call_state (call_id, data, dirty) VALUES (?, ?, 1) "
+            "ON CONFLICT(call_id) DO UPDATE SET data = excluded.data, dirty = 1",
+            (state.call_id, json.dumps(state.to_dict())),
+        )
+
+    def _delete(self, call_id):
+        self._conn().execute("DELETE FROM call_state WHERE call_id = ?", (call_id,))
+
+    def _take_dirty(self):
+        # UPDATE ... RETURNING claims the rows in one statement, so two
+        # workers flushing at the same time never both write the same call
+        rows = self._conn().execute(
+            "UPDATE call_state SET dirty = 0 WHERE dirty = 1 RETURNING data"
+        ).fetchall()
+        return [CallState.from_dict(json.loads(row[0])) for row in rows]
+
+    def _mark_dirty(self, call_ids):
+        self._conn().executemany("UPDATE call_state SET dirty = 1 WHERE call_id = ?", [(c,) for c in call_ids])
+
+    def _count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM call_state").fetchone()[0]
+
+    async def get(self, call_id):
+        return await asyncio.to_thread(self._get, call_id)
+
+    async def put(self, state):
+        await asyncio.to_thread(self._put, state)
+
+    async def delete(self, call_id):
+        await asyncio.to_thread(self._delete, call_id)
+
+    async def take_dirty(self):
+        return await asyncio.to_thread(self._take_dirty)
+
+    async def mark_dirty(self, call_ids):
+        await asyncio.to_thread(self._mark_dirty, call_ids)
+
+    async def count(self):
+        return await asyncio.to_thread(self._count)
+
+
+def create_call_state_store() -> CallStateStore:
+    """Builds the store selected by CALL_STATE_BACKEND."""
+    backend = os.environ.get("CALL_STATE_BACKEND", "memory").lower()
+    if backend == "memory":
+        if int(os.environ.get("WEB_CONCURRENCY", "1")) > 1:
+            # Each worker would see only its own calls (and revive other workers' calls from the DB)
+            log.warning("call_state_memory_multi_worker", extra={"workers": os.environ["WEB_CONCURRENCY"], "hint": "set CALL_STATE_BACKEND=sqlite"})
+        return InMemoryCallStateStore()
+    if backend == "sqlite":
+        return SQLiteCallStateStore(os.environ.get("CALL_STATE_SQLITE_PATH", "./ivr_call_state.db"))
+    raise ValueError(f"Unknown CALL_STATE_BACKEND '{backend}' (expected 'memory' or 'sqlite')")
+
+
+# ==================== WRITE-BEHIND ====================
+_call_table = CallHistory.__table__
+FLUSH_STATEMENT = (
+    update(_call_table)
+    .where(_call_table.c.id == bindparam("_id"))
+    .where(_call_table.c.end_time.is_(None))
+    .values({name: bindparam(name) for name in CallState.FLUSH_FIELDS})
+)
+
+
+class CallStateFlusher:
+    """Background task that writes dirty call states (and buffered call events) in one batch."""
+
+    def __init__(self, store: CallStateStore, session_factory, interval: float = 2.0,
+                 event_buffer: Optional[EventBuffer] = None):
+        self.store = store
+        self.session_factory = session_factory
+        self.interval = interval
+        self.event_buffer = event_buffer
+        self._task: Optional[asyncio.Task] = None
+
+    async def _write(self, states: List[CallState], events: List[dict]) -> None:
+        async with self.session_factory() as db:
+            if states:
+                await db.execute(FLUSH_STATEMENT, [state.flush_params() for state in states])
+            await write_events(db, events) # <--- One bulk INSERT for every call
+            await db.commit()
+
+    async def flush(self) -> int:
+        """Writes every dirty state now. Returns the number of calls written."""
+        try:
+            states = await self.store.take_dirty()
+        except Exception as e:
+            # Store unavailable (e.g. the sqlite file stayed locked): nothing was claimed, events stay buffered
+            log.warning("call_state_take_failed", extra={"error": str(e)})
+            return 0
+        events = self.event_buffer.take() if self.event_buffer is not None else []
+        if not states and not events:
+            return 0
+        try:
+            await self._write(states, events)
+        except (OperationalError, InterfaceError) as e:
+            # Database unreachable: everything goes back for the next flush
+            log.warning("call_state_flush_failed", extra={"calls": len(states), "events": len(events), "error": str(e)})
+            await self._requeue(states, events)
+            return 0
+        except Exception as e:
+            # Something in the batch is bad: write call by call so one row can't hold up the rest
+            log.warning("call_state_batch_failed", extra={"calls": len(states), "events": len(events), "error": str(e)})
+            return await self._flush_per_call(states, events)
+        return len(states)
+
+    async def _flush_per_call(self, states: List[CallState], events: List[dict]) -> int:
+        by_call: Dict[int, tuple] = {}
+        for state in states:
+            by_call.setdefault(state.id, ([], []))[0].append(state)
+        for event in events:
+            by_call.setdefault(event["call_pk"], ([], []))[1].append(event)
+        written = 0
+        for call_pk, (call_states, call_events) in by_call.items():
+            try:
+                await self._write(call_states, call_events)
+                written += len(call_states)
+            except (OperationalError, InterfaceError) as e:
+                log.warning("call_state_flush_failed", extra={"call_pk": call_pk, "error": str(e)})
+                await self._requeue(call_states, call_events)
+            except Exception as e:
+                # Still failing on its own: drop it (the store keeps the state; its next change is flushed again)
+                log.error("call_state_dropped", extra={"call_pk": call_pk, "events": len(call_events), "error": str(e)})
+        return written
+
+    async def _requeue(self, states: List[CallState], events: List[dict]) -> None:
+        if events:
+            self.event_buffer.requeue(events) # <--- First: can't fail, unlike the store
+        await self.store.mark_dirty([state.call_id for state in states])
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.warning("call_state_flush_loop_failed", extra={"error": str(e)})
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the loop and writes whatever is still dirty."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -2,25 +2,41 @@
 # (v5) - FINAL Test-Aware Version
 
 import os
-from sqlalchemy import create_engine, Column, String, Integer, DateTime, JSON
+import re
+import tempfile
+import time
+from sqlalchemy import create_engine, Column, String, Integer, BigInteger, SmallInteger, DateTime, JSON, LargeBinary, ForeignKey, Index, inspect, text
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base  # <-- Use this
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from datetime import datetime
 
+import metrics
+
 # 1. GET THE DATABASE URL
 DATABASE_URL = os.environ.get("DATABASE_URL")
 TESTING = os.environ.get("TESTING") == "true" # <--- NEW: Check for test mode
 
 # --- THIS IS THE NEW LOGIC ---
 if TESTING:
-    # If we are testing, ALWAYS use an in-memory database
-    print(">>> RUNNING IN TEST MODE: Using in-memory SQLite database.")
-    DATABASE_URL = "sqlite:///:memory:"
+    # If we are testing, ALWAYS use a throwaway SQLite database.
+    # NOTE: a plain ":memory:" database can't be shared between the sync
+    # engine (setup/seeding) and the async engine (request handlers), so
+    # tests get a per-process temp file instead.
+    TEST_DB_PATH = os.path.join(tempfile.gettempdir(), f"ivr_test_{os.getpid()}.db")
+    print(f">>> RUNNING IN TEST MODE: Using throwaway SQLite database '{TEST_DB_PATH}'.")
+    DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
 elif DATABASE_URL and DATABASE_URL.startswith("postgres"):
     # This is for production (Render)
     print(">>> RUNNING IN PRODUCTION MODE: Using PostgreSQL database.")
     if DATABASE_URL.startswith("postgres://"):
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+elif DATABASE_URL and DATABASE_URL.startswith("sqlite"):
+    # An explicit SQLite file (e.g. the load generator's throwaway database)
+    print(f">>> Using SQLite database from DATABASE_URL: {DATABASE_URL}")
 else:
     # This is for running locally (e.g., uvicorn main:app)
     print(">>> DATABASE_URL not found. Defaulting to local SQLite file 'ivr.db'.")
@@ -28,34 +44,184 @@ else:
 # --- END OF NEW LOGIC ---
 
 
+# --- METRICS HOOKS ---
+# Pool checkout wait is timed by a thin subclass of the engine's usual pool
+# class (it survives engine.dispose(), which recreates the pool from its class).
+# Statement timings come from the before/after_cursor_execute events.
+class _TimedCheckout:
+    metrics_label = "sync"
+
+    def _do_get(self):
+        metrics.POOL_WAITING.inc(self.metrics_label)
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.POOL_WAITING.dec(self.metrics_label)
+            metrics.POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started, self.metrics_label)
+
+def timed_pool(pool_class, label):
+    return type(f"Timed{pool_class.__name__}", (_TimedCheckout, pool_class), {"metrics_label": label})
+
+_STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+\"?(\w+)", re.IGNORECASE)
+_statement_labels = {} # <--- SQL text -> (kind, table); the set of statements is small and fixed
+
+def _statement_label(statement):
+    labels = _statement_labels.get(statement)
+    if labels is None:
+        words = statement.split(None, 1)
+        table = _STATEMENT_TABLE.search(statement)
+        labels = (words[0].upper() if words else "", table.group(1) if table else "")
+        if len(_statement_labels) < 1000:
+            _statement_labels[statement] = labels
+    return labels
+
+def instrument_engine(sync_engine, label):
+    """Statement timings + checked-out connection gauge for one (sync or async.sync_engine) engine."""
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_started", None)
+        if started is not None:
+            metrics.SQL_LATENCY.observe(time.perf_counter() - started, *_statement_label(statement))
+
+    @event.listens_for(sync_engine.pool, "checkout")
+    def _checkout(dbapi_connection, record, proxy):
+        metrics.POOL_CHECKED_OUT.inc(label)
+
+    @event.listens_for(sync_engine.pool, "checkin")
+    def _checkin(dbapi_connection, record):
+        metrics.POOL_CHECKED_OUT.dec(label)
+
+
+# --- ENGINE PROFILES ---
+# DB_ENGINE_PROFILE=tuned (default) applies the settings below;
+# DB_ENGINE_PROFILE=stock keeps SQLAlchemy's/SQLite's defaults (for comparisons).
+#   SQLite  : pragmas run on every new connection. WAL lets readers and the
+#             single writer work at the same time; synchronous=NORMAL is
+#             still crash-safe in WAL mode (only the last commits can be lost
+#             on power failure, never corruption).
+#   Postgres: pool sizing / timeout / recycle / pre-ping.
+ENGINE_PROFILE = os.environ.get("DB_ENGINE_PROFILE", "tuned").lower()
+
+def _env_bool(name, default):
+    return os.environ.get(name, default).lower() in ("1", "true", "yes", "on")
+
+def sqlite_pragmas() -> dict:
+    if ENGINE_PROFILE == "stock":
+        return {}
+    return {
+        "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+        "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+        "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", "-65536")), # <--- Negative = KiB, so 64 MiB
+        "temp_store": "MEMORY",
+    }
+
+def postgres_pool_options() -> dict:
+    if ENGINE_PROFILE == "stock":
+        return {}
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": _env_bool("DB_POOL_PRE_PING", "true"),
+    }
+
+def apply_sqlite_pragmas(sync_engine, pragmas):
+    """Runs the pragmas on each new DBAPI connection (sqlite3 or aiosqlite)."""
+    if not pragmas:
+        return
+
+    @event.listens_for(sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
 # 2. CREATE THE ENGINE
 # This engine will now be correct for all 3 modes (Test, Prod, Local)
-if DATABASE_URL.startswith("sqlite"):
-    print(">>> Using SQLite database.")
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+if IS_SQLITE:
+    print(f">>> Using SQLite database ({ENGINE_PROFILE} profile).")
+    ENGINE_OPTIONS = {}
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=timed_pool(QueuePool, "sync"))
+    apply_sqlite_pragmas(engine, sqlite_pragmas())
 else:
-    print(f">>> Using live PostgreSQL database.")
-    engine = create_engine(DATABASE_URL)
+    print(f">>> Using live PostgreSQL database ({ENGINE_PROFILE} profile).")
+    ENGINE_OPTIONS = postgres_pool_options()
+    engine = create_engine(DATABASE_URL, poolclass=timed_pool(QueuePool, "sync"), **ENGINE_OPTIONS)
+instrument_engine(engine, "sync")
+
+# 2b. CREATE THE ASYNC ENGINE
+# The request handlers are `async def`, so they must not use the blocking
+# engine above: one slow round trip would stall every caller on the worker.
+# Same database, async driver (aiosqlite / asyncpg).
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def to_async_url(url: str) -> str:
+    """Swaps the sync driver in a database URL for its asyncio counterpart."""
+    parsed = make_url(url)
+    return parsed.set(drivername=ASYNC_DRIVERS[parsed.get_backend_name()]).render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = to_async_url(DATABASE_URL)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=timed_pool(AsyncAdaptedQueuePool, "async"), **ENGINE_OPTIONS)
+if IS_SQLITE:
+    apply_sqlite_pragmas(async_engine.sync_engine, sqlite_pragmas())
+instrument_engine(async_engine.sync_engine, "async")
 
 # 3. STANDARD SESSION SETUP (This is now correct)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: attributes can't be lazy-loaded after a commit in async mode
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # 4. DATABASE MODELS (Your tables)
+
+# One row per flight. Seat inventory lives HERE, not on every booking, so a
+# booking/cancellation is a single conditional UPDATE of one row.
+def normalize_flight_code(code):
+    """The form stored in flights.flight_code and used for lookups: trimmed, uppercase."""
+    return code.strip().upper() if code is not None else None
+
+class Flight(Base):
+    __tablename__ = "flights"
+    id = Column(Integer, primary_key=True, index=True)
+    flight = Column(String(10), unique=True, index=True, nullable=False)
+    # Normalized copy of `flight`, so a lookup is an exact-match index probe
+    # instead of trim()/ilike() over every row. Set on insert; flight codes never change.
+    flight_code = Column(String(10), index=True,
+                         default=lambda ctx: normalize_flight_code(ctx.get_current_parameters().get("flight")))
+    route = Column(String(100))
+    time = Column(String(50))
+    status = Column(String(20))
+    seats_available = Column(Integer, nullable=False, default=0)
+
 class Booking(Base):
     __tablename__ = "bookings"
     id = Column(Integer, primary_key=True, index=True)
     pnr_key = Column(String(6), unique=True, index=True, nullable=False)
     pnr_display = Column(String(8))
-    flight = Column(String(10))
-    status = Column(String(20))
-    route = Column(String(100))
-    time = Column(String(50))
-    seats_available = Column(Integer)
+    flight = Column(String(10), ForeignKey("flights.flight"), index=True)
+    status = Column(String(20)) # <--- PNR status (e.g. Confirmed / Cancelled)
     passenger_name = Column(String(100))
     passenger_age = Column(Integer)
     passenger_gender = Column(String(10))
 
+    # Always loaded with the booking (async sessions can't lazy-load)
+    flight_info = relationship(Flight, lazy="joined")
+
 class FrequentFlyer(Base):
     __tablename__ = "frequent_flyers"
     id = Column(Integer, primary_key=True, index=True)
@@ -75,16 +241,16 @@ class CallHistory(Base):
     caller_number = Column(String(20))
     start_time = Column(DateTime, default=datetime.now)
     end_time = Column(DateTime, nullable=True) # A call that is not ended will have NULL here
+    last_activity = Column(DateTime, default=datetime.now) # <--- Last handled input (written behind by the flusher)
     
     # State Info
     current_menu = Column(String(50), default='main')
     input_buffer = Column(String(100), default='')
     
-    # --- THIS IS THE BUG FIX ---
-    # Use default=lambda: [] to create a new list for every row
-    menu_path = Column(JSON, default=lambda: ["main"])
-    inputs = Column(JSON, default=list)
-    # --- END BUG FIX ---
+    # Legacy, read-only: calls recorded before call_events existed kept their
+    # whole path/input history here. New calls leave them NULL.
+    menu_path = Column(JSON, nullable=True)
+    inputs = Column(JSON, nullable=True)
     
     # PNR/FF State
     active_pnr = Column(String(10), nullable=True)
@@ -96,10 +262,160 @@ class CallHistory(Base):
     booking_age = Column(Integer, nullable=True)
     booking_gender = Column(String(20), nullable=True)
 
-# 5. DEPENDENCY
+    # Partial index: only active calls are in it, so the idle sweep and
+    # active-call counts stay small however many ended calls pile up
+    __table_args__ = (
+        Index("ix_call_history_active", "last_activity",
+              sqlite_where=text("end_time IS NULL"), postgresql_where=text("end_time IS NULL")),
+        # Ended calls only, for picking calls to archive (and so the planner never
+        # prefers it over ix_call_history_active for "end_time IS NULL")
+        Index("ix_call_history_ended", "end_time",
+              sqlite_where=text("end_time IS NOT NULL"), postgresql_where=text("end_time IS NOT NULL")),
+    )
+
+# --- Ended calls older than ARCHIVE_AFTER_DAYS, moved out of the hot table ---
+# One row per call; state + events packed into `payload` (see call_archive.py).
+class CallArchive(Base):
+    __tablename__ = "call_archive"
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    call_id = Column(String(50), unique=True, nullable=False)
+    caller_number = Column(String(20))
+    start_time = Column(DateTime)
+    end_time = Column(DateTime, index=True) # <--- Retention purges by this
+    payload = Column(LargeBinary, nullable=False)
+
+# --- Menu name <-> small int, so each navigation event stores 2 bytes, not a name ---
+# IDs are only ever added, never renumbered, so old events keep their meaning.
+class MenuId(Base):
+    __tablename__ = "menus"
+    id = Column(SmallInteger, primary_key=True)
+    name = Column(String(50), unique=True, nullable=False)
+
+# --- Append-only call history: one row per menu change / key / status note ---
+# Replaces rewriting the menu_path/inputs JSON arrays on every keypress.
+class CallEvent(Base):
+    __tablename__ = "call_events"
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    call_pk = Column(Integer, ForeignKey("call_history.id"), nullable=False)
+    seq = Column(Integer, nullable=False)        # order within the call
+    kind = Column(SmallInteger, nullable=False)  # see call_events.EVENT_*
+    menu_id = Column(SmallInteger, nullable=True)
+    value = Column(String(200), nullable=True)
+    at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (Index("ix_call_events_call_seq", "call_pk", "seq"),)
+
+# --- Running totals for /stats and the health endpoints ---
+# Bumped in the same transaction as the event they count, so reading stats
+# is a handful of primary-key lookups instead of COUNT(*) over big tables.
+class StatCounter(Base):
+    __tablename__ = "stat_counters"
+    name = Column(String(50), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+# --- High-water marks for the ID allocator (one row per sequence) ---
+# Workers take whole blocks with one UPDATE, then hand IDs out from memory.
+class IdBlock(Base):
+    __tablename__ = "id_blocks"
+    name = Column(String(50), primary_key=True)
+    next_value = Column(BigInteger, nullable=False, default=0)
+
+# 5. MIGRATIONS
+# Older databases kept route/time/seats_available copied onto every booking.
+LEGACY_FLIGHT_COLUMNS = ("route", "time", "seats_available")
+
+def migrate_flights_from_bookings(bind) -> int:
+    """
+    Fills the flights table from the legacy per-booking flight columns.
+    Safe to run on every startup: does nothing once flights has rows, or if
+    bookings never had the legacy columns. Returns the number of flights created.
+    """
+    booking_columns = {c["name"] for c in inspect(bind).get_columns("bookings")}
+    if not set(LEGACY_FLIGHT_COLUMNS) <= booking_columns:
+        return 0
+
+    with bind.begin() as conn:
+        if conn.execute(text("SELECT COUNT(*) FROM flights")).scalar():
+            return 0
+        # All bookings of a flight carried the same copy, so take the first one
+        result = conn.execute(text(
+            "INSERT INTO flights (flight, route, time, status, seats_available) "
+            "SELECT b.flight, b.route, b.time, b.status, COALESCE(b.seats_available, 0) "
+            "FROM bookings b "
+            "JOIN (SELECT flight, MIN(id) AS first_id FROM bookings WHERE flight IS NOT NULL GROUP BY flight) f "
+            "ON b.id = f.first_id"
+        ))
+        return result.rowcount
+
+def backfill_flight_codes(bind) -> int:
+    """
+    Adds flights.flight_code to databases created before it existed and fills
+    it for rows inserted without it (e.g. by raw SQL). Safe to run on every
+    startup. Returns the number of rows updated.
+    """
+    if "flight_code" not in {c["name"] for c in inspect(bind).get_columns("flights")}:
+        with bind.begin() as conn:
+            conn.execute(text("ALTER TABLE flights ADD COLUMN flight_code VARCHAR(10)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_flights_flight_code ON flights (flight_code)"))
+    with bind.begin() as conn:
+        return conn.execute(text(
+            "UPDATE flights SET flight_code = UPPER(TRIM(flight)) "
+            "WHERE flight_code IS NULL OR flight_code <> UPPER(TRIM(flight))"
+        )).rowcount
+
+def add_call_activity_column(bind) -> int:
+    """
+    Adds call_history.last_activity (and the active-call partial index) to
+    databases created before it existed; calls without it get their
+    start_time. Safe to run on every startup. Returns the rows backfilled.
+    """
+    if "last_activity" not in {c["name"] for c in inspect(bind).get_columns("call_history")}:
+        with bind.begin() as conn:
+            conn.execute(text("ALTER TABLE call_history ADD COLUMN last_activity TIMESTAMP"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_call_history_active ON call_history (last_activity) WHERE end_time IS NULL"))
+    with bind.begin() as conn:
+        return conn.execute(text(
+            "UPDATE call_history SET last_activity = COALESCE(start_time, CURRENT_TIMESTAMP) WHERE last_activity IS NULL"
+        )).rowcount
+
+def create_missing_indexes(bind, *models) -> None:
+    """create_all() skips indexes of tables that already exist; this adds them."""
+    for model in models:
+        for index in model.__table__.indexes:
+            index.create(bind, checkfirst=True)
+
+# Baseline for each counter, used once when its row doesn't exist yet
+# (archived calls count too: they were started and ended here)
+STAT_COUNTER_BASELINES = {
+    "calls_started": "SELECT (SELECT COUNT(*) FROM call_history) + (SELECT COUNT(*) FROM call_archive)",
+    "calls_ended": "SELECT (SELECT COUNT(*) FROM call_history WHERE end_time IS NOT NULL) + (SELECT COUNT(*) FROM call_archive)",
+    "bookings": "SELECT COUNT(*) FROM bookings",
+    "cancellations": "SELECT COUNT(*) FROM bookings WHERE status = 'Cancelled'",
+    "ff_accounts": "SELECT COUNT(*) FROM frequent_flyers",
+}
+
+def init_stat_counters(bind) -> int:
+    """
+    Creates any missing stat_counters row from a one-time count of the
+    existing data. Safe to run on every startup. Returns the rows created.
+    """
+    with bind.begin() as conn:
+        existing = {row[0] for row in conn.execute(text("SELECT name FROM stat_counters"))}
+        missing = [name for name in STAT_COUNTER_BASELINES if name not in existing]
+        for name in missing:
+            value = conn.execute(text(STAT_COUNTER_BASELINES[name])).scalar() or 0
+            conn.execute(text("INSERT INTO stat_counters (name, value) VALUES (:name, :value)"), {"name": name, "value": value})
+        return len(missing)
+
+# 6. DEPENDENCY
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+# Async version used by all the /ivr endpoints
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
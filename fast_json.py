@@ -0,0 +1,118 @@
+# fast_json.py
+# Response encoding for the hot IVR endpoints.
+#
+# Most responses are declared with a response model, so FastAPI serializes
+# them straight to bytes with pydantic-core (no jsonable_encoder pass).
+# Menu transitions skip even that: every static transition in MENU_GRAPH
+# (menu + the option's fixed message) is encoded ONCE at startup, and
+# _go_to_menu() hands back a MenuResponse that carries those bytes. Endpoints
+# wrapped in @serve_prepared send the bytes as they are.
+#
+# A handler may still edit the dict it got from _go_to_menu(); any change
+# drops the prepared body and the response goes through the model as usual.
+#
+# orjson is optional: without it the bodies are encoded once with json.
+
+import functools
+import json
+
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError: # pragma: no cover
+    orjson = None
+
+MEDIA_TYPE = "application/json"
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def menu_payload(menu: str, prompt: str, message=None) -> dict:
+    return {"status": "processed", "message": message, "current_menu": menu, "prompt": prompt}
+
+
+class MenuResponse(dict):
+    """A menu-transition response, with its pre-encoded body until someone changes it."""
+
+    __slots__ = ("body",)
+
+    def __init__(self, payload: dict, body: bytes = None):
+        super().__init__(payload)
+        self.body = body
+
+    def __setitem__(self, key, value):
+        self.body = None
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.body = None
+        super().__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self.body = None
+        super().update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        self.body = None
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self.body = None
+        return super().pop(*args)
+
+    def popitem(self):
+        self.body = None
+        return super().popitem()
+
+    def clear(self):
+        self.body = None
+        super().clear()
+
+    def __ior__(self, other):
+        self.body = None
+        return super().__ior__(other)
+
+
+class TransitionBodies:
+    """(target menu, message) -> encoded response, for every static transition of a menu graph."""
+
+    def __init__(self, graph):
+        self._graph = graph
+        self._bodies = {}
+        for name, node in graph.nodes.items():
+            self._add(name, None) # <--- _go_to_menu(call, menu) with no message
+            for option in node.options.values():
+                if option.action == "goto_menu" and option.target in graph:
+                    self._add(option.target, option.message)
+
+    def _add(self, menu: str, message) -> None:
+        self._bodies[(menu, message)] = dumps(menu_payload(menu, self._graph[menu].prompt, message))
+
+    def response(self, menu: str, message=None) -> MenuResponse:
+        payload = menu_payload(menu, self._graph[menu].prompt, message)
+        return MenuResponse(payload, self._bodies.get((menu, message))) # <--- None for dynamic messages
+
+    def __len__(self):
+        return len(self._bodies)
+
+
+def prepared_body(result):
+    """The pre-encoded bytes of an unmodified MenuResponse, else None."""
+    return result.body if type(result) is MenuResponse else None
+
+
+def serve_prepared(endpoint):
+    """Endpoint decorator: a still-pristine MenuResponse goes out as its prepared bytes."""
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        result = await endpoint(*args, **kwargs)
+        body = prepared_body(result)
+        if body is not None:
+            return Response(body, media_type=MEDIA_TYPE)
+        return result
+    return wrapper
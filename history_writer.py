@@ -0,0 +1,181 @@
+# history_writer.py
+# Group-commit writer for call history and audit records.
+#
+# Ending a call used to SELECT the CallHistory row, copy the final state in,
+# append the audit note ("Looked up PNR status", "Call ended by user", ...)
+# and COMMIT, all while the caller waited. Now end_call_logic only queues a
+# record; this background task writes whatever has queued up in ONE
+# transaction, once HISTORY_BATCH_SIZE records are waiting or
+# HISTORY_FLUSH_MS has passed since the first one.
+#
+#   backpressure : the queue holds HISTORY_QUEUE_SIZE records; when it is
+#                  full, submit() waits instead of growing memory forever
+#   shutdown     : stop() writes everything still queued before returning
+#   failures     : a lost connection retries the batch every retry_delay;
+#                  any other error splits it, and a record that still fails
+#                  on its own is logged and dropped (one bad row must not
+#                  hold up every other call's end)
+
+import asyncio
+from datetime import datetime
+from typing import List, Optional, Set
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+import stats
+from call_events import write_events
+from call_state import CallState
+from database import CallHistory
+from ivr_logging import get_logger
+
+log = get_logger("db")
+
+_call_table = CallHistory.__table__
+
+# Final state + end_time. Only matches a call that hasn't ended, so a
+# duplicate end (frontend and backend both hanging up) changes nothing.
+END_STATEMENT = (
+    update(_call_table)
+    .where(_call_table.c.id == bindparam("_id"))
+    .where(_call_table.c.end_time.is_(None))
+    .values(end_time=bindparam("_end_time"), **{name: bindparam(name) for name in CallState.FLUSH_FIELDS})
+)
+
+
+class CallEndRecord:
+    """Everything written when one call ends."""
+
+    __slots__ = ("call_pk", "params", "events")
+
+    def __init__(self, call: CallState, end_time: datetime, events: List[dict]):
+        self.call_pk = call.id
+        self.params = dict(call.flush_params(), _end_time=end_time)
+        self.events = events
+
+
+class HistoryWriter:
+    """Background task draining an asyncio queue of CallEndRecords in batched transactions."""
+
+    def __init__(self, session_factory, batch_size: int = 500, flush_interval: float = 0.05,
+                 max_queue: int = 10000, retry_delay: float = 1.0):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.retry_delay = retry_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending_ends: Set[int] = set() # <--- Queued or being written, not committed yet
+
+    # ---------- Producer side ----------
+    def is_ending(self, call_pk: int) -> bool:
+        """True if this call's end is queued but not committed yet."""
+        return call_pk in self._pending_ends
+
+    def pending_call_pks(self) -> List[int]:
+        return list(self._pending_ends)
+
+    async def submit(self, record: CallEndRecord) -> None:
+        """Queues a record. Waits while the queue is full (backpressure)."""
+        self._pending_ends.add(record.call_pk)
+        if self._queue is None:
+            # Not running (e.g. a script using the handlers directly): write through
+            await self._write_with_retry([record])
+            return
+        await self._queue.put(record)
+
+    async def drain(self) -> None:
+        """Returns once every record submitted so far is committed."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    # ---------- Consumer side ----------
+    async def _next_batch(self) -> List[CallEndRecord]:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _end_calls(self, db, batch: List[CallEndRecord]) -> int:
+        """Runs END_STATEMENT for the batch; returns how many calls it actually ended."""
+        params = [record.params for record in batch]
+        if db.bind.dialect.supports_sane_multi_rowcount:
+            return (await db.execute(END_STATEMENT, params)).rowcount
+        # No executemany rowcount (asyncpg): lock the calls still open, then end them
+        still_open = (await db.execute(
+            select(_call_table.c.id)
+            .where(_call_table.c.id.in_({record.call_pk for record in batch}), _call_table.c.end_time.is_(None))
+            .with_for_update()
+        )).scalars().all()
+        await db.execute(END_STATEMENT, params)
+        return len(still_open)
+
+    async def _write(self, batch: List[CallEndRecord]) -> None:
+        async with self.session_factory() as db:
+            ended = await self._end_calls(db, batch)
+            await write_events(db, [event for record in batch for event in record.events])
+            await stats.bump(db, "calls_ended", ended) # <--- Duplicate ends don't count twice
+            await db.commit() # <--- One commit for the whole batch
+
+    async def _write_with_retry(self, batch: List[CallEndRecord]) -> None:
+        try:
+            while True:
+                try:
+                    await self._write(batch)
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except (OperationalError, InterfaceError) as e:
+                    # Database unreachable: keep the records; the queue filling up slows callers down meanwhile
+                    log.warning("history_write_failed", extra={"records": len(batch), "retry_in_s": self.retry_delay, "error": str(e)})
+                    await asyncio.sleep(self.retry_delay)
+                except Exception as e:
+                    if len(batch) == 1:
+                        log.error("history_record_dropped", extra={"call_pk": batch[0].call_pk, "error": str(e)})
+                        return
+                    # Something in the batch is bad: find it by writing the records one at a time
+                    log.warning("history_batch_failed", extra={"records": len(batch), "error": str(e)})
+                    for record in batch:
+                        await self._write_with_retry([record])
+                    return
+        finally:
+            for record in batch:
+                self._pending_ends.discard(record.call_pk)
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._write_with_retry(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 30.0):
+        """Writes everything still queued (waiting up to `timeout`), then stops the task."""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            log.error("history_drain_timeout", extra={"records_lost": self._queue.qsize()})
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._queue = None
@@ -0,0 +1,122 @@
+# id_allocator.py
+# Call IDs and PNRs without a database round trip per ID.
+#
+#   call IDs : CALL_<13-digit ms timestamp><4-hex worker shard><4-hex sequence>
+#              Time-ordered, and unique because every worker process takes
+#              its own shard from the id_blocks table once, at startup.
+#   PNRs     : 6-digit keys handed out from blocks of PNR_BLOCK_SIZE. One
+#              UPDATE reserves a block for this worker and one SELECT drops
+#              the keys in it that older bookings already use.
+#
+# The PNR sequence is scrambled over 100000-999999 so consecutive bookings
+# don't get consecutive PNRs. It is a permutation, not a secret.
+
+import asyncio
+import os
+import time
+from typing import List, Optional
+
+from sqlalchemy import select, update, insert
+from sqlalchemy.exc import IntegrityError
+
+from database import Booking, IdBlock
+
+PNR_MIN = 100000
+PNR_SPACE = 900000         # 100000..999999
+PNR_MULTIPLIER = 387433    # coprime with PNR_SPACE, so the mapping is a permutation
+PNR_OFFSET = 141421
+
+SHARD_BITS = 16
+SEQUENCE_BITS = 16
+
+
+class IdSpaceExhausted(RuntimeError):
+    """Every 6-digit PNR has been handed out."""
+
+
+def pnr_for_index(index: int) -> str:
+    """The index-th PNR of the scrambled sequence."""
+    return str(PNR_MIN + (index * PNR_MULTIPLIER + PNR_OFFSET) % PNR_SPACE)
+
+
+class IdAllocator:
+    """Per-process allocator. One instance per worker; safe for concurrent coroutines."""
+
+    def __init__(self, session_factory, pnr_block_size: int = 1000):
+        self.session_factory = session_factory
+        self.pnr_block_size = pnr_block_size
+        self.shard: Optional[int] = None
+        self._last_ms = 0
+        self._sequence = 0
+        self._pnrs: List[str] = []
+        self._lock = asyncio.Lock()
+
+    async def _reserve(self, name: str, size: int) -> int:
+        """Takes `size` values of a sequence for this process. Returns the first one."""
+        table = IdBlock.__table__
+        while True:
+            async with self.session_factory() as db:
+                result = await db.execute(
+                    update(table)
+                    .where(table.c.name == name)
+                    .values(next_value=table.c.next_value + size)
+                    .returning(table.c.next_value)
+                )
+                end = result.scalar()
+                if end is None:
+                    # First use of this sequence; another worker may race us to it
+                    try:
+                        await db.execute(insert(table).values(name=name, next_value=size))
+                        await db.commit()
+                    except IntegrityError:
+                        await db.rollback()
+                        continue
+                    return 0
+                await db.commit()
+                return end - size
+
+    async def start(self):
+        """Takes this worker's shard. Called once from the app lifespan."""
+        if self.shard is None:
+            self.shard = await self._reserve("call_shard", 1) % (1 << SHARD_BITS)
+
+    # ---------- Call IDs ----------
+    async def next_call_id(self) -> str:
+        if self.shard is None:
+            async with self._lock:
+                await self.start()
+
+        now_ms = max(int(time.time() * 1000), self._last_ms) # <--- Never step back if the clock does
+        if now_ms == self._last_ms:
+            self._sequence += 1
+            if self._sequence >= 1 << SEQUENCE_BITS:
+                # 65536 IDs in one millisecond: borrow the next millisecond
+                now_ms += 1
+                self._sequence = 0
+        else:
+            self._sequence = 0
+        self._last_ms = now_ms
+        return f"CALL_{now_ms:013d}{self.shard:04x}{self._sequence:04x}"
+
+    # ---------- PNRs ----------
+    async def _refill_pnrs(self):
+        start = await self._reserve("pnr", self.pnr_block_size)
+        if start >= PNR_SPACE:
+            raise IdSpaceExhausted("No 6-digit PNRs left to allocate")
+        candidates = [pnr_for_index(i) for i in range(start, min(start + self.pnr_block_size, PNR_SPACE))]
+
+        # Bookings made before the allocator existed used random keys
+        async with self.session_factory() as db:
+            taken = set((await db.execute(select(Booking.pnr_key).where(Booking.pnr_key.in_(candidates)))).scalars())
+        # Reversed so pop() hands them out in sequence order
+        self._pnrs = [key for key in reversed(candidates) if key not in taken]
+
+    async def next_pnr(self) -> str:
+        async with self._lock:
+            while not self._pnrs:
+                await self._refill_pnrs()
+            return self._pnrs.pop()
+
+
+def create_id_allocator(session_factory) -> IdAllocator:
+    return IdAllocator(session_factory, pnr_block_size=int(os.environ.get("PNR_BLOCK_SIZE", "1000")))
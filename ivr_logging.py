@@ -0,0 +1,176 @@
+# ivr_logging.py
+# Structured, non-blocking logging for the IVR backend.
+#
+# Request handlers only build a LogRecord and drop it on an in-memory queue
+# (QueueHandler); a background thread (QueueListener) formats it and writes
+# the line. One logger per subsystem so each can be turned up or down alone:
+#
+#   ivr.app  ivr.call  ivr.dtmf  ivr.nlu  ivr.db  ivr.booking
+#
+# Environment:
+#   LOG_LEVEL         default level for every subsystem          (INFO)
+#   LOG_LEVELS        per-subsystem overrides, "nlu=DEBUG,db=WARNING"
+#   LOG_FORMAT        json | text                                 (json)
+#   LOG_DEBUG_SAMPLE  share of calls whose DEBUG events are kept  (1.0)
+#
+# Log with an event name and fields, never a pre-formatted f-string:
+#   log.debug("dtmf_input", extra={"call_id": call_id, "menu": menu, "digit": digit})
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+ROOT_LOGGER = "ivr"
+SUBSYSTEMS = ("app", "call", "dtmf", "nlu", "db", "booking")
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+
+# ==================== FORMATTERS ====================
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS and k != "call_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, subsystem, call_id, event, then the extra fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "subsystem": record.name.rsplit(".", 1)[-1],
+            "call_id": getattr(record, "call_id", None),
+            "event": record.getMessage(),
+        }
+        entry.update(_extra_fields(record))
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Readable single line for local development."""
+
+    def format(self, record):
+        fields = " ".join(f"{k}={v}" for k, v in _extra_fields(record).items())
+        call_id = getattr(record, "call_id", None) or "-"
+        line = f"{record.levelname:<7} {record.name.rsplit('.', 1)[-1]:<7} {call_id:<26} {record.getMessage()} {fields}".rstrip()
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+# ==================== SAMPLING ====================
+class DebugSampler(logging.Filter):
+    """
+    Keeps DEBUG records for a `rate` share of calls. The decision is made per
+    call_id, so a sampled call keeps its whole trace; INFO and above always pass.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self._threshold = int(rate * 0xFFFFFFFF)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        call_id = getattr(record, "call_id", None)
+        if call_id is None:
+            return random.random() < self.rate
+        return zlib.crc32(call_id.encode()) <= self._threshold
+
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    """Queues the record as-is (message merged, traceback rendered), leaving formatting to the listener thread."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Writes to whatever sys.stdout is at emit time (survives stdout being swapped)."""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+# ==================== SETUP ====================
+def parse_levels(spec: str) -> Dict[str, int]:
+    """"nlu=DEBUG,db=WARNING" -> {"nlu": 10, "db": 30}"""
+    levels = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        subsystem, _, level = part.partition("=")
+        if subsystem not in SUBSYSTEMS:
+            raise ValueError(f"Unknown log subsystem '{subsystem}' (expected one of {', '.join(SUBSYSTEMS)})")
+        levels[subsystem] = logging.getLevelName(level.strip().upper())
+        if not isinstance(levels[subsystem], int):
+            raise ValueError(f"Unknown log level '{level}' for '{subsystem}'")
+    return levels
+
+
+def setup_logging(level: Optional[str] = None, levels: Optional[str] = None,
+                  fmt: Optional[str] = None, debug_sample: Optional[float] = None) -> None:
+    """Configures the ivr.* loggers and starts the writer thread. Safe to call again."""
+    global _listener
+    level = (level or os.environ.get("LOG_LEVEL", "INFO")).upper()
+    overrides = parse_levels(levels if levels is not None else os.environ.get("LOG_LEVELS", ""))
+    fmt = (fmt or os.environ.get("LOG_FORMAT", "json")).lower()
+    rate = debug_sample if debug_sample is not None else float(os.environ.get("LOG_DEBUG_SAMPLE", "1.0"))
+
+    if _listener is not None:
+        _listener.stop()
+
+    output = _StdoutHandler()
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, output)
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers[:] = [_RecordQueueHandler(log_queue)]
+    root.filters[:] = []
+    root.propagate = False
+    root.setLevel(level)
+    for subsystem in SUBSYSTEMS:
+        logger = get_logger(subsystem)
+        logger.setLevel(overrides.get(subsystem, logging.NOTSET))
+        logger.filters[:] = [DebugSampler(rate)] if rate < 1.0 else []
+
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """Writes out whatever is still queued."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -1,32 +1,64 @@
 # ivr_simulator_backend.py
 # FINAL VERSION (v4.1): Lifespan Fix (Replaces on_startup)
 
+import asyncio
 import os
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError
+from typing import Any, Dict, Optional, List
+from contextvars import ContextVar
 from datetime import datetime
+import json
 import random
 import re
+import time
 
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+import nlu
+import fast_json
+from fast_json import TransitionBodies, serve_prepared
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import insert, select, text, update
 from contextlib import contextmanager, asynccontextmanager # <--- IMPORT THIS
 
 # Import our new database models and session helper
-from database import get_db, Booking, FrequentFlyer, CallHistory, SessionLocal, engine, Base
+from database import get_async_db, Flight, Booking, FrequentFlyer, migrate_flights_from_bookings, backfill_flight_codes, add_call_activity_column, create_missing_indexes, init_stat_counters, CallHistory, SessionLocal, AsyncSessionLocal, engine, async_engine, Base
+from call_state import CallState, CallStateFlusher, create_call_state_store
+from menu_graph import ActionRegistry, compile_menu_graph
+import stats
+import metrics
+import call_events
+from history_writer import CallEndRecord, HistoryWriter
+from call_reaper import IdleCallReaper
+from call_archive import CallArchiver, read_call_history
+from id_allocator import create_id_allocator
+from lookup_cache import create_lookup_cache
+from admission import AdmissionMiddleware, Rejected, create_admission_controller
+import profiling
+from profiling import ProfilingMiddleware, create_profiler
+from ivr_logging import get_logger, setup_logging
 
 
 # --- DATABASE MOCK DATA (Unchanged) ---
+MOCK_FLIGHT_DB = {
+    "AI101": {"route": "Mumbai to Delhi", "time": "Today 6:00 PM", "status": "Confirmed", "seats_available": 30},
+    "UK822": {"route": "Chennai to Bangalore", "time": "Today 4:30 PM (New 5:15 PM)", "status": "Delayed", "seats_available": 5},
+    "SG445": {"route": "Delhi to Goa", "time": "Tomorrow 9:00 AM", "status": "Cancelled", "seats_available": 0},
+    "6E204": {"route": "Kolkata to Hyderabad", "time": "Today 7:20 PM", "status": "Confirmed", "seats_available": 50},
+    "BA142": {"route": "London to Mumbai", "time": "Tomorrow 11:00 AM", "status": "Confirmed", "seats_available": 12},
+    "EK501": {"route": "Dubai to Chennai", "time": "Today 4:30 PM", "status": "Boarding", "seats_available": 0},
+    "QF068": {"route": "Singapore to Sydney", "time": "Today 8:00 PM", "status": "On Time", "seats_available": 45}
+}
 MOCK_PNR_DB = {
-    "241234": {"pnr_display": "AI1234", "flight": "AI101", "status": "Confirmed", "route": "Mumbai to Delhi", "time": "Today 6:00 PM", "seats_available": 30, "passenger_name": "R. Kumar", "passenger_age": 45, "passenger_gender": "Male"},
-    "855678": {"pnr_display": "UK5678", "flight": "UK822", "status": "Delayed", "route": "Chennai to Bangalore", "time": "Today 4:30 PM (New 5:15 PM)", "seats_available": 5, "passenger_name": "S. Priya", "passenger_age": 28, "passenger_gender": "Female"},
-    "749876": {"pnr_display": "SG9876", "flight": "SG445", "status": "Cancelled", "route": "Delhi to Goa", "time": "Tomorrow 9:00 AM", "seats_available": 0, "passenger_name": "A. Gupta", "passenger_age": 33, "passenger_gender": "Male"},
-    "631111": {"pnr_display": "6E1111", "flight": "6E204", "status": "Confirmed", "route": "Kolkata to Hyderabad", "time": "Today 7:20 PM", "seats_available": 50, "passenger_name": "M. Banerjee", "passenger_age": 52, "passenger_gender": "Female"},
-    "222222": {"pnr_display": "BA2222", "flight": "BA142", "status": "Confirmed", "route": "London to Mumbai", "time": "Tomorrow 11:00 AM", "seats_available": 12, "passenger_name": "John Smith", "passenger_age": 41, "passenger_gender": "Male"},
-    "353333": {"pnr_display": "EK3333", "flight": "EK501", "status": "Boarding", "route": "Dubai to Chennai", "time": "Today 4:30 PM", "seats_available": 0, "passenger_name": "F. Al-Jaber", "passenger_age": 29, "passenger_gender": "Female"},
-    "734444": {"pnr_display": "QF4444", "flight": "QF068", "status": "On Time", "route": "Singapore to Sydney", "time": "Today 8:00 PM", "seats_available": 45, "passenger_name": "L. Chen", "passenger_age": 60, "passenger_gender": "Male"}
+    "241234": {"pnr_display": "AI1234", "flight": "AI101", "status": "Confirmed", "passenger_name": "R. Kumar", "passenger_age": 45, "passenger_gender": "Male"},
+    "855678": {"pnr_display": "UK5678", "flight": "UK822", "status": "Delayed", "passenger_name": "S. Priya", "passenger_age": 28, "passenger_gender": "Female"},
+    "749876": {"pnr_display": "SG9876", "flight": "SG445", "status": "Cancelled", "passenger_name": "A. Gupta", "passenger_age": 33, "passenger_gender": "Male"},
+    "631111": {"pnr_display": "6E1111", "flight": "6E204", "status": "Confirmed", "passenger_name": "M. Banerjee", "passenger_age": 52, "passenger_gender": "Female"},
+    "222222": {"pnr_display": "BA2222", "flight": "BA142", "status": "Confirmed", "passenger_name": "John Smith", "passenger_age": 41, "passenger_gender": "Male"},
+    "353333": {"pnr_display": "EK3333", "flight": "EK501", "status": "Boarding", "passenger_name": "F. Al-Jaber", "passenger_age": 29, "passenger_gender": "Female"},
+    "734444": {"pnr_display": "QF4444", "flight": "QF068", "status": "On Time", "passenger_name": "L. Chen", "passenger_age": 60, "passenger_gender": "Male"}
 }
 MOCK_FF_DB = {
     "111222333": {"pin": "1234", "points": 12500, "name": "Saranya"},
@@ -39,13 +71,30 @@ MOCK_FF_DB = {
 # --- DATABASE SETUP (Unchanged) ---
 def setup_database():
     Base.metadata.create_all(bind=engine)
+    migrated = migrate_flights_from_bookings(engine)
+    if migrated:
+        print(f"Migrated {migrated} flights from legacy booking columns.")
+    activity_backfilled = add_call_activity_column(engine)
+    if activity_backfilled:
+        print(f"Backfilled last_activity on {activity_backfilled} calls.")
+    create_missing_indexes(engine, CallHistory) # <--- ix_call_history_ended on existing DBs
+    backfilled = backfill_flight_codes(engine)
+    if backfilled:
+        print(f"Backfilled flight_code on {backfilled} flights.")
+    # Seed rows go in as one Core INSERT per table; bulk_load.py streams large datasets the same way
     db = SessionLocal()
     try:
+        if db.query(Flight).count() == 0:
+            print("Populating Flights table...")
+            db.execute(insert(Flight), [{"flight": key, **data} for key, data in MOCK_FLIGHT_DB.items()])
+            db.commit()
+            print("Flights populated.")
+        else:
+            print("Flights table already has data.")
+
         if db.query(Booking).count() == 0:
             print("Populating Bookings (PNR) table...")
-            for key, data in MOCK_PNR_DB.items():
-                db_booking = Booking(pnr_key=key, **data)
-                db.add(db_booking)
+            db.execute(insert(Booking), [{"pnr_key": key, **data} for key, data in MOCK_PNR_DB.items()])
             db.commit()
             print("Bookings populated.")
         else:
@@ -53,9 +102,7 @@ def setup_database():
 
         if db.query(FrequentFlyer).count() == 0:
             print("Populating FrequentFlyer table...")
-            for key, data in MOCK_FF_DB.items():
-                db_ff = FrequentFlyer(ff_number=key, **data)
-                db.add(db_ff)
+            db.execute(insert(FrequentFlyer), [{"ff_number": key, **data} for key, data in MOCK_FF_DB.items()])
             db.commit()
             print("FrequentFlyer populated.")
         else:
@@ -67,6 +114,92 @@ def setup_database():
     finally:
         db.close()
 
+    created = init_stat_counters(engine) # <--- After seeding, so the baselines include it
+    if created:
+        print(f"Initialized {created} stat counters.")
+
+# --- LOGGING ---
+# Handlers only queue a record; a background thread formats and writes it.
+# LOG_LEVEL / LOG_LEVELS / LOG_FORMAT / LOG_DEBUG_SAMPLE (see ivr_logging.py)
+setup_logging()
+app_log = get_logger("app")
+call_log = get_logger("call")
+dtmf_log = get_logger("dtmf")
+nlu_log = get_logger("nlu")
+db_log = get_logger("db")
+booking_log = get_logger("booking")
+
+# --- LIVE CALL STATE ---
+# Keypresses only touch the store; CallHistory is updated in the background
+# every CALL_STATE_FLUSH_SECONDS and once more when the call ends.
+call_store = create_call_state_store()
+
+# --- CALL HISTORY EVENTS ---
+# Menu changes / keys / end notes, inserted in bulk into call_events
+menu_ids = call_events.MenuIds()
+event_buffer = call_events.EventBuffer(menu_ids)
+
+call_state_flusher = CallStateFlusher(
+    call_store,
+    AsyncSessionLocal,
+    interval=float(os.environ.get("CALL_STATE_FLUSH_SECONDS", "2.0")),
+    event_buffer=event_buffer,
+)
+
+# --- CALL HISTORY WRITER ---
+# Call ends + audit notes, committed in batches off the request path
+history_writer = HistoryWriter(
+    AsyncSessionLocal,
+    batch_size=int(os.environ.get("HISTORY_BATCH_SIZE", "500")),
+    flush_interval=float(os.environ.get("HISTORY_FLUSH_MS", "50")) / 1000,
+    max_queue=int(os.environ.get("HISTORY_QUEUE_SIZE", "10000")),
+)
+
+# --- IDLE CALL REAPER ---
+# Ends calls abandoned without /ivr/end (no input for CALL_IDLE_TIMEOUT_SECONDS)
+call_reaper = IdleCallReaper(
+    AsyncSessionLocal,
+    call_store,
+    call_state_flusher,
+    event_buffer,
+    history_writer,
+    timeout=float(os.environ.get("CALL_IDLE_TIMEOUT_SECONDS", "900")),
+    interval=float(os.environ.get("CALL_REAPER_INTERVAL_SECONDS", "60")),
+)
+
+# --- CALL ARCHIVE ---
+# Moves ended calls older than ARCHIVE_AFTER_DAYS out of call_history, in batches
+call_archiver = CallArchiver(
+    AsyncSessionLocal,
+    archive_after_days=float(os.environ.get("ARCHIVE_AFTER_DAYS", "30")),
+    retention_days=float(os.environ.get("ARCHIVE_RETENTION_DAYS", "365")),
+    batch_size=int(os.environ.get("ARCHIVE_BATCH_SIZE", "1000")),
+    interval=float(os.environ.get("ARCHIVE_INTERVAL_SECONDS", "3600")),
+)
+
+# --- ID ALLOCATION ---
+# Call IDs and PNRs come from memory; the DB is only hit once per worker
+# (its shard) and once per block of PNR_BLOCK_SIZE PNRs
+id_allocator = create_id_allocator(AsyncSessionLocal)
+
+# --- STATS ---
+# Counters for /, /stats; re-read from stat_counters at most once per TTL
+stats_cache = stats.StatsCache(ttl=float(os.environ.get("STATS_CACHE_SECONDS", "5.0")))
+
+# --- LOOKUP CACHE ---
+# PNR / flight / frequent-flyer reads, LRU + TTL, invalidated by the writers
+lookup_cache = create_lookup_cache()
+
+# --- ADMISSION CONTROL ---
+# Caps live calls / in-flight requests per worker (new calls are shed first)
+# and rate-limits call starts per caller number
+admission_controller = create_admission_controller(call_store.count)
+
+# --- REQUEST PROFILING ---
+# Opt-in (PROFILE_ENABLED): cProfile of header-triggered or sampled requests,
+# kept in a ring buffer on disk and served by /admin/profiles
+profiler = create_profiler()
+
 # ==========================================================
 # ##### !!!!! THIS IS THE LIFESPAN FIX !!!!! #####
 # ==========================================================
@@ -76,19 +209,33 @@ def setup_database():
 async def lifespan(app: FastAPI):
     # This is the code that runs ON STARTUP
     if os.environ.get("TESTING") != "true":
-        print("--- Server starting up (Production Mode) ---")
+        app_log.info("server_starting", extra={"mode": "production"})
         
         setup_database() # <--- Your database setup function
-        print("--- Startup complete. Server is ready. ---")
+        app_log.info("startup_complete")
     else:
-        print("--- Server starting up (Testing Mode): Skipping setup_database(). ---")
+        app_log.info("server_starting", extra={"mode": "testing", "setup_database": "skipped"})
+    await id_allocator.start() # <--- Take this worker's call-ID shard
+    await menu_ids.load(AsyncSessionLocal, MENU_STRUCTURE) # <--- Small-int IDs for call_events
+    call_state_flusher.start()
+    history_writer.start()
+    call_reaper.start()
+    call_archiver.start()
+    if os.environ.get("LOOKUP_CACHE_WARM", "true").lower() == "true":
+        await lookup_cache.warm(AsyncSessionLocal) # <--- Every flight, so the first callers don't miss
     
     # ---
     yield # <--- The app runs here
     # ---
     
     # Code below yield runs ON SHUTDOWN (if needed)
-    print("--- Server shutting down. ---")
+    await call_archiver.stop()
+    await call_reaper.stop()
+    await call_state_flusher.stop() # <--- Write back any unflushed call state
+    await history_writer.stop() # <--- Drain queued call ends before the pool closes
+    await async_engine.dispose() # <--- Close pooled async connections
+    admission_controller.close()
+    app_log.info("server_stopped")
 
 
 # 2. Pass the lifespan function to the FastAPI app
@@ -105,6 +252,12 @@ app = FastAPI(
 # ==========================================================
 
 
+# Innermost, so a profile covers the handler itself
+app.add_middleware(ProfilingMiddleware, profiler=lambda: profiler)
+
+# Inside CORS and metrics, so 503 / 429 rejections still get CORS headers and metrics
+app.add_middleware(AdmissionMiddleware, controller=lambda: admission_controller)
+
 # Enable CORS
 app.add_middleware(
     CORSMiddleware,
@@ -113,6 +266,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware) # <--- Request latency per endpoint for /metrics
 
 # ==================== DATA MODELS (Unchanged) ====================
 class CallStart(BaseModel):
@@ -124,6 +278,11 @@ class DTMFInput(BaseModel):
     digit: str
     current_menu: str
 
+class DTMFEntryInput(BaseModel):
+    call_id: str
+    digits: str # <--- A whole keypad entry, e.g. "241234#"
+    current_menu: str
+
 class VoiceInput(BaseModel):
     call_id: str
     text: str
@@ -132,6 +291,71 @@ class VoiceInput(BaseModel):
 class CallEndRequest(BaseModel):
     call_id: str
 
+# ==================== RESPONSE MODELS ====================
+# Declared so FastAPI serializes straight to JSON bytes (pydantic-core),
+# without a jsonable_encoder pass. IVR endpoints use exclude_unset, so each
+# response carries exactly the keys its handler set.
+class PnrInfo(BaseModel):
+    pnr_display: Optional[str] = None
+    flight: Optional[str] = None
+    status: Optional[str] = None
+    route: Optional[str] = None
+    time: Optional[str] = None
+    seats_available: Optional[int] = None
+
+class IvrResponse(BaseModel):
+    model_config = ConfigDict(extra="allow") # <--- Never drop a key a handler added
+    status: Optional[str] = None
+    message: Optional[str] = None
+    prompt: Optional[str] = None
+    current_menu: Optional[str] = None
+    call_action: Optional[str] = None
+    collected: Optional[str] = None
+    valid_options: Optional[List[str]] = None
+    prompt_original: Optional[str] = None
+    pnr_info: Optional[PnrInfo] = None
+    error: Optional[str] = None
+
+class CallStartResponse(BaseModel):
+    call_id: str
+    status: str
+    prompt: str
+
+class CallEndResponse(BaseModel):
+    status: str
+    call_id: Optional[str] = None
+    message: Optional[str] = None
+
+class ServiceStatus(BaseModel):
+    status: str
+    database_status: Optional[str] = None
+    live_active_calls_in_db: Optional[int] = None
+    total_completed_calls_in_db: Optional[int] = None
+    total_bookings_in_db: Optional[int] = None
+    total_ff_accounts_in_db: Optional[int] = None
+
+class StatsResponse(BaseModel):
+    calls_started: int
+    calls_ended: int
+    bookings: int
+    cancellations: int
+    ff_accounts: int
+    active_calls: int
+    refreshed_at: str
+    cache_ttl_seconds: float
+
+class CallHistoryResponse(BaseModel):
+    call_id: str
+    caller_number: Optional[str] = None
+    start_time: Optional[datetime] = None
+    end_time: Optional[datetime] = None
+    state: Dict[str, Any]
+    menu_path: List[str]
+    inputs: List[Optional[str]]
+    archived: bool
+
+IVR_RESPONSE = {"response_model": IvrResponse, "response_model_exclude_unset": True}
+
 # ==================== MENU_STRUCTURE (Unchanged) ====================
 MENU_STRUCTURE = {
     "main": {
@@ -147,257 +371,840 @@ MENU_STRUCTURE = {
                   "Press 9 for All Other Inquiries. "
                   "Press 0 to speak with an agent.",
         "options": {
-            "1": {"action": "goto_menu", "target": "flight_status_pnr", "message": "You selected Flight Status."},
-            "2": {"action": "goto_menu", "target": "manage_booking_pnr", "message": "You selected Manage Booking."},
-            "3": {"action": "goto_menu", "target": "baggage", "message": "You selected Baggage Services."},
-            "4": {"action": "goto_menu", "target": "check_in_options", "message": "You selected Check-in and Boarding Pass."},
-            "5": {"action": "goto_menu", "target": "booking_ask_flight", "message": "You selected Book New Flight."},
-            "6": {"action": "goto_menu", "target": "frequent_flyer_number", "message": "You selected Frequent Flyer Program."},
-            "7": {"action": "goto_menu", "target": "special_assistance", "message": "You selected Special Assistance."},
-            "8": {"action": "goto_menu", "target": "refunds", "message": "You selected Refunds and Receipts."},
-            "9": {"action": "goto_menu", "target": "other_inquiries", "message": "You selected Other Inquiries."},
-            "0": {"action": "transfer_agent", "message": "You will be directing to our airline agent please wait"}
+            "1": {"action": "goto_menu", "target": "flight_status_pnr", "message": "You selected Flight Status.", "keywords": ["status"]},
+            "2": {"action": "goto_menu", "target": "manage_booking_pnr", "message": "You selected Manage Booking.", "keywords": ["manage", "cancel", "change"]},
+            "3": {"action": "goto_menu", "target": "baggage", "message": "You selected Baggage Services.", "keywords": ["baggage", "bag", "bags", "luggage"]},
+            "4": {"action": "goto_menu", "target": "check_in_options", "message": "You selected Check-in and Boarding Pass.", "keywords": ["check in", "checkin", "boarding pass"]},
+            "5": {"action": "goto_menu", "target": "booking_ask_flight", "message": "You selected Book New Flight.", "keywords": ["booking", "book"]},
+            "6": {"action": "goto_menu", "target": "frequent_flyer_number", "message": "You selected Frequent Flyer Program.", "keywords": ["frequent", "flyer", "points"]},
+            "7": {"action": "goto_menu", "target": "special_assistance", "message": "You selected Special Assistance.", "keywords": ["special", "wheelchair", "assistance"]},
+            "8": {"action": "goto_menu", "target": "refunds", "message": "You selected Refunds and Receipts.", "keywords": ["refund", "refunds", "receipt", "receipts"]},
+            "9": {"action": "goto_menu", "target": "other_inquiries", "message": "You selected Other Inquiries.", "keywords": ["other", "pet", "pets"]},
+            "0": {"action": "transfer_agent", "message": "You will be directing to our airline agent please wait", "keywords": ["agent", "speak"], "global": True}
         }
     },
     "flight_status_pnr": { 
         "prompt": "Please say your 6-digit PNR number, or enter it on the keypad followed by hash. Press star to go back.",
         "options": {
             "#": {"action": "lookup_pnr_status", "message": "Looking up your PNR..."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "manage_booking_pnr": {
        "prompt": "To manage your booking, please say your 6-digit PNR number, or enter it on the keypad followed by hash. Press star to go back.",
         "options": {
             "#": {"action": "lookup_pnr_manage", "message": "Finding your booking..."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "manage_booking_options": {
         "prompt": "PNR found. Say 'Change Flight' or 'Cancel Flight'. Or, Press 1 to Change your flight. Press 2 to Cancel your flight. Press star to go back.",
         "options": {
-            "1": {"action": "end_call", "message": "To change your flight, a link has been sent via SMS. This call will now end."},
-            "2": {"action": "cancel_flight", "message": "Attempting to cancel your flight..."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "1": {"action": "end_call", "message": "To change your flight, a link has been sent via SMS. This call will now end.", "keywords": ["change"]},
+            "2": {"action": "cancel_flight", "message": "Attempting to cancel your flight...", "keywords": ["cancel"]},
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "baggage": {
         "prompt": "For Baggage Services: Say 'Lost Baggage' or 'Baggage Allowance'. Or, Press 1 for Lost or Delayed Baggage. Press 2 for Baggage Allowance. Press star to go back.",
         "options": {
-            "1": {"action": "transfer_agent", "message": "Transferring to a baggage specialist."},
-            "2": {"action": "end_call", "message": "For domestic flights, your cabin allowance is 7kg and check-in allowance is 15kg. For international, check-in is 25kg. This call will now end."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "1": {"action": "transfer_agent", "message": "Transferring to a baggage specialist.", "keywords": ["lost", "delayed"]},
+            "2": {"action": "end_call", "message": "For domestic flights, your cabin allowance is 7kg and check-in allowance is 15kg. For international, check-in is 25kg. This call will now end.", "keywords": ["allowance"]},
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "check_in_options": {
         "prompt": "For Check-in: Say 'Check in' or 'Get Boarding Pass'. Or, Press 1 to check in for your flight. Press 2 to get your boarding pass. Press star to go back.",
         "options": {
-            "1": {"action": "goto_menu", "target": "check_in_pnr_for_checkin", "message": "Okay, let's check you in."},
-            "2": {"action": "goto_menu", "target": "check_in_pnr_for_boardingpass", "message": "Okay, let's get your boarding pass."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "1": {"action": "goto_menu", "target": "check_in_pnr_for_checkin", "message": "Okay, let's check you in.", "keywords": ["check in", "checkin"]},
+            "2": {"action": "goto_menu", "target": "check_in_pnr_for_boardingpass", "message": "Okay, let's get your boarding pass.", "keywords": ["boarding pass"]},
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "check_in_pnr_for_checkin": {
         "prompt": "To check in, please say your 6-digit PNR number, or enter it followed by hash. Press star to go back.",
         "options": {
             "#": {"action": "lookup_pnr_checkin", "message": "Finding your booking for check-in..."},
-            "*": {"action": "goto_menu", "target": "check_in_options", "message": "Going back."}
+            "*": {"action": "goto_menu", "target": "check_in_options", "message": "Going back.", "keywords": ["back", "main menu"]}
         }
     },
      "check_in_pnr_for_boardingpass": {
         "prompt": "To get your boarding pass, please say your 6-digit PNR number, or enter it followed by hash. Press star to go back.",
         "options": {
             "#": {"action": "lookup_pnr_boardingpass", "message": "Finding your booking for boarding pass..."},
-            "*": {"action": "goto_menu", "target": "check_in_options", "message": "Going back."}
+            "*": {"action": "goto_menu", "target": "check_in_options", "message": "Going back.", "keywords": ["back", "main menu"]}
         }
     },
     "booking_ask_flight": { 
         "prompt": "Please say the flight number you wish to book, like 'one zero one' for AI101, or enter the digits followed by hash. Press star to go back.",
         "options": {
             "#": {"action": "lookup_flight_for_booking", "message": "Checking seat availability for this flight..."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "booking_ask_name": {
         "prompt": "Please say the passenger's full name now. Say 'go back' or press star to cancel.",
         "options": {
-             "*": {"action": "goto_menu", "target": "main", "message": "Booking cancelled. Going back to main menu."}
+             "*": {"action": "goto_menu", "target": "main", "message": "Booking cancelled. Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "booking_ask_age": {
         "prompt": "Please say the passenger's age, or enter it on the keypad followed by hash. Press star to go back.",
         "options": {
             "#": {"action": "set_age_and_ask_gender", "message": "Age recorded."},
-             "*": {"action": "goto_menu", "target": "main", "message": "Booking cancelled. Going back to main menu."}
+             "*": {"action": "goto_menu", "target": "main", "message": "Booking cancelled. Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "booking_ask_gender": {
         "prompt": "Please say 'Male', 'Female', or 'Other'. Or, press 1 for Male, 2 for Female, 3 for Other. Press star to go back.",
         "options": {
-             "1": {"action": "set_gender_and_confirm", "gender": "Male", "message": "Gender set as Male."},
-             "2": {"action": "set_gender_and_confirm", "gender": "Female", "message": "Gender set as Female."},
-             "3": {"action": "set_gender_and_confirm", "gender": "Other", "message": "Gender set as Other."},
-             "*": {"action": "goto_menu", "target": "booking_ask_age", "message": "Going back to age."}
+             "1": {"action": "set_gender_and_confirm", "gender": "Male", "message": "Gender set as Male.", "keywords": ["male", "man"]},
+             "2": {"action": "set_gender_and_confirm", "gender": "Female", "message": "Gender set as Female.", "keywords": ["female", "woman"]},
+             "3": {"action": "set_gender_and_confirm", "gender": "Other", "message": "Gender set as Other.", "keywords": ["other"]},
+             "*": {"action": "goto_menu", "target": "booking_ask_age", "message": "Going back to age.", "keywords": ["back", "main menu"]}
         }
     },
     "booking_confirm_details": {
         "prompt": "You are about to book. Press 1 to confirm, star to cancel.",
          "options": {
-            "1": {"action": "confirm_booking", "message": "Booking your seat..."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Booking cancelled. Going back to main menu."}
+            "1": {"action": "confirm_booking", "message": "Booking your seat...", "keywords": ["confirm", "yes"]},
+            "*": {"action": "goto_menu", "target": "main", "message": "Booking cancelled. Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "frequent_flyer_number": {
         "prompt": "Please say or enter your 9-digit Flying Returns number followed by hash. Press star to go back.",
         "options": {
             "#": {"action": "lookup_ff_number", "message": "Looking up your account..."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "frequent_flyer_pin": {
         "prompt": "For security, please say or enter your 4-digit PIN followed by hash. Press star to go back.",
         "options": {
             "#": {"action": "verify_ff_pin", "message": "Verifying your PIN..."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "frequent_flyer_options": {
         "prompt": "Account verified. Say 'Check Points' or 'Redeem Points'. Or, Press 1 to check your points balance. Press 2 to redeem points. Press star to go back.",
         "options": {
-            "1": {"action": "check_ff_points", "message": "Checking your points balance..."},
-            "2": {"action": "end_call", "message": "To redeem points for flights or upgrades, please log in to your account on our website. This call will now end."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "1": {"action": "check_ff_points", "message": "Checking your points balance...", "keywords": ["check", "points", "balance"]},
+            "2": {"action": "end_call", "message": "To redeem points for flights or upgrades, please log in to your account on our website. This call will now end.", "keywords": ["redeem"]},
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "special_assistance": {
         "prompt": "For Special Assistance: Say 'Wheelchair' or 'Other Needs'. Or, Press 1 for Wheelchair Assistance. Press 2 for other needs. Press star to go back.",
         "options": {
-            "1": {"action": "transfer_agent", "message": "Transferring to our special assistance team for wheelchair booking."},
-            "2": {"action": "transfer_agent", "message": "Transferring to our special assistance team."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "1": {"action": "transfer_agent", "message": "Transferring to our special assistance team for wheelchair booking.", "keywords": ["wheelchair"]},
+            "2": {"action": "transfer_agent", "message": "Transferring to our special assistance team.", "keywords": ["other"]},
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "refunds": {
         "prompt": "For Refunds and Receipts: Say 'Refund Status' or 'Get Receipt'. Or, Press 1 for Refund Status. Press 2 to get a copy of your receipt. Press star to go back.",
         "options": {
-            "1": {"action": "goto_menu", "target": "refunds_pnr_for_status", "message": "Okay, let's check your refund status."},
-            "2": {"action": "goto_menu", "target": "refunds_pnr_for_receipt", "message": "Okay, let's get your receipt."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "1": {"action": "goto_menu", "target": "refunds_pnr_for_status", "message": "Okay, let's check your refund status.", "keywords": ["status"]},
+            "2": {"action": "goto_menu", "target": "refunds_pnr_for_receipt", "message": "Okay, let's get your receipt.", "keywords": ["receipt", "receipts", "copy"]},
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     },
     "refunds_pnr_for_status": {
         "prompt": "To check your refund status, please say or enter your 6-digit PNR followed by hash. Press star to go back.",
         "options": {
             "#": {"action": "lookup_pnr_refundstatus", "message": "Finding your refund details..."},
-            "*": {"action": "goto_menu", "target": "refunds", "message": "Going back."}
+            "*": {"action": "goto_menu", "target": "refunds", "message": "Going back.", "keywords": ["back", "main menu"]}
         }
     },
      "refunds_pnr_for_receipt": {
         "prompt": "To get your receipt, please say or enter your 6-digit PNR followed by hash. Press star to go back.",
         "options": {
             "#": {"action": "lookup_pnr_receipt", "message": "Finding your booking details..."},
-            "*": {"action": "goto_menu", "target": "refunds", "message": "Going back."}
+            "*": {"action": "goto_menu", "target": "refunds", "message": "Going back.", "keywords": ["back", "main menu"]}
         }
     },
     "other_inquiries": {
         "prompt": "For Other Inquiries: Say 'Pet Policy' or 'Group Booking'. Or, Press 1 for Pet Travel Policy. Press 2 for Group Bookings. Press star to go back.",
         "options": {
-            "1": {"action": "end_call", "message": "For Pet Travel, small pets in carriers are allowed in the cabin for a fee. Please see our website for size restrictions. This call will now end."},
-            "2": {"action": "transfer_agent", "message": "For group bookings of 9 or more, transferring to a specialist."},
-            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu."}
+            "1": {"action": "end_call", "message": "For Pet Travel, small pets in carriers are allowed in the cabin for a fee. Please see our website for size restrictions. This call will now end.", "keywords": ["pet", "pets"]},
+            "2": {"action": "transfer_agent", "message": "For group bookings of 9 or more, transferring to a specialist.", "keywords": ["group", "groups"]},
+            "*": {"action": "goto_menu", "target": "main", "message": "Going back to main menu.", "keywords": ["back", "main menu"]}
         }
     }
 }
 
+# --- Voice keywords -> (menu, digit), built once from the "keywords" above ---
+INTENT_INDEX = nlu.build_intent_index(MENU_STRUCTURE)
+
+# --- Menus that collect a keypad entry before '#' (length -1 = variable) ---
+INPUT_REQUIRED_MENUS = {
+    "flight_status_pnr": 6,
+    "manage_booking_pnr": 6,
+    "check_in_pnr_for_checkin": 6,
+    "check_in_pnr_for_boardingpass": 6,
+    "frequent_flyer_number": 9,
+    "frequent_flyer_pin": 4,
+    "refunds_pnr_for_status": 6,
+    "refunds_pnr_for_receipt": 6,
+    "booking_ask_flight": -1, # <--- Variable length
+    "booking_ask_age": -1 # <--- Variable length
+}
+
+# Menus where the caller says (or keys) a 6-digit PNR
+PNR_INPUT_MENUS = frozenset(menu for menu, length in INPUT_REQUIRED_MENUS.items() if length == 6)
+SECRET_ENTRY_MENUS = frozenset({"frequent_flyer_pin"}) # <--- Entries never written to call_events
+
+# A whole entry for /ivr/dtmf_entry: digits, optionally submitted with '#'
+DTMF_ENTRY_PATTERN = re.compile(r"(\d*)(#?)")
+MAX_ENTRY_DIGITS = 20 # <--- Longest keypad entry kept in input_buffer (String(100) column)
+
 # ==================== HELPER FUNCTIONS (DATABASE) ====================
 
-# --- NEW: Fetches the call state from DB ---
-def get_active_call(call_id: str, db: Session):
-    """Fetches the active call from the CallHistory table."""
-    call = db.query(CallHistory).filter(CallHistory.call_id == call_id).first()
+# --- Fetches the live call state (store first, DB as fallback) ---
+async def get_active_call(call_id: str, db: AsyncSession) -> CallState:
+    """Fetches the active call from the call-state store, falling back to the CallHistory table."""
+    profiling.tag(call_id=call_id)
+    channel = call_channel.get()
+    if channel is not None and channel.call is not None and channel.call.call_id == call_id:
+        return channel.call # <--- Bound to this WebSocket: no store read
+    call = await call_store.get(call_id)
+    if call:
+        return call
+
+    # Not in the store: server restarted, or another worker owns a memory store
+    result = await db.execute(select(CallHistory).filter(CallHistory.call_id == call_id))
+    row = result.scalars().first()
     
-    if not call:
-        print(f"Error: Call {call_id} not in DB.")
+    if not row:
+        call_log.warning("call_not_found", extra={"call_id": call_id})
         raise HTTPException(status_code=404, detail="Call not found in database")
     
-    if call.end_time:
-        print(f"Error: Call {call_id} has already ended.")
+    if row.end_time or history_writer.is_ending(row.id): # <--- Ended, even if the write is still queued
+        call_log.warning("call_already_ended", extra={"call_id": call_id})
         raise HTTPException(status_code=400, detail="Call has already ended")
         
+    call = CallState.from_row(row, await call_events.next_event_seq(db, row.id))
+    await call_store.put(call)
     return call
 
-# --- UPDATED: No longer uses in-memory dict ---
-def end_call_logic(db: Session, call_id_to_end, status_msg=""):
-    """Fetches the call from the DB and marks it as ended."""
-    call_to_end = db.query(CallHistory).filter(CallHistory.call_id == call_id_to_end).first()
-    
-    if call_to_end and not call_to_end.end_time: # Check it hasn't already been ended
-        call_to_end.end_time = datetime.now()
-        
-        if status_msg:
-            # Handle JSON fields
-            new_inputs = list(call_to_end.inputs)
-            new_inputs.append(status_msg)
-            call_to_end.inputs = new_inputs
-            
-        db.commit() # <--- Save the end_time
-        print(f"✅ Call {call_id_to_end} marked as ended in DB.")
-    elif not call_to_end:
-        print(f"Error: Tried to end call {call_id_to_end} but it was not in DB.")
+# --- Connection-bound calls (/ivr/ws) ---
+# A call driven over a WebSocket keeps its CallState on the connection. It is
+# only written to the store when the menu changes, or every WS_PERSIST_SECONDS
+# so the idle reaper still sees activity. Digits typed in between stay on the connection.
+WS_PERSIST_SECONDS = float(os.environ.get("WS_PERSIST_SECONDS", "60"))
+
+class CallChannel:
+    """The live call of one /ivr/ws connection."""
+
+    __slots__ = ("call", "persisted_menu", "persisted_at")
+
+    def __init__(self):
+        self.call: Optional[CallState] = None
+        self.persisted_menu = None
+        self.persisted_at = 0.0
+
+    def bind(self, call: CallState) -> None:
+        self.call = call
+        self.persisted_menu = call.current_menu
+        self.persisted_at = time.monotonic()
+
+    def should_persist(self, call: CallState) -> bool:
+        now = time.monotonic()
+        if call.current_menu == self.persisted_menu and now - self.persisted_at < WS_PERSIST_SECONDS:
+            return False
+        self.persisted_menu, self.persisted_at = call.current_menu, now
+        return True
+
+call_channel: ContextVar[Optional[CallChannel]] = ContextVar("call_channel", default=None)
+
+# --- Saves the live call state (written to the DB later by the flusher) ---
+async def save_call(call: CallState):
+    call.last_activity = datetime.now() # <--- Keeps the idle reaper away from this call
+    channel = call_channel.get()
+    if channel is not None and channel.call is call and not channel.should_persist(call):
+        return
+    await call_store.put(call)
+
+async def end_call_logic(db: AsyncSession, call_id_to_end, status_msg="", call_state: Optional[CallState] = None):
+    """Queues the final call state, end_time and audit note for the history writer and drops the call from the store."""
+    if call_state is None:
+        call_state = await call_store.get(call_id_to_end)
+    if call_state is None:
+        # Not live here: already ended, or owned by another worker's memory store
+        result = await db.execute(select(CallHistory).filter(CallHistory.call_id == call_id_to_end))
+        call_to_end = result.scalars().first()
+        if not call_to_end:
+            call_log.warning("end_unknown_call", extra={"call_id": call_id_to_end})
+            return
+        if call_to_end.end_time:
+            # This can happen if the frontend and backend both try to end the call
+            call_log.info("end_already_ended", extra={"call_id": call_id_to_end})
+            return
+        call_state = CallState.from_row(call_to_end, await call_events.next_event_seq(db, call_to_end.id))
+
+    if history_writer.is_ending(call_state.id):
+        call_log.info("end_already_ended", extra={"call_id": call_id_to_end})
     else:
-        # This can happen if the frontend and backend both try to end the call
-        print(f"Info: Tried to end call {call_id_to_end} but it was already ended.")
+        if status_msg:
+            event_buffer.note(call_state, status_msg)
+        # The call's buffered events go in with its end_time, not with the next flush
+        record = CallEndRecord(call_state, datetime.now(), event_buffer.take_for(call_state.id))
+        await history_writer.submit(record) # <--- No commit on the caller's latency path
+        call_log.info("call_end_queued", extra={"call_id": call_id_to_end, "status_msg": status_msg})
+    await call_store.delete(call_id_to_end)
+
+
+# --- Seat inventory: single-row conditional UPDATEs on the flights table ---
+async def reserve_seat(db: AsyncSession, flight_num: str) -> Optional[int]:
+    """Takes one seat if any are left. Returns the new seat count, or None if sold out / not found."""
+    result = await db.execute(
+        update(Flight)
+        .where(Flight.flight == flight_num, Flight.seats_available > 0)
+        .values(seats_available=Flight.seats_available - 1)
+        .returning(Flight.seats_available)
+    )
+    return result.scalar()
+
+async def release_seat(db: AsyncSession, flight_num: str) -> Optional[int]:
+    """Gives one seat back. Returns the new seat count, or None if the flight is not found."""
+    result = await db.execute(
+        update(Flight)
+        .where(Flight.flight == flight_num)
+        .values(seats_available=Flight.seats_available + 1)
+        .returning(Flight.seats_available)
+    )
+    return result.scalar()
 
 
-# --- UPDATED: Type hint is now CallHistory ---
-def _go_to_menu(call: CallHistory, target_menu: str, message: Optional[str] = None):
+def _go_to_menu(call: CallState, target_menu: str, message: Optional[str] = None):
     """Helper to transition the call state to a new menu."""
     call.current_menu = target_menu
     
-    # Handle JSON field update
-    new_path = list(call.menu_path) # Make a copy
-    new_path.append(target_menu)
-    call.menu_path = new_path
+    event_buffer.menu(call, target_menu) # <--- One appended event, no JSON rewrite
     
-    response = {
-        "status": "processed",
-        "message": message,
-        "current_menu": target_menu,
-        "prompt": MENU_STRUCTURE[target_menu]["prompt"]
+    return transition_bodies.response(target_menu, message) # <--- Static transitions come pre-encoded
+
+# ==================== ACTION HANDLERS ====================
+# One async function per MENU_STRUCTURE "action". Each gets the live call,
+# the MenuOption that was pressed, the DB session and the default response,
+# and returns the response to send. Registered by name; the menu graph
+# resolves them once at startup.
+ACTIONS = ActionRegistry()
+
+# --- (DB Helper functions) ---
+# Read-only lookups go through lookup_cache (shared, immutable snapshots)
+async def _find_pnr_info(db: AsyncSession, pnr_key_to_find):
+    return await lookup_cache.booking(db, pnr_key_to_find)
+
+async def _find_flight_info(db: AsyncSession, flight_num_to_find):
+    return await lookup_cache.flight(db, flight_num_to_find)
+
+async def _find_ff_info(db: AsyncSession, ff_num_to_find):
+    return await lookup_cache.frequent_flyer(db, ff_num_to_find)
+
+# Writers load the ORM row itself, never a cached snapshot
+async def _load_booking(db: AsyncSession, pnr_key_to_find):
+    result = await db.execute(select(Booking).filter(Booking.pnr_key == pnr_key_to_find))
+    return result.scalars().first()
+
+def _handle_invalid_input(call: CallState, option, error_message, repeat_menu=None):
+    call.input_buffer = "" # <--- Modify call state
+    menu_to_repeat = repeat_menu if repeat_menu else option.menu
+    
+    return {
+        "status": "processed", 
+        "message": error_message,
+        "prompt": MENU_GRAPH[menu_to_repeat].prompt, 
+        "current_menu": menu_to_repeat
     }
+
+
+@ACTIONS.register("goto_menu")
+async def _action_goto_menu(call, option, db, response):
+    target_menu = option.target
+    
+    # <--- NEW: Clear booking data if returning to main
+    if target_menu == "main":
+        call.active_pnr = None
+        call.active_ff_number = None
+        call.booking_flight = None
+        call.booking_name = None
+        call.booking_age = None
+        call.booking_gender = None
+        
+    if MENU_GRAPH[option.menu].input_length:
+         call.input_buffer = ""
+
+    return _go_to_menu(call, target_menu, option.message) # This modifies 'call' object
+
+@ACTIONS.register("end_call")
+async def _action_end_call(call, option, db, response):
+    response["status"] = "call_ended"
+    response["call_action"] = "hangup"
+    await end_call_logic(db, call.call_id, f"Call ended with message: {option.message}", call) 
     return response
 
-# ==================== ENDPOINTS ====================
+@ACTIONS.register("transfer_agent")
+async def _action_transfer_agent(call, option, db, response):
+    response["status"] = "transferring"
+    response["call_action"] = "hangup"
+    response["message"] = option.message
+    await end_call_logic(db, call.call_id, f"Transferred to agent: {option.message}", call) 
+    call_log.info("transferring", extra={"call_id": call.call_id, "action": option.action})
+    return response
+
+@ACTIONS.register("lookup_pnr_status")
+async def _action_lookup_pnr_status(call, option, db, response):
+    pnr_key = call.input_buffer
+    call.input_buffer = ""
+    pnr_info = await _find_pnr_info(db, pnr_key) 
+
+    if pnr_info:
+        pnr_display = pnr_info.pnr_display
+        flight_info = await _find_flight_info(db, pnr_info.flight) if pnr_info.flight else None
+        seats = flight_info.seats_available if flight_info else None
+
+        vacancy_message = ""
+        if pnr_info.status == "Cancelled":
+            vacancy_message = "There are no seats available as this flight is cancelled."
+        elif flight_info is None:
+            pass # <--- Booking names no known flight (no FK check on SQLite / bulk loads): status only
+        elif seats > 0:
+            vacancy_message = f"There are currently {seats} seats available on this flight."
+        else:
+            vacancy_message = "This flight is currently full."
+        
+        pass_name = pnr_info.passenger_name if pnr_info.passenger_name else "N/A"
+
+        response["status"] = "pnr_found"
+        response["pnr_info"] = { "pnr_display": pnr_info.pnr_display, "flight": pnr_info.flight, "status": pnr_info.status, "route": flight_info.route if flight_info else None, "time": flight_info.time if flight_info else None, "seats_available": seats }
+        
+        route = f" from {flight_info.route}" if flight_info else ""
+        response["message"] = (
+            f"Your PNR {pnr_display}: Flight {pnr_info.flight or 'N/A'}{route} is {pnr_info.status}. "
+            f"Passenger: {pass_name}. "
+            f"{vacancy_message} " 
+            f"This call will now end."
+        )
+        response["call_action"] = "hangup"
+        await end_call_logic(db, call.call_id, f"Looked up PNR status: {pnr_display}", call) 
+        return response
+    return _handle_invalid_input(call, option, f"Sorry, PNR {pnr_key} was not found. Please try again.")
+
+@ACTIONS.register("lookup_pnr_manage", targets=("manage_booking_options", "main"))
+async def _action_lookup_pnr_manage(call, option, db, response):
+    pnr_key = call.input_buffer
+    call.input_buffer = ""
+    pnr_info = await _find_pnr_info(db, pnr_key) 
+
+    if not pnr_info:
+        return _handle_invalid_input(call, option, f"Sorry, PNR {pnr_key} was not found. Please try again.")
+
+    pnr_display = pnr_info.pnr_display
+    if pnr_info.status == "Cancelled":
+         response["message"] = f"PNR {pnr_display} is already marked as Cancelled. Returning to main menu."
+         target_menu = "main"
+         call.active_pnr = None
+    else:
+         call.active_pnr = pnr_key 
+         target_menu = "manage_booking_options"
+
+    # Use helper to set menu
+    _go_to_menu(call, target_menu, response["message"])
+    response["current_menu"] = target_menu
+
+    if target_menu == "manage_booking_options":
+        pass_name = pnr_info.passenger_name if pnr_info.passenger_name else "N/A"
+        response["prompt"] = f"PNR {pnr_display} for {pass_name} found. Say 'Cancel Flight'. Or, Press 2 to Cancel. Press star to go back."
+    else:
+         response["prompt"] = MENU_GRAPH[target_menu].prompt
+    return response
+
+@ACTIONS.register("lookup_pnr_checkin", targets=("main",))
+async def _action_lookup_pnr_checkin(call, option, db, response):
+    pnr_key = call.input_buffer
+    call.input_buffer = ""
+    pnr_info = await _find_pnr_info(db, pnr_key) 
+    
+    if not pnr_info:
+        return _handle_invalid_input(call, option, f"Sorry, PNR {pnr_key} was not found. Please try again.")
+
+    pnr_display = pnr_info.pnr_display
+    if pnr_info.status == "Cancelled":
+         response["message"] = f"Cannot check in for cancelled PNR {pnr_display}. Returning to main menu."
+         target_menu = "main"
+         _go_to_menu(call, target_menu, response["message"])
+         response["current_menu"] = target_menu
+         response["prompt"] = MENU_GRAPH[target_menu].prompt
+    else:
+         pass_name = pnr_info.passenger_name if pnr_info.passenger_name else "N/A"
+         response["status"] = "call_ended"
+         response["message"] = f"Check-in successful for PNR {pnr_display}, passenger {pass_name}. A link has been sent. This call will now end."
+         response["call_action"] = "hangup"
+         await end_call_logic(db, call.call_id, f"Checked in PNR: {pnr_display}", call) 
+    return response
+
+@ACTIONS.register("lookup_pnr_boardingpass", targets=("main",))
+async def _action_lookup_pnr_boardingpass(call, option, db, response):
+    pnr_key = call.input_buffer
+    call.input_buffer = ""
+    pnr_info = await _find_pnr_info(db, pnr_key) 
+
+    if not pnr_info:
+        return _handle_invalid_input(call, option, f"Sorry, PNR {pnr_key} was not found. Please try again.")
+
+    pnr_display = pnr_info.pnr_display
+    if pnr_info.status == "Cancelled":
+        response["message"] = f"Cannot get boarding pass for cancelled PNR {pnr_display}. Returning to main menu."
+        target_menu = "main"
+        _go_to_menu(call, target_menu, response["message"])
+        response["current_menu"] = target_menu
+        response["prompt"] = MENU_GRAPH[target_menu].prompt
+    else:
+        response["status"] = "call_ended"
+        response["message"] = f"Your boarding pass for PNR {pnr_display} has been re-sent to your registered email. This call will now end."
+        response["call_action"] = "hangup"
+        await end_call_logic(db, call.call_id, f"Sent boarding pass for PNR: {pnr_display}", call) 
+    return response
+
+@ACTIONS.register("cancel_flight")
+async def _action_cancel_flight(call, option, db, response):
+    pnr_to_cancel_key = call.active_pnr # <--- Read from call state
+    
+    if not pnr_to_cancel_key:
+        return _handle_invalid_input(call, option, "An error occurred (no PNR active). Returning to main menu.", "main")
+
+    booking_to_cancel = await _load_booking(db, pnr_to_cancel_key) 
+    if not booking_to_cancel:
+        response = _handle_invalid_input(call, option, "An error occurred finding your PNR. Returning to main menu.", "main")
+        call.active_pnr = None
+        return response
+
+    pnr_display = booking_to_cancel.pnr_display
+
+    if booking_to_cancel.status == "Cancelled":
+        response["message"] = f"Your flight for PNR {pnr_display} is already cancelled. This call will now end."
+    else:
+        # 1. UPDATE THE BOOKING STATUS
+        booking_to_cancel.status = "Cancelled"
+        await stats.bump(db, "cancellations")
+        
+        # 2. INCREMENT SEAT COUNT (one row, one UPDATE)
+        flight_num = booking_to_cancel.flight
+        new_seat_count = await release_seat(db, flight_num)
+        if new_seat_count is not None:
+            booking_log.info("seats_updated", extra={"call_id": call.call_id, "flight": flight_num, "seats_available": new_seat_count})
+
+        # 3. COMMIT (SAVE) ALL CHANGES (the call-end audit is written separately)
+        await db.commit()
+        lookup_cache.invalidate_booking(pnr_to_cancel_key) # <--- After the commit, so no reader re-caches the old row
+        lookup_cache.invalidate_flight(flight_num)
+        booking_log.info("booking_cancelled", extra={"call_id": call.call_id, "pnr": pnr_display})
+        response["message"] = f"Your flight for PNR {pnr_display} has been successfully cancelled. A confirmation email has been sent. This call will now end."
+    
+    response["status"] = "call_ended"
+    response["call_action"] = "hangup"
+    await end_call_logic(db, call.call_id, f"Cancelled PNR: {pnr_display}", call) 
+    return response
+
+@ACTIONS.register("lookup_ff_number", targets=("frequent_flyer_pin",))
+async def _action_lookup_ff_number(call, option, db, response):
+    ff_number = call.input_buffer
+    call.input_buffer = ""
+    ff_info = await _find_ff_info(db, ff_number) 
+
+    if ff_info:
+        call.active_ff_number = ff_number
+        return _go_to_menu(call, "frequent_flyer_pin", f"Account {ff_number} found for {ff_info.name}.")
+    return _handle_invalid_input(call, option, f"Sorry, Flying Returns number {ff_number} was not found. Please try again.")
+
+@ACTIONS.register("verify_ff_pin", targets=("frequent_flyer_options",))
+async def _action_verify_ff_pin(call, option, db, response):
+    pin_entered = call.input_buffer
+    call.input_buffer = ""
+    ff_info = await _find_ff_info(db, call.active_ff_number) 
+
+    if ff_info and ff_info.pin == pin_entered: 
+        return _go_to_menu(call, "frequent_flyer_options", "PIN verified.")
+    return _handle_invalid_input(call, option, f"Sorry, that PIN is incorrect. Please try again.")
+
+@ACTIONS.register("check_ff_points")
+async def _action_check_ff_points(call, option, db, response):
+    active_ff = call.active_ff_number
+    ff_info = await _find_ff_info(db, active_ff) 
+    if ff_info:
+         points = ff_info.points 
+         response["status"] = "call_ended"
+         response["message"] = f"Your Flying Returns balance for account {active_ff} is {points:,} points. This call will now end."
+         response["call_action"] = "hangup"
+         await end_call_logic(db, call.call_id, f"Checked points for FF: {active_ff}", call) 
+         return response
+    response = _handle_invalid_input(call, option, "An error occurred finding your account details. Returning to main menu.", "main")
+    call.active_ff_number = None
+    return response
+
+@ACTIONS.register("lookup_pnr_refundstatus")
+async def _action_lookup_pnr_refundstatus(call, option, db, response):
+    pnr_key = call.input_buffer
+    call.input_buffer = ""
+    pnr_info = await _find_pnr_info(db, pnr_key) 
+
+    if not pnr_info:
+        return _handle_invalid_input(call, option, f"Sorry, PNR {pnr_key} was not found. Please try again.")
+
+    pnr_display = pnr_info.pnr_display
+    if pnr_info.status == "Cancelled":
+         refund_msg = f"Your refund request for cancelled PNR {pnr_display} is currently in process. It should reflect in your account within 5-7 business days."
+    else:
+         refund_msg = f"There is no active refund request found for PNR {pnr_display} as the booking is currently {pnr_info.status}."
 
-@app.get("/")
-def root(db: Session = Depends(get_db)): 
-    """Health check"""
+    response["status"] = "call_ended"
+    response["message"] = refund_msg + " This call will now end."
+    response["call_action"] = "hangup"
+    await end_call_logic(db, call.call_id, f"Checked refund status for PNR: {pnr_display}", call) 
+    return response
+
+@ACTIONS.register("lookup_pnr_receipt")
+async def _action_lookup_pnr_receipt(call, option, db, response):
+    pnr_key = call.input_buffer
+    call.input_buffer = ""
+    pnr_info = await _find_pnr_info(db, pnr_key) 
+
+    if not pnr_info:
+        return _handle_invalid_input(call, option, f"Sorry, PNR {pnr_key} was not found. Please try again.")
+
+    pnr_display = pnr_info.pnr_display
+    response["status"] = "call_ended"
+    response["message"] = f"A copy of the receipt for PNR {pnr_display} has been sent to your registered email address. This call will now end."
+    response["call_action"] = "hangup"
+    await end_call_logic(db, call.call_id, f"Sent receipt for PNR: {pnr_display}", call) 
+    return response
+
+@ACTIONS.register("lookup_flight_for_booking", targets=("booking_ask_name",))
+async def _action_lookup_flight_for_booking(call, option, db, response):
+    flight_input = call.input_buffer
+    
+    if flight_input.isdigit():
+        flight_input = "AI" + flight_input
+    
+    flight_info = await _find_flight_info(db, flight_input.upper())
+    call.input_buffer = ""
+    
+    if not flight_info:
+        return _handle_invalid_input(call, option, f"Sorry, flight {flight_input.upper()} was not found. Please try again.", "booking_ask_flight")
+    if flight_info.seats_available <= 0:
+        return _handle_invalid_input(call, option, f"Sorry, flight {flight_info.flight} is full. Please try another flight.", "booking_ask_flight")
+
+    call.booking_flight = flight_info.flight # Store "AI101"
+    return _go_to_menu(call, "booking_ask_name", f"Flight {flight_info.flight} found. {flight_info.seats_available} seats available.")
+
+@ACTIONS.register("set_age_and_ask_gender", targets=("booking_ask_gender",))
+async def _action_set_age_and_ask_gender(call, option, db, response):
     try:
-        booking_count = db.query(Booking).count()
-        ff_count = db.query(FrequentFlyer).count()
-        history_count = db.query(CallHistory).count()
+        age = int(call.input_buffer)
+    except ValueError:
+        return _handle_invalid_input(call, option, "Invalid age entered. Please try again.", "booking_ask_age")
+
+    if 0 < age < 120:
+        call.booking_age = age
+        call.input_buffer = ""
+        return _go_to_menu(call, "booking_ask_gender", f"Passenger age set as {age}.")
+    return _handle_invalid_input(call, option, "Invalid age. Please enter an age between 1 and 120.", "booking_ask_age")
+
+@ACTIONS.register("set_gender_and_confirm", targets=("booking_confirm_details",))
+async def _action_set_gender_and_confirm(call, option, db, response):
+    call.booking_gender = option.params["gender"]
+    
+    dynamic_prompt = (
+        f"You are about to book one seat on flight {call.booking_flight} for {call.booking_name}, "
+        f"age {call.booking_age}, gender {call.booking_gender}. "
+        "Press 1 to confirm and book. Press star to cancel and return to the main menu." # <-- CHANGED
+    )
+    
+    call.current_menu = "booking_confirm_details"
+    event_buffer.menu(call, "booking_confirm_details")
+    response["current_menu"] = "booking_confirm_details"
+    response["prompt"] = dynamic_prompt
+    return response
+
+@ACTIONS.register("confirm_booking")
+async def _action_confirm_booking(call, option, db, response):
+    flight_num = call.booking_flight
+    name = call.booking_name
+    age = call.booking_age
+    gender = call.booking_gender
+    
+    if not all([flight_num, name, age, gender]):
+         return _handle_invalid_input(call, option, "A booking error occurred. Incomplete details. Returning to main menu.", "main")
+    
+    flight_exists = await db.scalar(select(Flight.id).filter(Flight.flight == flight_num))
+    if not flight_exists:
+        return _handle_invalid_input(call, option, f"Error: Flight {flight_num} not found. Returning to main menu.", "main")
         
-        # Check active calls by querying DB
-        active_call_count = db.query(CallHistory).filter(CallHistory.end_time == None).count()
+    # PNR first: a block refill commits on its own connection, which must not
+    # wait behind this request's write lock on SQLite. Unused PNRs just leave a gap.
+    new_pnr_key = await id_allocator.next_pnr() # <--- From this worker's reserved block, no lookup
+
+    # Atomic: the UPDATE only matches while a seat is left, so two callers
+    # can never both take the last seat
+    new_seat_count = await reserve_seat(db, flight_num)
+    if new_seat_count is None:
+        return _handle_invalid_input(call, option, f"Sorry, flight {flight_num} has just sold out. Returning to main menu.", "main")
+    
+    new_pnr_display = flight_num[:2] + new_pnr_key[2:]
+
+    new_booking = Booking(
+        pnr_key=new_pnr_key,
+        pnr_display=new_pnr_display,
+        flight=flight_num,
+        status="Confirmed",
+        passenger_name=name,
+        passenger_age=age,
+        passenger_gender=gender
+    )
+        
+    db.add(new_booking)
+    await stats.bump(db, "bookings")
+    await db.commit() # <--- The booking is durable before the caller hears the PNR
+    lookup_cache.invalidate_flight(flight_num) # <--- Seat count changed
+    
+    booking_log.info("booking_created", extra={"call_id": call.call_id, "pnr": new_pnr_display, "flight": flight_num, "seats_available": new_seat_count})
+
+    response["status"] = "call_ended"
+    response["message"] = f"Booking confirmed. Your new PNR is {new_pnr_display}. This call will now end."
+    response["call_action"] = "hangup"
+    await end_call_logic(db, call.call_id, f"Booked PNR: {new_pnr_display}", call)
+    return response
+
+
+# --- Transitions made outside the option table (voice-only steps) ---
+VOICE_TRANSITIONS = {
+    "booking_ask_name": "booking_ask_age", # <--- Spoken name, then ask for age
+}
+
+# --- Compiled once at import: fails startup on a broken MENU_STRUCTURE ---
+MENU_GRAPH = compile_menu_graph(
+    MENU_STRUCTURE,
+    ACTIONS,
+    input_lengths=INPUT_REQUIRED_MENUS,
+    root="main",
+    extra_edges={menu: (target,) for menu, target in VOICE_TRANSITIONS.items()},
+)
+
+# --- Encoded once: the response body of every static menu transition ---
+transition_bodies = TransitionBodies(MENU_GRAPH)
+# /ivr/start: only the call ID changes, the (long) welcome prompt is pre-encoded
+START_CALL_BODY_TAIL = fast_json.dumps({"status": "connected", "prompt": MENU_GRAPH[MENU_GRAPH.root].prompt})[1:]
+
+# ==================== ENDPOINTS ====================
+
+@app.get("/", response_model=ServiceStatus, response_model_exclude_unset=True)
+async def root(db: AsyncSession = Depends(get_async_db)): 
+    """Health check (served from the cached counters, no table scans)"""
+    try:
+        counters = (await stats_cache.get(db))["counters"]
         
         return {
             "status": "IVR Simulator Running",
             "database_status": "Connected",
-            "live_active_calls_in_db": active_call_count, # <--- Changed
-            "total_completed_calls_in_db": history_count,
-            "total_bookings_in_db": booking_count,
-            "total_ff_accounts_in_db": ff_count
+            "live_active_calls_in_db": counters["active_calls"],
+            "total_completed_calls_in_db": counters["calls_started"],
+            "total_bookings_in_db": counters["bookings"],
+            "total_ff_accounts_in_db": counters["ff_accounts"]
         }
     except Exception as e:
-        print(f"DB Error: {e}")
+        db_log.warning("status_query_failed", extra={"error": str(e)})
         return {"status": "IVR Simulator Running", "database_status": "Error - Not Connected"}
 
 
+# --- Probes for the load balancer ---
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving. Never touches the database."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz(db: AsyncSession = Depends(get_async_db)):
+    """Readiness: one SELECT 1 round trip to the database."""
+    try:
+        await db.execute(text("SELECT 1"))
+    except Exception as e:
+        db_log.warning("readiness_failed", extra={"error": str(e)})
+        return JSONResponse(status_code=503, content={"status": "unavailable", "database_status": "Error - Not Connected"})
+    return {"status": "ready", "database_status": "Connected"}
+
+@app.get("/stats", response_model=StatsResponse)
+async def get_stats(db: AsyncSession = Depends(get_async_db)):
+    """Call/booking totals, maintained incrementally and cached for STATS_CACHE_SECONDS."""
+    snapshot = await stats_cache.get(db)
+    return {
+        **snapshot["counters"],
+        "refreshed_at": datetime.fromtimestamp(snapshot["refreshed_at"]).isoformat(),
+        "cache_ttl_seconds": stats_cache.ttl,
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text format. Everything is in-process; only the active-call gauge is read now."""
+    metrics.ACTIVE_CALLS.set(await call_store.count())
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# ==================== Profiles (admin) ====================
+def _profile_admin(token: Optional[str]):
+    if not profiler.token:
+        raise HTTPException(status_code=404, detail="Profiling admin is not enabled")
+    if not profiler.authorized(token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.get("/admin/profiles")
+async def list_profiles(call_id: Optional[str] = None, menu: Optional[str] = None, action: Optional[str] = None,
+                        x_admin_token: Optional[str] = Header(None)):
+    """Stored request profiles (newest first), filterable by call_id / menu / action."""
+    _profile_admin(x_admin_token)
+    return {"profiles": await asyncio.to_thread(profiler.list, call_id, menu, action)}
+
+@app.get("/admin/profiles/{profile_id}")
+async def download_profile(profile_id: str, format: str = "pstats", limit: int = 40,
+                           x_admin_token: Optional[str] = Header(None)):
+    """One profile: the pstats file (load it with pstats / snakeviz), or ?format=text for its top `limit` functions by cumulative time."""
+    _profile_admin(x_admin_token)
+    if format == "text":
+        report = await asyncio.to_thread(profiler.summary, profile_id, limit)
+        if report is None:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return PlainTextResponse(report)
+    path = profiler.profile_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{profile_id}.prof")
+
+
+@app.get("/ivr/history/{call_id}", response_model=CallHistoryResponse)
+async def get_call_history(call_id: str, db: AsyncSession = Depends(get_async_db)):
+    """One call's record, menu path and inputs, whether it is still hot or already archived."""
+    history = await read_call_history(db, call_id)
+    if history is None:
+        raise HTTPException(status_code=404, detail="Call not found")
+    return history
+
+
 # --- UPDATED: Saves call to DB ---
-@app.post("/ivr/start")
-def start_call(call_data: CallStart, db: Session = Depends(get_db)): # <--- Add db session
+@app.post("/ivr/start", response_model=CallStartResponse)
+async def start_call(call_data: CallStart, db: AsyncSession = Depends(get_async_db)): # <--- Add db session
+    call = await _start_call(call_data, db)
+    return Response(_start_call_body(call.call_id), media_type=fast_json.MEDIA_TYPE)
+
+def _start_call_body(call_id: str) -> bytes:
+    return b'{"call_id":' + fast_json.dumps(call_id) + b"," + START_CALL_BODY_TAIL
 
-    call_id = f"CALL_{random.randint(100000, 999999)}"
+async def _start_call(call_data: CallStart, db: AsyncSession) -> CallState:
+    """Creates the CallHistory row and the live call state (shared by /ivr/start and /ivr/ws)."""
+    try:
+        await admission_controller.check_caller(call_data.caller_number) # <--- 429 once this number's bucket is empty
+    except Rejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+    call_id = await id_allocator.next_call_id() # <--- Time-ordered, unique across workers
 
     # Create the new call state IN THE DATABASE
     new_call = CallHistory(
@@ -409,21 +1216,25 @@ def start_call(call_data: CallStart, db: Session = Depends(get_db)): # <--- Add
     )
     
     db.add(new_call)
-    db.commit() # <--- Save the new call to the DB
-
-    print(f"\n📞 NEW CALL: {call_id} from {call_data.caller_number} (Saved to DB)")
+    await stats.bump(db, "calls_started")
+    await db.commit() # <--- Save the new call to the DB
+    call = CallState.from_row(new_call)
+    event_buffer.menu(call, call.current_menu) # <--- Every path starts at "main"
+    await save_call(call) # <--- Then keep it live in the store
+
+    profiling.tag(call_id=call_id, menu=call.current_menu, action="start")
+    call_log.info("call_started", extra={"call_id": call_id, "caller_number": call_data.caller_number})
+    return call
 
-    return {
-        "call_id": call_id,
-        "status": "connected",
-        "prompt": MENU_STRUCTURE["main"]["prompt"]
-    }
+def _observe_nlu(started: float, result: str):
+    metrics.NLU_LATENCY.observe(time.perf_counter() - started, result)
 
 # ==========================================================
 # ##### UPDATED handle_voice_input (NLU FIX + DB STATE) #####
 # ==========================================================
-@app.post("/ivr/process_voice")
-async def handle_voice_input(input_data: VoiceInput, db: Session = Depends(get_db)): 
+@app.post("/ivr/process_voice", **IVR_RESPONSE)
+@serve_prepared
+async def handle_voice_input(input_data: VoiceInput, db: AsyncSession = Depends(get_async_db)): 
     """
     MODERNIZATION LAYER:
     Accepts natural language text, maps it to legacy IVR logic.
@@ -432,267 +1243,88 @@ async def handle_voice_input(input_data: VoiceInput, db: Session = Depends(get_d
     text = input_data.text.lower()
     
     # --- NEW: Get call from DB ---
-    call = get_active_call(call_id, db)
+    call = await get_active_call(call_id, db)
     # --- END NEW ---
     
     original_menu = call.current_menu # Get menu from DB
+    profiling.tag(menu=original_menu, action="voice")
 
-    print(f"\n🗣️ VOICE INPUT: Call {call_id}, Menu: {original_menu}, Text: {text}")
+    nlu_log.debug("voice_input", extra={"call_id": call_id, "menu": original_menu, "text": text})
 
     # --- NLU (Natural Language Understanding) Simulation ---
-    pnr_input_menus = ["flight_status_pnr", "manage_booking_pnr", "check_in_pnr_for_checkin", "check_in_pnr_for_boardingpass", "refunds_pnr_for_status", "refunds_pnr_for_receipt"]
     ff_number_menu = "frequent_flyer_number"
     ff_pin_menu = "frequent_flyer_pin"
     booking_flight_menu = "booking_ask_flight"
     booking_name_menu = "booking_ask_name"
     booking_age_menu = "booking_ask_age"
-    booking_gender_menu = "booking_ask_gender"
-    booking_confirm_menu = "booking_confirm_details"
-
-    FILLER_WORDS = [
-        'my', 'is', 'uh', 'um', 'please', 'can', 'get', 'space', 'dot', 'dash', 'want', 'to', 'like'
-    ]
-
-    def map_spoken_pnr(spoken_text):
-        letter_map = {
-            'a': '2', 'b': '2', 'c': '2', 'd': '3', 'e': '3', 'f': '3',
-            'g': '4', 'h': '4', 'i': '4', 'j': '5', 'k': '5', 'l': '5',
-            'm': '6', 'n': '6', 'o': '6', 'p': '7', 'q': '7', 'r': '7', 's': '7',
-            't': '8', 'u': '8', 'v': '8', 'w': '9', 'x': '9', 'y': '9', 'z': '9'
-        }
-        num_word_map = {
-            "one": "1", "two": "2", "three": "3", "four": "4", 
-            "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9", "zero": "0"
-        }
-
-        for word in FILLER_WORDS + ['pnr', 'number']:
-            spoken_text = spoken_text.replace(word, ' ')
-
-        for word, digit in num_word_map.items():
-            spoken_text = spoken_text.replace(word, digit)
-        
-        cleaned_text = re.sub(r'[.\s,-]+', '', spoken_text)
-        
-        chars = re.findall(r'([a-zA-Z0-9])', cleaned_text)
-        alphanumeric_pnr = "".join(chars)
-        
-        if len(alphanumeric_pnr) == 6:
-            numeric_pnr = ""
-            for char in alphanumeric_pnr:
-                if char.isalpha(): 
-                    numeric_pnr += letter_map.get(char, '') 
-                elif char.isdigit():
-                    numeric_pnr += char
-            
-            if len(numeric_pnr) == 6:
-                print(f"      NLU: Converted spoken PNR '{alphanumeric_pnr}' to '{numeric_pnr}'")
-                return numeric_pnr
-        
-        digit_match = re.search(r'(\d{6})', alphanumeric_pnr)
-        if digit_match:
-             print(f"      NLU: Found numeric PNR: {digit_match.group(1)}")
-             return digit_match.group(1)
-             
-        return None
-
-    def map_spoken_flight_number(spoken_text):
-        num_word_map = {
-            "one": "1", "two": "2", "three": "3", "four": "4", 
-            "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9", "zero": "0"
-        }
-
-        for word in FILLER_WORDS + ['flight', 'book', 'number']:
-            spoken_text = spoken_text.replace(word, ' ')
-
-        for word, digit in num_word_map.items():
-            spoken_text = spoken_text.replace(word, digit)
-        
-        cleaned_text = re.sub(r'[\s.-]+', '', spoken_text) 
-        
-        flight_match = re.search(r'([a-zA-Z0-9]{2}\d{2,4})', cleaned_text, re.IGNORECASE)
-        if flight_match:
-            flight_num_str = flight_match.group(1).upper()
-            print(f"      NLU: Found flight code '{flight_num_str}'")
-            return flight_num_str
-
-        cleaned_digits = re.sub(r'[^0-9]+', '', cleaned_text)
-        if cleaned_digits:
-            flight_num_str = "AI" + cleaned_digits # Assume AI prefix
-            print(f"      NLU: Converted spoken digits to '{flight_num_str}'")
-            return flight_num_str
-        return None
-
-    def map_spoken_age(spoken_text):
-        for word in FILLER_WORDS + ['age', 'years', 'old']:
-            spoken_text = spoken_text.replace(word, ' ')
-
-        num_word_map = {
-            "one": "1", "two": "2", "three": "3", "four": "4", 
-            "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9", "zero": "0",
-            "ten": "10", "eleven": "11", "twelve": "12", "thirteen": "13", "fourteen": "14", "fifteen": "15",
-            "sixteen": "16", "seventeen": "17", "eighteen": "18", "nineteen": "19", "twenty": "20",
-            "thirty": "30", "forty": "40", "fifty": "50", "sixty": "60", "seventy": "70", "eighty": "80", "ninety": "90"
-        }
-        for word, digit in num_word_map.items():
-            spoken_text = spoken_text.replace(word, digit)
-
-        age_match = re.search(r'(\d{1,3})', spoken_text)
-        if age_match:
-            age = int(age_match.group(1))
-            if 0 < age < 120:
-                print(f"      NLU: Extracted age '{age}'")
-                return age
-        return None
 
     # --- NLU PROCESSING ---
-    if original_menu in pnr_input_menus:
-        numeric_pnr = map_spoken_pnr(text) 
+    nlu_started = time.perf_counter()
+    if original_menu in PNR_INPUT_MENUS:
+        numeric_pnr = nlu.extract_pnr(text) 
         if numeric_pnr:
+            _observe_nlu(nlu_started, "match")
+            nlu_log.debug("extracted", extra={"call_id": call_id, "field": "pnr", "value": numeric_pnr})
             call.input_buffer = numeric_pnr # <--- UPDATE DB OBJECT
-            dtmf_input = DTMFInput(call_id=call_id, digit="#", current_menu=original_menu)
-            return await handle_dtmf(dtmf_input, db) 
+            return await _dispatch_dtmf(call, "#", db)
 
     elif original_menu == booking_flight_menu:
-        flight_num_str = map_spoken_flight_number(text)
+        flight_num_str = nlu.extract_flight_number(text)
         if flight_num_str:
+            _observe_nlu(nlu_started, "match")
+            nlu_log.debug("extracted", extra={"call_id": call_id, "field": "flight", "value": flight_num_str})
             call.input_buffer = flight_num_str # <--- UPDATE DB OBJECT
-            dtmf_input = DTMFInput(call_id=call_id, digit="#", current_menu=original_menu)
-            return await handle_dtmf(dtmf_input, db)
+            return await _dispatch_dtmf(call, "#", db)
 
     elif original_menu == booking_name_menu:
-        cleaned_name = text
-        for word in FILLER_WORDS + ['name']:
-             cleaned_name = cleaned_name.replace(word, ' ')
-        
-        name = cleaned_name.strip().title()
+        name = nlu.extract_name(text)
         
         if name:
+            _observe_nlu(nlu_started, "match")
             call.booking_name = name # <--- UPDATE DB OBJECT
-            response = _go_to_menu(call, "booking_ask_age", f"Passenger name set as {name}.")
-            db.commit() # <--- SAVE CHANGES
+            event_buffer.entry(call, name)
+            response = _go_to_menu(call, VOICE_TRANSITIONS[booking_name_menu], f"Passenger name set as {name}.")
+            await save_call(call) # <--- SAVE CHANGES
             return response
         
     elif original_menu == booking_age_menu:
-        age = map_spoken_age(text)
+        age = nlu.extract_age(text)
         if age:
+            _observe_nlu(nlu_started, "match")
+            nlu_log.debug("extracted", extra={"call_id": call_id, "field": "age", "value": age})
             call.input_buffer = str(age) # <--- UPDATE DB OBJECT
-            dtmf_input = DTMFInput(call_id=call_id, digit="#", current_menu=original_menu)
-            return await handle_dtmf(dtmf_input, db)
-
-    elif original_menu == booking_gender_menu:
-        digit = None
-        if "male" in text:
-            digit = "1"
-        elif "female" in text:
-            digit = "2"
-        elif "other" in text:
-            digit = "3"
-        
-        if digit:
-            dtmf_input = DTMFInput(call_id=call_id, digit=digit, current_menu=original_menu)
-            return await handle_dtmf(dtmf_input, db)
+            return await _dispatch_dtmf(call, "#", db)
 
     elif original_menu == ff_number_menu:
-        cleaned_text = text
-        for word in FILLER_WORDS + ['number']:
-             cleaned_text = cleaned_text.replace(word, ' ')
-        cleaned_text = re.sub(r'[^0-9]+', '', cleaned_text)
-        
-        data_match = re.search(r'(\d{9})', cleaned_text)
-        if data_match:
-            data = data_match.group(1)
-            print(f"      NLU: Extracted FF Number: {data}")
+        data = nlu.extract_ff_number(text)
+        if data:
+            _observe_nlu(nlu_started, "match")
+            nlu_log.debug("extracted", extra={"call_id": call_id, "field": "ff_number", "value": data})
             call.input_buffer = data # <--- UPDATE DB OBJECT
-            dtmf_input = DTMFInput(call_id=call_id, digit="#", current_menu=original_menu)
-            return await handle_dtmf(dtmf_input, db) 
+            return await _dispatch_dtmf(call, "#", db)
 
     elif original_menu == ff_pin_menu:
-        cleaned_text = text
-        for word in FILLER_WORDS + ['pin']:
-             cleaned_text = cleaned_text.replace(word, ' ')
-        
-        spoken_digits = cleaned_text.split()
-        pin_digits = ""
-        num_map = {"zero": "0", "one": "1", "two": "2", "three": "3", "four": "4", "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9"}
-        for word in spoken_digits:
-            if word.isdigit():
-                pin_digits += word
-            elif word in num_map:
-                pin_digits += num_map[word]
-
-        data_match = re.search(r'(\d{4})', pin_digits)
-        if data_match:
-            data = data_match.group(1)
-            print(f"      NLU: Extracted PIN: {data}")
+        data = nlu.extract_pin(text)
+        if data:
+            _observe_nlu(nlu_started, "match")
+            nlu_log.debug("extracted", extra={"call_id": call_id, "field": "pin"}) # <--- Never log the PIN itself
             call.input_buffer = data # <--- UPDATE DB OBJECT
-            dtmf_input = DTMFInput(call_id=call_id, digit="#", current_menu=original_menu)
-            return await handle_dtmf(dtmf_input, db) 
-
-    # --- (Voice to DTMF mapping logic) ---
-    digit_to_press = None
-    menu_to_use = original_menu
-    if "agent" in text or "speak" in text:
-        digit_to_press = "0"
-        menu_to_use = "main"
-    elif "main menu" in text:
-        if original_menu != "main":
-            digit_to_press = "*" 
-            menu_to_use = original_menu
-    elif "back" in text:
-       if original_menu in [ff_pin_menu, "booking_confirm_details", "booking_ask_name", "booking_ask_age", "booking_ask_gender"]:
-            digit_to_press = "*" 
-            menu_to_use = original_menu
-       elif original_menu != "main":
-            digit_to_press = "*" 
-            menu_to_use = original_menu
-    if digit_to_press is None:
-        if original_menu == "main":
-            if "status" in text: digit_to_press = "1"
-            elif "manage" in text or "cancel" in text or "change" in text: digit_to_press = "2"
-            elif "baggage" in text or "bag" in text: digit_to_press = "3"
-            elif "check in" in text or "boarding pass" in text: digit_to_press = "4"
-            elif "booking" in text or "book" in text: digit_to_press = "5"
-            elif "frequent" in text or "points" in text: digit_to_press = "6"
-            elif "special" in text or "wheelchair" in text: digit_to_press = "7"
-            elif "refund" in text or "receipt" in text: digit_to_press = "8"
-            elif "other" in text or "pet" in text: digit_to_press = "9"
-        elif original_menu == "manage_booking_options":
-            if "change" in text: digit_to_press = "1"
-            elif "cancel" in text: digit_to_press = "2"
-        elif original_menu == booking_confirm_menu:
-            if "confirm" in text or "yes" in text: digit_to_press = "1"
-        elif original_menu == "baggage":
-            if "lost" in text: digit_to_press = "1"
-            elif "allowance" in text: digit_to_press = "2"
-        elif original_menu == "check_in_options":
-            if "check in" in text: digit_to_press = "1"
-            elif "boarding pass" in text: digit_to_press = "2"
-        elif original_menu == "frequent_flyer_options":
-            if "check" in text or "points" in text: digit_to_press = "1"
-            elif "redeem" in text: digit_to_press = "2"
-        elif original_menu == "special_assistance":
-            if "wheelchair" in text: digit_to_press = "1"
-            elif "other" in text: digit_to_press = "2"
-        elif original_menu == "refunds":
-            if "status" in text: digit_to_press = "1"
-            elif "receipt" in text or "copy" in text: digit_to_press = "2"
-        elif original_menu == "other_inquiries":
-            if "pet" in text: digit_to_press = "1"
-            elif "group" in text: digit_to_press = "2"
+            return await _dispatch_dtmf(call, "#", db)
+
+    # --- (Voice to DTMF mapping logic: one index lookup per word) ---
+    digit_to_press = nlu.resolve_intent(INTENT_INDEX, text, original_menu)
 
     if digit_to_press:
-        print(f"      NLU: Mapped text '{text}' to DTMF digit: {digit_to_press} (using menu: {menu_to_use})")
-        dtmf_input = DTMFInput(
-            call_id=call_id,
-            digit=digit_to_press,
-            current_menu=menu_to_use
-        )
-        return await handle_dtmf(dtmf_input, db) 
+        _observe_nlu(nlu_started, "match")
+        nlu_log.debug("intent_mapped", extra={"call_id": call_id, "menu": original_menu, "digit": digit_to_press})
+        # NOTE: the dispatcher always uses the call's own menu, like /ivr/dtmf does
+        return await _dispatch_dtmf(call, digit_to_press, db)
 
     # --- (NLU Fail logic) ---
-    print("      NLU: No intent or digit matched.")
+    _observe_nlu(nlu_started, "miss")
+    nlu_log.debug("no_match", extra={"call_id": call_id, "menu": original_menu})
     prompt_msg = "I'm sorry, I didn't understand that. Please try again."
-    if original_menu in pnr_input_menus:
+    if original_menu in PNR_INPUT_MENUS:
         prompt_msg = "Sorry, I didn't catch that PNR. Please clearly say your 6-digit PNR."
     # ... (other custom fail messages) ...
 
@@ -700,492 +1332,226 @@ async def handle_voice_input(input_data: VoiceInput, db: Session = Depends(get_d
         "status": "invalid",
         "prompt": prompt_msg,
         "current_menu": original_menu,
-        "prompt_original": MENU_STRUCTURE[original_menu]["prompt"]
+        "prompt_original": MENU_GRAPH[original_menu].prompt
     }
 
+def _collect_digits(call: CallState, digits: str, required_length: int):
+    """Appends entry digits to the input buffer. Returns the 'collecting' response for the last digit."""
+    if len(call.input_buffer) + len(digits) > MAX_ENTRY_DIGITS:
+        call.input_buffer = "" # <--- Start the entry over rather than grow the buffer without bound
+        return { "status": "processed", "message": "Entry too long. Please try again.", "prompt": MENU_GRAPH[call.current_menu].prompt, "current_menu": call.current_menu }
+
+    call.input_buffer += digits # <--- UPDATE CALL STATE
+    buffer_content = call.input_buffer
+    last_digit = digits[-1]
+    prompt_msg = f"You entered {last_digit}. Press hash to submit."
+
+    # Fixed-length entries keep asking until enough digits are in
+    if required_length > 0 and len(buffer_content) < required_length:
+        prompt_msg = f"You entered {last_digit}. Continue entering."
+
+    return { "status": "collecting", "prompt": prompt_msg, "collected": buffer_content, "current_menu": call.current_menu }
+
+
 # ==========================================================
 # ##### UPDATED handle_dtmf (Star-Key Fix + DB STATE) #####
 # ==========================================================
-@app.post("/ivr/dtmf")
-async def handle_dtmf(input_data: DTMFInput, db: Session = Depends(get_db)): 
+@app.post("/ivr/dtmf", **IVR_RESPONSE)
+@serve_prepared
+async def handle_dtmf(input_data: DTMFInput, db: AsyncSession = Depends(get_async_db)): 
     """
     Process DTMF key press (The Legacy System)
     """
 
-    call_id = input_data.call_id
-    digit = input_data.digit
-    
-    # --- NEW: Get call from DB ---
-    call = get_active_call(call_id, db)
-    # --- END NEW ---
+    call = await get_active_call(input_data.call_id, db)
+    return await _dispatch_dtmf(call, input_data.digit, db)
+
 
-    current_menu = call.current_menu 
-    menu_name_from_db = call.current_menu # Use menu from DB
+async def _dispatch_dtmf(call: CallState, digit: str, db: AsyncSession):
+    """Applies one key press to the live call state (shared by DTMF and voice input)."""
+    call_id = call.call_id
+    menu_name_from_db = call.current_menu # Use menu from the call state
 
-    print(f"\n🔢 DTMF INPUT: Call {call_id}, DB Menu: {menu_name_from_db}, Digit: {digit}")
+    dtmf_log.debug("dtmf_input", extra={"call_id": call_id, "menu": menu_name_from_db, "digit": digit})
 
-    menu = MENU_STRUCTURE.get(menu_name_from_db)
-    if not menu:
+    node = MENU_GRAPH.get(menu_name_from_db)
+    if not node:
         return {"error": "Invalid menu state"}
 
     # --- Input buffer logic (UPDATED for Star-Key) ---
-    input_required_menus = {
-        "flight_status_pnr": 6,
-        "manage_booking_pnr": 6,
-        "check_in_pnr_for_checkin": 6,
-        "check_in_pnr_for_boardingpass": 6,
-        "frequent_flyer_number": 9,
-        "frequent_flyer_pin": 4,
-        "refunds_pnr_for_status": 6,
-        "refunds_pnr_for_receipt": 6,
-        "booking_ask_flight": -1, # <--- Variable length
-        "booking_ask_age": -1 # <--- Variable length
-    }
-    required_length = input_required_menus.get(menu_name_from_db)
+    required_length = node.input_length
 
-    # --- PNR/FF/PIN Input (Fixed length) ---
-    if required_length and required_length > 0 and digit != "#" and digit != "*": 
-        call.input_buffer += digit # <--- UPDATE DB OBJECT
-        buffer_content = call.input_buffer
-        prompt_msg = f"You entered {digit}. Continue entering."
-        
-        if len(buffer_content) >= required_length:
-             prompt_msg = f"You entered {digit}. Press hash to submit."
-             
-        db.commit() # <--- SAVE CHANGES
-        return { "status": "collecting", "prompt": prompt_msg, "collected": buffer_content, "current_menu": menu_name_from_db }
-    
-    # --- NEW: Flight Booking/Age Input (Variable length) ---
-    elif required_length == -1 and digit != "#" and digit != "*": 
-        call.input_buffer += digit # <--- UPDATE DB OBJECT
-        buffer_content = call.input_buffer
-        db.commit() # <--- SAVE CHANGES
-        return { "status": "collecting", "prompt": f"You entered {digit}. Press hash to submit.", "collected": buffer_content, "current_menu": menu_name_from_db }
+    # --- PNR/FF/PIN (fixed length) and Flight/Age (variable length) input ---
+    if required_length and digit != "#" and digit != "*": 
+        response = _collect_digits(call, digit, required_length)
+        await save_call(call) # <--- SAVE CHANGES
+        return response
 
     
     # --- Check if hash is pressed AND length is incorrect (for fixed-length inputs) ---
     if digit == "#" and required_length and required_length > 0 and len(call.input_buffer) != required_length:
           error_message = f"Invalid input length. Must be {required_length} digits. Please try again."
-          # We need to define _handle_invalid_input to work on the 'call' object
           call.input_buffer = ""
-          db.commit()
+          await save_call(call)
           return {
               "status": "processed", 
               "message": error_message,
-              "prompt": MENU_STRUCTURE[menu_name_from_db]["prompt"], 
+              "prompt": node.prompt, 
               "current_menu": menu_name_from_db
           }
 
 
-    if digit not in menu["options"]:
-        invalid_menu_to_use = call.current_menu
-        return { "status": "invalid", "prompt": "Invalid option. Please try again.", "current_menu": invalid_menu_to_use, "valid_options": list(MENU_STRUCTURE[invalid_menu_to_use]["options"].keys()) }
+    option = node.options.get(digit)
+    if option is None:
+        return { "status": "invalid", "prompt": "Invalid option. Please try again.", "current_menu": menu_name_from_db, "valid_options": list(node.valid_options) }
 
-    # Handle JSON field
-    new_inputs = list(call.inputs)
-    new_inputs.append(digit)
-    call.inputs = new_inputs
+    if digit == "#" and required_length:
+        event_buffer.entry(call, None if menu_name_from_db in SECRET_ENTRY_MENUS else call.input_buffer) # <--- For replay
+    event_buffer.input(call, digit)
+    profiling.tag(menu=menu_name_from_db, action=option.action)
+    metrics.MENU_INPUTS.inc(menu_name_from_db)
+    metrics.ACTIONS.inc(menu_name_from_db, option.action)
 
-    option = menu["options"][digit]
-    action = option["action"]
-    message = option["message"]
+    # --- Action dispatch: the handler was resolved when MENU_GRAPH was compiled ---
+    response = await option.handler(call, option, db, { "status": "processed", "message": option.message })
 
-    response = { "status": "processed", "message": message }
+    # end_call_logic handles its own commit, so ended calls need no save
+    # (a save would put the call back in the store, where it counts as live)
+    if response.get("status") != "transferring" and response.get("status") != "call_ended" and response.get("call_action") != "hangup":
+        dtmf_log.debug("action", extra={"call_id": call_id, "menu": menu_name_from_db, "action": option.action})
+        await save_call(call) # <--- THIS IS THE FINAL SAVE for all state changes
 
-    # --- (DB Helper functions) ---
-    def _find_pnr_info(pnr_key_to_find):
-        return db.query(Booking).filter(Booking.pnr_key == pnr_key_to_find).first()
-    
-    def _find_flight_info(flight_num_to_find):
-        return db.query(Booking).filter(func.trim(Booking.flight).ilike(func.trim(flight_num_to_find))).first()
-
-    def _find_ff_info(ff_num_to_find):
-        return db.query(FrequentFlyer).filter(FrequentFlyer.ff_number == ff_num_to_find).first()
-
-    def _handle_invalid_input(error_message, repeat_menu=None):
-        call.input_buffer = "" # <--- Modify DB object
-        menu_to_repeat = repeat_menu if repeat_menu else menu_name_from_db
-        
-        return {
-            "status": "processed", 
-            "message": error_message,
-            "prompt": MENU_STRUCTURE[menu_to_repeat]["prompt"], 
-            "current_menu": menu_to_repeat
-        }
+    return response
 
-    # --- (Action logic: goto_menu, end_call, transfer_agent are unchanged) ---
-    if action == "goto_menu":
-        target_menu = option["target"]
-        
-        # <--- NEW: Clear booking data if returning to main
-        if target_menu == "main":
-            call.active_pnr = None
-            call.active_ff_number = None
-            call.booking_flight = None
-            call.booking_name = None
-            call.booking_age = None
-            call.booking_gender = None
-            
-        if menu_name_from_db in input_required_menus:
-             call.input_buffer = ""
 
-        response = _go_to_menu(call, target_menu, message) # This modifies 'call' object
+# ==================== dtmf_entry ====================
+@app.post("/ivr/dtmf_entry", **IVR_RESPONSE)
+@serve_prepared
+async def handle_dtmf_entry(input_data: DTMFEntryInput, db: AsyncSession = Depends(get_async_db)):
+    """
+    Submits a whole keypad entry (e.g. "241234#") in one request.
+    The response is exactly what pressing the keys one at a time would return.
+    """
+    call = await get_active_call(input_data.call_id, db)
+    required_length = MENU_GRAPH[call.current_menu].input_length
+    if not required_length:
+        raise HTTPException(status_code=400, detail=f"Menu '{call.current_menu}' does not take keypad entries")
 
+    entry = DTMF_ENTRY_PATTERN.fullmatch(input_data.digits)
+    if not input_data.digits or not entry:
+        raise HTTPException(status_code=422, detail="Entry must be digits, optionally followed by '#'")
+    digits, submit = entry.groups()
 
-    elif action == "end_call":
-        response["status"] = "call_ended"
-        response["call_action"] = "hangup"
-        end_call_logic(db, call.call_id, f"Call ended with message: {message}") 
+    dtmf_log.debug("dtmf_entry", extra={"call_id": call.call_id, "menu": call.current_menu, "length": len(digits)})
 
-    elif action == "transfer_agent":
-        response["status"] = "transferring"
-        response["call_action"] = "hangup"
-        response["message"] = message
-        end_call_logic(db, call.call_id, f"Transferred to agent: {message}") 
-        print(f"✅ ACTION: {action} - Sending 'transferring' signal to frontend.")
+    if not submit:
+        response = _collect_digits(call, digits, required_length)
+        await save_call(call)
         return response
 
-    elif action == "lookup_pnr_status":
-        pnr_key = call.input_buffer
-        call.input_buffer = ""
-        pnr_info = _find_pnr_info(pnr_key) 
-
-        if pnr_info:
-            pnr_display = pnr_info.pnr_display
-            seats = pnr_info.seats_available 
-
-            vacancy_message = ""
-            if pnr_info.status == "Cancelled":
-                vacancy_message = "There are no seats available as this flight is cancelled."
-            elif seats > 0:
-                vacancy_message = f"There are currently {seats} seats available on this flight."
-            else:
-                vacancy_message = "This flight is currently full."
-            
-            pass_name = pnr_info.passenger_name if pnr_info.passenger_name else "N/A"
-
-            response["status"] = "pnr_found"
-            response["pnr_info"] = { "pnr_display": pnr_info.pnr_display, "flight": pnr_info.flight, "status": pnr_info.status, "route": pnr_info.route, "time": pnr_info.time, "seats_available": seats }
-            
-            response["message"] = (
-                f"Your PNR {pnr_display}: Flight {pnr_info.flight} from {pnr_info.route} is {pnr_info.status}. "
-                f"Passenger: {pass_name}. "
-                f"{vacancy_message} " 
-                f"This call will now end."
-            )
-            response["call_action"] = "hangup"
-            end_call_logic(db, call.call_id, f"Looked up PNR status: {pnr_display}") 
-        else:
-            response = _handle_invalid_input(f"Sorry, PNR {pnr_key} was not found. Please try again.")
-
-    elif action == "lookup_pnr_manage":
-        pnr_key = call.input_buffer
-        call.input_buffer = ""
-        pnr_info = _find_pnr_info(pnr_key) 
-
-        if pnr_info:
-            pnr_display = pnr_info.pnr_display
-            if pnr_info.status == "Cancelled":
-                 response["message"] = f"PNR {pnr_display} is already marked as Cancelled. Returning to main menu."
-                 target_menu = "main"
-                 call.active_pnr = None
-            else:
-                 call.active_pnr = pnr_key 
-                 target_menu = "manage_booking_options"
-
-            # Use helper to set menu
-            _go_to_menu(call, target_menu, response["message"])
-            response["current_menu"] = target_menu
-
-            if target_menu == "manage_booking_options":
-                pass_name = pnr_info.passenger_name if pnr_info.passenger_name else "N/A"
-                response["prompt"] = f"PNR {pnr_display} for {pass_name} found. Say 'Cancel Flight'. Or, Press 2 to Cancel. Press star to go back."
-            else:
-                 response["prompt"] = MENU_STRUCTURE[target_menu]["prompt"]
-
-        else:
-            response = _handle_invalid_input(f"Sorry, PNR {pnr_key} was not found. Please try again.")
-
-    elif action == "lookup_pnr_checkin":
-        pnr_key = call.input_buffer
-        call.input_buffer = ""
-        pnr_info = _find_pnr_info(pnr_key) 
-        
-        if pnr_info:
-            pnr_display = pnr_info.pnr_display
-            if pnr_info.status == "Cancelled":
-                 response["message"] = f"Cannot check in for cancelled PNR {pnr_display}. Returning to main menu."
-                 target_menu = "main"
-                 _go_to_menu(call, target_menu, response["message"])
-                 response["current_menu"] = target_menu
-                 response["prompt"] = MENU_STRUCTURE[target_menu]["prompt"]
-            else:
-                 pass_name = pnr_info.passenger_name if pnr_info.passenger_name else "N/A"
-                 response["status"] = "call_ended"
-                 response["message"] = f"Check-in successful for PNR {pnr_display}, passenger {pass_name}. A link has been sent. This call will now end."
-                 response["call_action"] = "hangup"
-                 end_call_logic(db, call.call_id, f"Checked in PNR: {pnr_display}") 
-        else:
-            response = _handle_invalid_input(f"Sorry, PNR {pnr_key} was not found. Please try again.")
-
-    elif action == "lookup_pnr_boardingpass":
-        pnr_key = call.input_buffer
-        call.input_buffer = ""
-        pnr_info = _find_pnr_info(pnr_key) 
-
-        if pnr_info:
-             pnr_display = pnr_info.pnr_display
-             if pnr_info.status == "Cancelled":
-                 response["message"] = f"Cannot get boarding pass for cancelled PNR {pnr_display}. Returning to main menu."
-                 target_menu = "main"
-                 _go_to_menu(call, target_menu, response["message"])
-                 response["current_menu"] = target_menu
-                 response["prompt"] = MENU_STRUCTURE[target_menu]["prompt"]
-             else:
-                 response["status"] = "call_ended"
-                 response["message"] = f"Your boarding pass for PNR {pnr_display} has been re-sent to your registered email. This call will now end."
-                 response["call_action"] = "hangup"
-                 end_call_logic(db, call.call_id, f"Sent boarding pass for PNR: {pnr_display}") 
-        else:
-             response = _handle_invalid_input(f"Sorry, PNR {pnr_key} was not found. Please try again.")
-
-    elif action == "cancel_flight":
-        pnr_to_cancel_key = call.active_pnr # <--- Read from DB object
-        
-        if pnr_to_cancel_key:
-            booking_to_cancel = _find_pnr_info(pnr_to_cancel_key) 
-            
-            if booking_to_cancel:
-                pnr_display = booking_to_cancel.pnr_display
-
-                if booking_to_cancel.status == "Cancelled":
-                    response["message"] = f"Your flight for PNR {pnr_display} is already cancelled. This call will now end."
-                else:
-                    # 1. UPDATE THE BOOKING STATUS
-                    booking_to_cancel.status = "Cancelled"
-                    
-                    # 2. <--- NEW: INCREMENT SEAT COUNT
-                    flight_num = booking_to_cancel.flight
-                    all_bookings_for_flight = db.query(Booking).filter(Booking.flight == flight_num).all()
-                    
-                    if all_bookings_for_flight:
-                        current_seats = all_bookings_for_flight[0].seats_available
-                        new_seat_count = current_seats + 1
-                        for b in all_bookings_for_flight:
-                            b.seats_available = new_seat_count
-                        print(f"      *** SEATS UPDATED for {flight_num}: {current_seats} -> {new_seat_count} ***")
-
-                    # 3. COMMIT (SAVE) ALL CHANGES
-                    # db.commit() # <--- This will be handled at the end
-                    print(f"      *** PNR {pnr_display} ({pnr_to_cancel_key}) STATUS UPDATED TO CANCELLED IN DB ***")
-                    response["message"] = f"Your flight for PNR {pnr_display} has been successfully cancelled. A confirmation email has been sent. This call will now end."
-                
-                response["status"] = "call_ended"
-                response["call_action"] = "hangup"
-                end_call_logic(db, call.call_id, f"Cancelled PNR: {pnr_display}") 
-            
-            else:
-                 response = _handle_invalid_input("An error occurred finding your PNR. Returning to main menu.", "main")
-                 call.active_pnr = None
-        else:
-             response = _handle_invalid_input("An error occurred (no PNR active). Returning to main menu.", "main")
-
-    elif action == "lookup_ff_number":
-        ff_number = call.input_buffer
-        call.input_buffer = ""
-        ff_info = _find_ff_info(ff_number) 
-
-        if ff_info:
-            call.active_ff_number = ff_number
-            response = _go_to_menu(call, "frequent_flyer_pin", f"Account {ff_number} found for {ff_info.name}.")
-        else:
-             response = _handle_invalid_input(f"Sorry, Flying Returns number {ff_number} was not found. Please try again.")
-
-    elif action == "verify_ff_pin":
-        pin_entered = call.input_buffer
-        call.input_buffer = ""
-        active_ff = call.active_ff_number
-        ff_info = _find_ff_info(active_ff) 
-
-        if ff_info and ff_info.pin == pin_entered: 
-            response = _go_to_menu(call, "frequent_flyer_options", "PIN verified.")
-        else:
-            response = _handle_invalid_input(f"Sorry, that PIN is incorrect. Please try again.")
-
-    elif action == "check_ff_points":
-        active_ff = call.active_ff_number
-        ff_info = _find_ff_info(active_ff) 
-        if ff_info:
-             points = ff_info.points 
-             response["status"] = "call_ended"
-             response["message"] = f"Your Flying Returns balance for account {active_ff} is {points:,} points. This call will now end."
-             response["call_action"] = "hangup"
-             end_call_logic(db, call.call_id, f"Checked points for FF: {active_ff}") 
-        else:
-            response = _handle_invalid_input("An error occurred finding your account details. Returning to main menu.", "main")
-            call.active_ff_number = None
-
-    elif action == "lookup_pnr_refundstatus":
-        pnr_key = call.input_buffer
-        call.input_buffer = ""
-        pnr_info = _find_pnr_info(pnr_key) 
-
-        if pnr_info:
-            pnr_display = pnr_info.pnr_display
-            refund_msg = ""
-            if pnr_info.status == "Cancelled":
-                 refund_msg = f"Your refund request for cancelled PNR {pnr_display} is currently in process. It should reflect in your account within 5-7 business days."
-            else:
-                 refund_msg = f"There is no active refund request found for PNR {pnr_display} as the booking is currently {pnr_info.status}."
-
-            response["status"] = "call_ended"
-            response["message"] = refund_msg + " This call will now end."
-            response["call_action"] = "hangup"
-            end_call_logic(db, call.call_id, f"Checked refund status for PNR: {pnr_display}") 
-        else:
-             response = _handle_invalid_input(f"Sorry, PNR {pnr_key} was not found. Please try again.")
-
-    elif action == "lookup_pnr_receipt":
-        pnr_key = call.input_buffer
-        call.input_buffer = ""
-        pnr_info = _find_pnr_info(pnr_key) 
-
-        if pnr_info:
-            pnr_display = pnr_info.pnr_display
-            response["status"] = "call_ended"
-            response["message"] = f"A copy of the receipt for PNR {pnr_display} has been sent to your registered email address. This call will now end."
-            response["call_action"] = "hangup"
-            end_call_logic(db, call.call_id, f"Sent receipt for PNR: {pnr_display}") 
-        else:
-             response = _handle_invalid_input(f"Sorry, PNR {pnr_key} was not found. Please try again.")
-
-    elif action == "lookup_flight_for_booking":
-        flight_input = call.input_buffer
-        
-        if flight_input.isdigit():
-            flight_input = "AI" + flight_input
-        
-        flight_info = _find_flight_info(flight_input.upper())
-        call.input_buffer = ""
-        
-        if flight_info:
-            if flight_info.seats_available > 0:
-                call.booking_flight = flight_info.flight # Store "AI101"
-                response = _go_to_menu(call, "booking_ask_name", f"Flight {flight_info.flight} found. {flight_info.seats_available} seats available.")
-            else:
-                response = _handle_invalid_input(f"Sorry, flight {flight_info.flight} is full. Please try another flight.", "booking_ask_flight")
-        else:
-            response = _handle_invalid_input(f"Sorry, flight {flight_input.upper()} was not found. Please try again.", "booking_ask_flight")
-            
-    elif action == "set_age_and_ask_gender":
-        try:
-            age = int(call.input_buffer)
-            if 0 < age < 120:
-                call.booking_age = age
-                call.input_buffer = ""
-                response = _go_to_menu(call, "booking_ask_gender", f"Passenger age set as {age}.")
-            else:
-                response = _handle_invalid_input("Invalid age. Please enter an age between 1 and 120.", "booking_ask_age")
-        except ValueError:
-            response = _handle_invalid_input("Invalid age entered. Please try again.", "booking_ask_age")
-
-    elif action == "set_gender_and_confirm":
-        call.booking_gender = option["gender"]
-        
-        name = call.booking_name
-        age = call.booking_age
-        gender = call.booking_gender
-        flight = call.booking_flight
-        
-        dynamic_prompt = (
-            f"You are about to book one seat on flight {flight} for {name}, age {age}, gender {gender}. "
-            "Press 1 to confirm and book. Press star to cancel and return to the main menu." # <-- CHANGED
-        )
-        
-        call.current_menu = "booking_confirm_details"
-        call.menu_path.append("booking_confirm_details")
-        response["current_menu"] = "booking_confirm_details"
-        response["prompt"] = dynamic_prompt
-
-    elif action == "confirm_booking":
-        flight_num = call.booking_flight
-        name = call.booking_name
-        age = call.booking_age
-        gender = call.booking_gender
-        
-        if not all([flight_num, name, age, gender]):
-             response = _handle_invalid_input("A booking error occurred. Incomplete details. Returning to main menu.", "main")
-             db.commit() # <--- Commit changes from _handle_invalid_input
-             return response
-        
-        all_bookings_for_flight = db.query(Booking).filter(Booking.flight == flight_num).all()
-        
-        if not all_bookings_for_flight:
-            response = _handle_invalid_input(f"Error: Flight {flight_num} not found. Returning to main menu.", "main")
-            db.commit() # <--- Commit changes from _handle_invalid_input
+    # Buffer the digits, then press '#' (the dispatcher validates the length)
+    if digits:
+        response = _collect_digits(call, digits, required_length)
+        if response["status"] != "collecting":
+            await save_call(call)
             return response
-            
-        current_seats = all_bookings_for_flight[0].seats_available
-        if current_seats <= 0:
-            response = _handle_invalid_input(f"Sorry, flight {flight_num} has just sold out. Returning to main menu.", "main")
-            db.commit() # <--- Commit changes from _handle_invalid_input
-            return response
-        
-        new_seat_count = current_seats - 1
-        flight_template = all_bookings_for_flight[0]
-        
-        new_pnr_key = str(random.randint(100000, 999999))
-        while _find_pnr_info(new_pnr_key): # Ensure PNR is unique
-            new_pnr_key = str(random.randint(100000, 999999))
-        
-        new_pnr_display = flight_template.flight[:2] + new_pnr_key[2:]
-
-        new_booking = Booking(
-            pnr_key=new_pnr_key,
-            pnr_display=new_pnr_display,
-            flight=flight_num,
-            status="Confirmed",
-            route=flight_template.route,
-            time=flight_template.time,
-            seats_available=new_seat_count,
-            passenger_name=name,
-            passenger_age=age,
-            passenger_gender=gender
-        )
-        
-        for b in all_bookings_for_flight:
-            b.seats_available = new_seat_count
-            
-        db.add(new_booking)
-        
-        print(f"      *** NEW BOOKING: {new_pnr_display} for {name} on {flight_num} ***")
-        print(f"      *** SEATS UPDATED for {flight_num}: {current_seats} -> {new_seat_count} ***")
-
-        response["status"] = "call_ended"
-        response["message"] = f"Booking confirmed. Your new PNR is {new_pnr_display}. This call will now end."
-        response["call_action"] = "hangup"
-        end_call_logic(db, call.call_id, f"Booked PNR: {new_pnr_display}")
-
-
-    if response.get("status") != "transferring" and response.get("status") != "call_ended":
-        print(f"✅ ACTION: {action} - {message}")
-        db.commit() # <--- THIS IS THE FINAL SAVE for all state changes
-    
-    # end_call_logic handles its own commit, so we don't commit again
-    elif response.get("status") == "transferring" or response.get("status") == "call_ended":
-        pass 
-
-    return response
+    return await _dispatch_dtmf(call, "#", db)
 
 
 # ==================== end_call ====================
-@app.post("/ivr/end")
-def end_call(request: CallEndRequest, db: Session = Depends(get_db)): 
+@app.post("/ivr/end", response_model=CallEndResponse, response_model_exclude_unset=True)
+async def end_call(request: CallEndRequest, db: AsyncSession = Depends(get_async_db)): 
     """End call (user hung up)"""
     call_id = request.call_id
     if call_id:
-        end_call_logic(db, call_id, "Call ended by user.")
+        await end_call_logic(db, call_id, "Call ended by user.")
         return {"status": "call_ended", "call_id": call_id}
         
     return {"status": "error", "message": "Call not found"}
 
+
+# ==================== WebSocket call channel ====================
+# One connection for the whole call. Client messages:
+#   {"type": "start", "caller_number": ...}   {"type": "dtmf", "digit": ...}
+#   {"type": "dtmf_entry", "digits": ...}     {"type": "voice", "text": ...}
+#   {"type": "end"}
+# Each is answered, in order, with the body the matching HTTP endpoint would
+# return; a rejected message gets {"status": "error", "error": ..., "status_code": ...}.
+# Closing the socket mid-call hangs the call up.
+IVR_RESPONSE_ADAPTER = TypeAdapter(IvrResponse)
+WS_INPUTS = {
+    "dtmf": (DTMFInput, handle_dtmf),
+    "dtmf_entry": (DTMFEntryInput, handle_dtmf_entry),
+    "voice": (VoiceInput, handle_voice_input),
+}
+
+def _ws_error(status_code: int, detail, retry_after: Optional[str] = None) -> bytes:
+    error = {"status": "error", "error": detail, "status_code": status_code}
+    if retry_after is not None:
+        error["retry_after"] = int(retry_after)
+    return fast_json.dumps(error)
+
+async def _ws_message(channel: CallChannel, message: dict, db: AsyncSession) -> bytes:
+    kind = message.get("type") if isinstance(message, dict) else None
+    metrics.WS_MESSAGES.inc(kind if kind in WS_INPUTS or kind in ("start", "end") else "unknown")
+    try:
+        if kind == "start":
+            if channel.call is not None:
+                return _ws_error(400, "A call is already active on this connection")
+            channel.bind(await _start_call(CallStart(caller_number=message.get("caller_number")), db))
+            return _start_call_body(channel.call.call_id)
+
+        if kind not in WS_INPUTS and kind != "end":
+            return _ws_error(400, f"Unknown message type: {kind!r}")
+        if channel.call is None:
+            return _ws_error(400, "No active call on this connection")
+        call = channel.call
+
+        if kind == "end":
+            await end_call_logic(db, call.call_id, "Call ended by user.", call)
+            channel.call = None
+            return fast_json.dumps({"status": "call_ended", "call_id": call.call_id})
+
+        model, endpoint = WS_INPUTS[kind]
+        fields = {name: message[name] for name in model.model_fields if name in message}
+        input_data = model(**{**fields, "call_id": call.call_id, "current_menu": call.current_menu})
+        response = await endpoint.__wrapped__(input_data, db) # <--- The endpoint body, without its HTTP wrapper
+    except HTTPException as e:
+        return _ws_error(e.status_code, e.detail, (e.headers or {}).get("Retry-After"))
+    except ValidationError as e:
+        return _ws_error(422, e.errors(include_url=False, include_context=False))
+
+    if response.get("call_action") == "hangup":
+        channel.call = None # <--- The handler ended the call
+    body = fast_json.prepared_body(response)
+    return body if body is not None else IVR_RESPONSE_ADAPTER.dump_json(IVR_RESPONSE_ADAPTER.validate_python(response), exclude_unset=True)
+
+@app.websocket("/ivr/ws")
+async def ivr_websocket(websocket: WebSocket, db: AsyncSession = Depends(get_async_db)):
+    """start / dtmf / dtmf_entry / voice / end over one connection, with the call state bound to it."""
+    await websocket.accept()
+    channel = CallChannel()
+    call_channel.set(channel)
+    try:
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+            except ValueError:
+                body = _ws_error(400, "Messages must be JSON")
+            else:
+                # Same admission as HTTP: "start" may be refused, in-call messages queue for a slot
+                new_call = isinstance(message, dict) and message.get("type") == "start" and channel.call is None
+                try:
+                    body = await admission_controller.run(new_call, lambda: _ws_message(channel, message, db))
+                except Rejected as e:
+                    body = _ws_error(e.status_code, e.detail, e.retry_after)
+            await db.close() # <--- Like the end of an HTTP request: the pooled connection goes back
+            await websocket.send_text(body.decode())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if channel.call is not None: # <--- Hung up (or the channel failed) mid-call
+            await end_call_logic(db, channel.call.call_id, "Caller disconnected.", channel.call)
+            channel.call = None
+
@@ -0,0 +1,171 @@
+# lookup_cache.py
+# Read-through cache for PNR, flight and frequent-flyer lookups.
+#
+# The same few PNRs and flights are looked up thousands of times an hour.
+# Each lookup now goes through a bounded LRU cache whose entries also expire
+# after LOOKUP_CACHE_TTL_SECONDS:
+#
+#   bookings        pnr_key   -> BookingInfo
+#   flights         FLIGHT    -> FlightInfo      (seat count included)
+#   frequent_flyers ff_number -> FrequentFlyerInfo
+#
+# Entries are immutable snapshots, not ORM objects, so they can be shared by
+# every request. Writers invalidate exactly the keys they changed after
+# their commit (cancel_flight: the booking + its flight, confirm_booking: the
+# flight). "Not found" is never cached, so a brand-new PNR is visible at once.
+# The TTL bounds how stale another worker's cache can be.
+
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import metrics
+from database import Booking, Flight, FrequentFlyer, normalize_flight_code
+
+
+# ==================== SNAPSHOTS ====================
+class _Snapshot:
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, row):
+        snapshot = cls.__new__(cls)
+        for name in cls.__slots__:
+            object.__setattr__(snapshot, name, getattr(row, name))
+        return snapshot
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only (it is shared through the lookup cache)")
+
+
+class BookingInfo(_Snapshot):
+    __slots__ = ("pnr_key", "pnr_display", "flight", "status", "passenger_name", "passenger_age", "passenger_gender")
+
+
+class FlightInfo(_Snapshot):
+    __slots__ = ("flight", "route", "time", "status", "seats_available")
+
+
+class FrequentFlyerInfo(_Snapshot):
+    __slots__ = ("ff_number", "pin", "name", "points")
+
+
+# ==================== LRU + TTL ====================
+class LRUTTLCache:
+    """At most `maxsize` entries; an entry older than `ttl` seconds counts as a miss."""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict() # <--- key -> (expires_at, value)
+        self.epoch = 0 # <--- Bumped by every invalidation
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                metrics.LOOKUP_CACHE.inc(self.name, "hit")
+                return entry[1]
+            del self._entries[key]
+        metrics.LOOKUP_CACHE.inc(self.name, "miss")
+        return None
+
+    def put(self, key, value, epoch: Optional[int] = None) -> None:
+        """`epoch`: self.epoch from before the value was read. If anything was
+        invalidated meanwhile the value may predate that write, so it is dropped."""
+        if epoch is not None and epoch != self.epoch:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        self.epoch += 1
+        if self._entries.pop(key, None) is not None:
+            metrics.LOOKUP_CACHE_INVALIDATIONS.inc(self.name)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+flight_key = normalize_flight_code
+
+
+# ==================== LOOKUPS ====================
+class LookupCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 30.0):
+        self.bookings = LRUTTLCache("bookings", maxsize, ttl)
+        self.flights = LRUTTLCache("flights", maxsize, ttl)
+        self.frequent_flyers = LRUTTLCache("frequent_flyers", maxsize, ttl)
+
+    async def booking(self, db: AsyncSession, pnr_key: str) -> Optional[BookingInfo]:
+        info = self.bookings.get(pnr_key)
+        if info is None:
+            epochs = self.bookings.epoch, self.flights.epoch
+            row = (await db.execute(select(Booking).filter(Booking.pnr_key == pnr_key))).scalars().first()
+            if row is None:
+                return None
+            info = BookingInfo.from_row(row)
+            self.bookings.put(pnr_key, info, epochs[0])
+            if row.flight_info is not None:
+                self.flights.put(flight_key(row.flight), FlightInfo.from_row(row.flight_info), epochs[1]) # <--- Came with the join
+        return info
+
+    async def flight(self, db: AsyncSession, flight_code: str) -> Optional[FlightInfo]:
+        key = flight_key(flight_code)
+        info = self.flights.get(key)
+        if info is None:
+            epoch = self.flights.epoch
+            row = (await db.execute(select(Flight).filter(Flight.flight_code == key))).scalars().first() # <--- Index probe
+            if row is None:
+                return None
+            info = FlightInfo.from_row(row)
+            self.flights.put(key, info, epoch)
+        return info
+
+    async def frequent_flyer(self, db: AsyncSession, ff_number: str) -> Optional[FrequentFlyerInfo]:
+        info = self.frequent_flyers.get(ff_number)
+        if info is None:
+            row = (await db.execute(select(FrequentFlyer).filter(FrequentFlyer.ff_number == ff_number))).scalars().first()
+            if row is None:
+                return None
+            info = FrequentFlyerInfo.from_row(row)
+            self.frequent_flyers.put(ff_number, info)
+        return info
+
+    # ---------- Writes (call after the commit) ----------
+    def invalidate_booking(self, pnr_key: str) -> None:
+        self.bookings.invalidate(pnr_key)
+
+    def invalidate_flight(self, flight_code: str) -> None:
+        self.flights.invalidate(flight_key(flight_code))
+
+    def clear(self) -> None:
+        self.bookings.clear()
+        self.flights.clear()
+        self.frequent_flyers.clear()
+
+    async def warm(self, session_factory) -> int:
+        """Loads every flight (a small table). Returns the number of entries added."""
+        async with session_factory() as db:
+            rows = (await db.execute(select(Flight))).scalars().all()
+        for row in rows:
+            self.flights.put(flight_key(row.flight), FlightInfo.from_row(row))
+        return len(rows)
+
+
+def create_lookup_cache() -> LookupCache:
+    return LookupCache(
+        maxsize=int(os.environ.get("LOOKUP_CACHE_SIZE", "10000")),
+        ttl=float(os.environ.get("LOOKUP_CACHE_TTL_SECONDS", "30")),
+    )
@@ -0,0 +1,160 @@
+# menu_graph.py
+# MENU_STRUCTURE compiled into an immutable state-machine graph.
+#
+# The menu dict stays the place where flows are written. At startup it is
+# compiled once into MenuNode/MenuOption objects with their action handler
+# already resolved, so a keypress is two dict lookups and one call:
+#
+#   node = graph.nodes[call.current_menu]
+#   option = node.options[digit]
+#   response = await option.handler(call, option, db, response)
+#
+# Compilation fails fast (MenuGraphError) on a target menu that doesn't
+# exist, a menu no caller can reach, or an action with no handler.
+
+from types import MappingProxyType
+from typing import Callable, Dict, Iterable, Mapping, Optional, Tuple
+
+
+class MenuGraphError(ValueError):
+    """MENU_STRUCTURE does not describe a valid call flow."""
+
+
+# ==================== HANDLER REGISTRY ====================
+class ActionRegistry:
+    """Action name -> async handler, plus the menus each handler can move a call to."""
+
+    def __init__(self):
+        self.handlers: Dict[str, Callable] = {}
+        self.targets: Dict[str, Tuple[str, ...]] = {}
+
+    def register(self, action: str, targets: Iterable[str] = ()):
+        """
+        Decorator. `targets` lists the menus the handler itself sends calls to
+        (not counting the option's own "target"), so they count as reachable.
+        """
+        def decorator(handler):
+            if action in self.handlers:
+                raise MenuGraphError(f"Action '{action}' registered twice")
+            self.handlers[action] = handler
+            self.targets[action] = tuple(targets)
+            return handler
+        return decorator
+
+
+# ==================== GRAPH NODES ====================
+class _Frozen:
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+
+class MenuOption(_Frozen):
+    """One key of one menu."""
+
+    __slots__ = ("menu", "digit", "action", "handler", "target", "message", "params")
+
+    def __init__(self, menu: str, digit: str, spec: dict, handler: Callable):
+        extra = {k: v for k, v in spec.items() if k not in ("action", "target", "message")}
+        for name, value in (
+            ("menu", menu), ("digit", digit), ("action", spec["action"]), ("handler", handler),
+            ("target", spec.get("target")), ("message", spec.get("message", "")),
+            ("params", MappingProxyType(extra)), # <--- e.g. "gender", "keywords"
+        ):
+            object.__setattr__(self, name, value)
+
+
+class MenuNode(_Frozen):
+    """One menu: its prompt, its keys and how many digits it collects before '#'."""
+
+    # input_length: None = no keypad entry, -1 = variable length, N = exactly N digits
+    __slots__ = ("name", "prompt", "input_length", "options", "valid_options")
+
+    def __init__(self, name: str, prompt: str, input_length: Optional[int], options: Dict[str, MenuOption]):
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "prompt", prompt)
+        object.__setattr__(self, "input_length", input_length)
+        object.__setattr__(self, "options", MappingProxyType(options))
+        object.__setattr__(self, "valid_options", tuple(options))
+
+
+class MenuGraph(_Frozen):
+    """Every menu of the IVR, by name."""
+
+    __slots__ = ("root", "nodes")
+
+    def __init__(self, root: str, nodes: Dict[str, MenuNode]):
+        object.__setattr__(self, "root", root)
+        object.__setattr__(self, "nodes", MappingProxyType(nodes))
+
+    def __getitem__(self, name: str) -> MenuNode:
+        return self.nodes[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self.nodes
+
+    def get(self, name: str) -> Optional[MenuNode]:
+        return self.nodes.get(name)
+
+
+# ==================== COMPILER ====================
+def compile_menu_graph(
+    menu_structure: Mapping[str, dict],
+    registry: ActionRegistry,
+    input_lengths: Optional[Mapping[str, int]] = None,
+    root: str = "main",
+    extra_edges: Optional[Mapping[str, Iterable[str]]] = None,
+) -> MenuGraph:
+    """
+    Validates MENU_STRUCTURE and compiles it into a MenuGraph.
+    `extra_edges` are transitions made outside the option table (e.g. a
+    voice-only step), so their targets count as reachable too.
+    """
+    input_lengths = input_lengths or {}
+    extra_edges = extra_edges or {}
+    errors = []
+
+    if root not in menu_structure:
+        raise MenuGraphError(f"Root menu '{root}' is not defined")
+    for name in list(input_lengths) + list(extra_edges):
+        if name not in menu_structure:
+            errors.append(f"Unknown menu '{name}' in input lengths / extra edges")
+
+    nodes = {}
+    edges = {name: set() for name in menu_structure}
+    for name, menu in menu_structure.items():
+        options = {}
+        for digit, spec in menu["options"].items():
+            action = spec.get("action")
+            handler = registry.handlers.get(action)
+            if handler is None:
+                errors.append(f"{name}[{digit}]: no handler registered for action '{action}'")
+                continue
+            for target in ((spec["target"],) if "target" in spec else ()) + registry.targets[action]:
+                if target not in menu_structure:
+                    errors.append(f"{name}[{digit}]: action '{action}' targets unknown menu '{target}'")
+                else:
+                    edges[name].add(target)
+            options[digit] = MenuOption(name, digit, spec, handler)
+        for target in extra_edges.get(name, ()):
+            if target not in menu_structure:
+                errors.append(f"{name}: extra edge targets unknown menu '{target}'")
+            else:
+                edges[name].add(target)
+        nodes[name] = MenuNode(name, menu["prompt"], input_lengths.get(name), options)
+
+    # Walk from the root; anything not visited can never be heard by a caller
+    reachable, pending = {root}, [root]
+    while pending:
+        for target in edges[pending.pop()]:
+            if target not in reachable:
+                reachable.add(target)
+                pending.append(target)
+    for name in menu_structure:
+        if name not in reachable:
+            errors.append(f"Menu '{name}' is unreachable from '{root}'")
+
+    if errors:
+        raise MenuGraphError("Invalid MENU_STRUCTURE:\n  " + "\n  ".join(errors))
+    return MenuGraph(root, nodes)
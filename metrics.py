@@ -0,0 +1,225 @@
+# metrics.py
+# In-process metrics, rendered in the Prometheus text format at /metrics.
+#
+# No client library and no push gateway: counters, gauges and histograms are
+# plain dicts keyed by label values, updated under a per-metric lock, and
+# turned into text only when something scrapes /metrics.
+#
+#   ivr_http_request_duration_seconds   per endpoint (route template), method, status
+#   ivr_menu_inputs_total               key presses accepted, per menu
+#   ivr_actions_total                   actions run, per menu and action
+#   ivr_nlu_duration_seconds            voice NLU time, result=match|miss
+#   ivr_sql_statement_duration_seconds  per statement kind and table (database.py hooks)
+#   ivr_db_pool_checkout_wait_seconds   time spent waiting for a pooled connection
+#   ivr_db_pool_waiting / _checked_out  pool gauges
+#   ivr_lookup_cache_*                  lookup cache hits / misses / invalidations
+#   ivr_ws_messages_total               /ivr/ws messages, per type
+#   ivr_active_calls                    live calls in the call-state store
+
+import bisect
+import threading
+import time
+from typing import Dict, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. Most IVR requests are sub-millisecond to a few ms; the tail is DB-bound.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, by: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + by
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, *labels) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, by: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + by
+
+    def dec(self, *labels, by: float = 1) -> None:
+        self.inc(*labels, by=-by)
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple, list] = {} # <--- labels -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, *labels) -> int:
+        series = self._values.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = self._header()
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(series[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> None:
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+# ==================== IVR METRICS ====================
+HTTP_LATENCY = Histogram(
+    "ivr_http_request_duration_seconds", "Request latency per endpoint.", ("endpoint", "method", "status"))
+MENU_INPUTS = Counter(
+    "ivr_menu_inputs_total", "Option keys accepted, per menu.", ("menu",))
+ACTIONS = Counter(
+    "ivr_actions_total", "Menu actions run, per menu and action.", ("menu", "action"))
+NLU_LATENCY = Histogram(
+    "ivr_nlu_duration_seconds", "Time spent understanding one voice input.", ("result",),
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+SQL_LATENCY = Histogram(
+    "ivr_sql_statement_duration_seconds", "SQL statement execution time.", ("statement", "table"))
+POOL_CHECKOUT_WAIT = Histogram(
+    "ivr_db_pool_checkout_wait_seconds", "Time spent waiting for a pooled DB connection.", ("engine",))
+POOL_WAITING = Gauge(
+    "ivr_db_pool_waiting", "Checkouts currently waiting for a pooled DB connection.", ("engine",))
+POOL_CHECKED_OUT = Gauge(
+    "ivr_db_pool_checked_out", "DB connections currently checked out of the pool.", ("engine",))
+LOOKUP_CACHE = Counter(
+    "ivr_lookup_cache_requests_total", "PNR / flight / frequent-flyer cache reads, per cache and hit|miss.", ("cache", "result"))
+LOOKUP_CACHE_INVALIDATIONS = Counter(
+    "ivr_lookup_cache_invalidations_total", "Cache entries dropped because the row changed.", ("cache",))
+WS_MESSAGES = Counter(
+    "ivr_ws_messages_total", "Messages received on /ivr/ws call channels, per type.", ("type",))
+ACTIVE_CALLS = Gauge(
+    "ivr_active_calls", "Live calls in the call-state store.")
+IN_FLIGHT = Gauge(
+    "ivr_in_flight_requests", "IVR requests currently holding an admission slot in this worker.")
+ADMISSION_REJECTED = Counter(
+    "ivr_admission_rejected_total", "Requests turned away by admission control, per reason.", ("reason",))
+PROFILES = Counter(
+    "ivr_profiles_captured_total", "Requests profiled, per trigger (header|sampled).", ("trigger",))
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# ==================== HTTP TIMING ====================
+class MetricsMiddleware:
+    """Plain ASGI middleware (no BaseHTTPMiddleware overhead) timing every HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            # Route template, not the raw path, so the label set stays small
+            endpoint = getattr(route, "path", None) or "(unmatched)"
+            HTTP_LATENCY.observe(time.perf_counter() - started, endpoint, scope["method"], status[0])
@@ -0,0 +1,211 @@
+# nlu.py
+# Speech-to-data extraction for the voice (NLU) layer.
+#
+# Everything here is built once at import time. Utterances are tokenized in a
+# single regex pass and number words are mapped token by token, so "two" is
+# never mangled by the filler "to" and "phone" never turns into "ph1".
+
+import re
+from typing import List, Optional
+
+# ==================== VOCABULARY ====================
+FILLER_WORDS = frozenset([
+    'my', 'is', 'uh', 'um', 'please', 'can', 'get', 'space', 'dot', 'dash', 'want', 'to', 'like'
+])
+
+DIGIT_WORDS = {
+    "zero": "0", "one": "1", "two": "2", "three": "3", "four": "4",
+    "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9"
+}
+
+TEEN_WORDS = {
+    "ten": 10, "eleven": 11, "twelve": 12, "thirteen": 13, "fourteen": 14, "fifteen": 15,
+    "sixteen": 16, "seventeen": 17, "eighteen": 18, "nineteen": 19
+}
+
+TENS_WORDS = {
+    "twenty": 20, "thirty": 30, "forty": 40, "fifty": 50,
+    "sixty": 60, "seventy": 70, "eighty": 80, "ninety": 90
+}
+
+# "oh" is only a zero inside a spoken number ("two oh four"), never on its own ("oh, my PNR is ...")
+SPOKEN_ZERO = "oh"
+
+# Phone keypad letters, so "AI1234" can be said as letters + digits
+KEYPAD_LETTERS = {
+    'a': '2', 'b': '2', 'c': '2', 'd': '3', 'e': '3', 'f': '3',
+    'g': '4', 'h': '4', 'i': '4', 'j': '5', 'k': '5', 'l': '5',
+    'm': '6', 'n': '6', 'o': '6', 'p': '7', 'q': '7', 'r': '7', 's': '7',
+    't': '8', 'u': '8', 'v': '8', 'w': '9', 'x': '9', 'y': '9', 'z': '9'
+}
+
+# Extra words to drop per entry type, on top of FILLER_WORDS
+PNR_STOP_WORDS = FILLER_WORDS | {'pnr', 'number'}
+FLIGHT_STOP_WORDS = FILLER_WORDS | {'flight', 'book', 'number'}
+AGE_STOP_WORDS = FILLER_WORDS | {'age', 'years', 'old'}
+NAME_STOP_WORDS = FILLER_WORDS | {'name'}
+FF_STOP_WORDS = FILLER_WORDS | {'number'}
+PIN_STOP_WORDS = FILLER_WORDS | {'pin'}
+
+# ==================== PRECOMPILED PATTERNS ====================
+TOKEN_RE = re.compile(r"[a-z]+|\d+")
+NAME_TOKEN_RE = re.compile(r"[a-z][a-z.'\-]*") # <--- Keeps "F." and "Al-Jaber" intact
+SIX_DIGITS_RE = re.compile(r"\d{6}")
+NINE_DIGITS_RE = re.compile(r"\d{9}")
+FOUR_DIGITS_RE = re.compile(r"\d{4}")
+FLIGHT_CODE_RE = re.compile(r"[a-z0-9]{2}\d{2,4}")
+NON_DIGITS_RE = re.compile(r"\D+")
+
+
+# ==================== TOKENIZER ====================
+def tokenize(text: str) -> List[str]:
+    """Lowercases and splits an utterance into word and digit-run tokens."""
+    return TOKEN_RE.findall(text.lower())
+
+
+def _is_digit_token(token: str) -> bool:
+    return token.isdigit() or token in DIGIT_WORDS
+
+
+def _in_digit_run(tokens: List[str], i: int) -> bool:
+    """True if the run of "oh"s around tokens[i] touches a digit ("oh oh seven", "two oh four")."""
+    before, after = i - 1, i + 1
+    while before >= 0 and tokens[before] == SPOKEN_ZERO:
+        before -= 1
+    while after < len(tokens) and tokens[after] == SPOKEN_ZERO:
+        after += 1
+    return (before >= 0 and _is_digit_token(tokens[before])) or (after < len(tokens) and _is_digit_token(tokens[after]))
+
+
+def _digits_and_words(text: str, stop_words) -> List[str]:
+    """Tokens minus stop words, with single-digit number words mapped to digits."""
+    tokens = tokenize(text)
+    kept = []
+    for i, token in enumerate(tokens):
+        if token in stop_words:
+            continue
+        if token == SPOKEN_ZERO:
+            if _in_digit_run(tokens, i):
+                kept.append("0")
+            continue # <--- A bare "oh" is an interjection, not a digit or letters
+        kept.append(DIGIT_WORDS.get(token, token))
+    return kept
+
+
+# ==================== EXTRACTORS ====================
+def extract_pnr(text: str) -> Optional[str]:
+    """Spoken PNR -> 6-digit key. Letters map through the phone keypad ("ai1234" -> "241234")."""
+    alphanumeric = "".join(_digits_and_words(text, PNR_STOP_WORDS))
+
+    if len(alphanumeric) == 6:
+        return "".join(KEYPAD_LETTERS.get(char, char) for char in alphanumeric)
+
+    digit_match = SIX_DIGITS_RE.search(alphanumeric)
+    return digit_match.group(0) if digit_match else None
+
+
+def extract_flight_number(text: str) -> Optional[str]:
+    """Spoken flight -> code such as "6E204". Bare digits get the AI prefix ("one zero one" -> "AI101")."""
+    cleaned = "".join(_digits_and_words(text, FLIGHT_STOP_WORDS))
+
+    flight_match = FLIGHT_CODE_RE.search(cleaned)
+    if flight_match:
+        return flight_match.group(0).upper()
+
+    digits = NON_DIGITS_RE.sub("", cleaned)
+    return "AI" + digits if digits else None
+
+
+def extract_age(text: str) -> Optional[int]:
+    """Spoken age -> int in 1..119. Understands digits and words ("forty five" -> 45)."""
+    tokens = [token for token in tokenize(text) if token not in AGE_STOP_WORDS]
+    for i, token in enumerate(tokens):
+        if token.isdigit():
+            age = int(token[:3])
+        elif token in TENS_WORDS:
+            age = TENS_WORDS[token]
+            following = tokens[i + 1] if i + 1 < len(tokens) else None
+            if following in DIGIT_WORDS and following != "zero":
+                age += int(DIGIT_WORDS[following])
+        elif token in TEEN_WORDS:
+            age = TEEN_WORDS[token]
+        elif token in DIGIT_WORDS:
+            age = int(DIGIT_WORDS[token])
+        else:
+            continue
+        if 0 < age < 120:
+            return age # <--- Out of range ("I'm 200, I mean 40"): keep looking
+    return None
+
+
+def extract_name(text: str) -> str:
+    """Spoken passenger name, title-cased, with filler words removed."""
+    words = [word for word in NAME_TOKEN_RE.findall(text.lower()) if word.strip(".'-") not in NAME_STOP_WORDS]
+    return " ".join(words).title()
+
+
+def extract_ff_number(text: str) -> Optional[str]:
+    """Spoken Flying Returns number -> 9 digits."""
+    digits = "".join(t for t in _digits_and_words(text, FF_STOP_WORDS) if t.isdigit())
+    match = NINE_DIGITS_RE.search(digits)
+    return match.group(0) if match else None
+
+
+def extract_pin(text: str) -> Optional[str]:
+    """Spoken PIN -> 4 digits."""
+    digits = "".join(t for t in _digits_and_words(text, PIN_STOP_WORDS) if t.isdigit())
+    match = FOUR_DIGITS_RE.search(digits)
+    return match.group(0) if match else None
+
+
+# ==================== INTENT INDEX ====================
+# Built once from the "keywords" declared on MENU_STRUCTURE options:
+#   keyword -> {menu_name: (rank, digit)}
+# Lower rank wins when one utterance matches several options of a menu:
+#   0 = options marked "global" (offered in every menu, e.g. "agent")
+#   1 = the "*" option (go back / main menu)
+#   2 = everything else, in the order the options are declared
+def build_intent_index(menu_structure: dict):
+    """Returns (index, max_keyword_words) for resolve_intent."""
+    index = {}
+    max_words = 1
+
+    def add(keyword, menu_name, rank, digit):
+        nonlocal max_words
+        words = tokenize(keyword)
+        if not words:
+            raise ValueError(f"Empty keyword on menu '{menu_name}', option '{digit}'")
+        max_words = max(max_words, len(words))
+        entry = index.setdefault(" ".join(words), {})
+        if menu_name not in entry or rank < entry[menu_name][0]:
+            entry[menu_name] = (rank, digit)
+
+    for menu_name, menu in menu_structure.items():
+        for position, (digit, option) in enumerate(menu["options"].items()):
+            keywords = option.get("keywords", ())
+            if option.get("global"):
+                for keyword in keywords:
+                    for any_menu in menu_structure:
+                        add(keyword, any_menu, (0, position), digit)
+                continue
+            tier = 1 if digit == "*" else 2
+            for keyword in keywords:
+                add(keyword, menu_name, (tier, position), digit)
+
+    return index, max_words
+
+
+def resolve_intent(intent_index, text: str, menu_name: str) -> Optional[str]:
+    """Maps an utterance to the digit to press in menu_name, or None."""
+    index, max_words = intent_index
+    tokens = tokenize(text)
+    best = None
+    for size in range(1, max_words + 1):
+        for start in range(len(tokens) - size + 1):
+            match = index.get(" ".join(tokens[start:start + size]))
+            if match is None:
+                continue
+            candidate = match.get(menu_name)
+            if candidate and (best is None or candidate[0] < best[0]):
+                best = candidate
+    return best[1] if best else None
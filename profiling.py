@@ -0,0 +1,197 @@
+# profiling.py
+# Opt-in cProfile capture of single requests.
+#
+# Off unless PROFILE_ENABLED=true. Then an /ivr/ HTTP request is profiled when
+#
+#   header   : it carries X-IVR-Profile: <PROFILE_ADMIN_TOKEN>
+#   sampled  : a PROFILE_SAMPLE_RATE share of requests (0.0 - 1.0) is picked
+#
+# One request per worker is profiled at a time (cProfile sees the whole event
+# loop thread, so two overlapping profiles would be the same profile); a
+# request picked while another one is being profiled just runs normally.
+# Work handed to other threads (the async DB driver) shows up as time spent
+# awaiting it.
+#
+# Each profile is a pstats file plus a small JSON sidecar with the call_id,
+# menu and action the handlers tagged it with. Files live in PROFILE_DIR, a
+# ring buffer of the newest PROFILE_MAX_FILES profiles (shared by the
+# workers on the host). A profiled response carries X-IVR-Profile-Id, and
+# /admin/profiles lists and serves them (with X-Admin-Token).
+
+import asyncio
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+import metrics
+from ivr_logging import get_logger
+
+log = get_logger("app")
+
+TRIGGER_HEADER = b"x-ivr-profile"
+PROFILE_ID_HEADER = b"x-ivr-profile-id"
+PROFILE_ID_PATTERN = re.compile(r"\d+-\d+")
+
+_tags: ContextVar[Optional[dict]] = ContextVar("profile_tags", default=None)
+
+
+def tag(**tags) -> None:
+    """Labels the profile of the current request (a no-op when it isn't being profiled)."""
+    current = _tags.get()
+    if current is not None:
+        current.update(tags)
+
+
+class RequestProfiler:
+    def __init__(self, directory: str, enabled: bool = False, sample_rate: float = 0.0,
+                 max_files: int = 200, token: str = ""):
+        self.directory = directory
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.token = token
+        self._active = False
+        self._random = random.random
+
+    # ---------- Picking requests ----------
+    def trigger(self, scope) -> Optional[str]:
+        """'header', 'sampled' or None for this request."""
+        if not self.enabled or self._active:
+            return None
+        if self.token:
+            for name, value in scope.get("headers", ()):
+                if name == TRIGGER_HEADER:
+                    return "header" if hmac.compare_digest(value, self.token.encode("utf-8")) else None
+        if self.sample_rate > 0 and self._random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def authorized(self, token: Optional[str]) -> bool:
+        return bool(self.token) and token is not None and hmac.compare_digest(token.encode("utf-8"), self.token.encode("utf-8"))
+
+    # ---------- Capturing ----------
+    async def run(self, scope, trigger: str, handler) -> None:
+        profile_id = f"{time.time_ns()}-{os.getpid()}"
+        tags = {}
+        context_token = _tags.set(tags)
+        profile = cProfile.Profile()
+        self._active = True
+        started_at, started = time.time(), time.perf_counter()
+        profile.enable()
+        try:
+            await handler(profile_id)
+        finally:
+            profile.disable()
+            self._active = False
+            _tags.reset(context_token)
+            meta = {
+                "id": profile_id, "path": scope.get("path"), "method": scope.get("method"), "trigger": trigger,
+                "started_at": started_at,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+                "call_id": tags.get("call_id"), "menu": tags.get("menu"), "action": tags.get("action"),
+            }
+            metrics.PROFILES.inc(trigger)
+            try:
+                await asyncio.to_thread(self._store, profile, meta)
+            except OSError as e:
+                log.warning("profile_store_failed", extra={"error": str(e)})
+
+    # ---------- Ring buffer ----------
+    def _path(self, profile_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.{suffix}")
+
+    def _store(self, profile: cProfile.Profile, meta: dict) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        profile.dump_stats(self._path(meta["id"], "prof"))
+        with open(self._path(meta["id"], "json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        ids = self._ids()
+        for stale in ids[:max(0, len(ids) - self.max_files)]:
+            for suffix in ("prof", "json"):
+                try:
+                    os.remove(self._path(stale, suffix))
+                except FileNotFoundError:
+                    pass # <--- Another worker got there first
+
+    def _ids(self) -> List[str]:
+        """Stored profile IDs, oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        ids = [name[:-5] for name in names if name.endswith(".json") and PROFILE_ID_PATTERN.fullmatch(name[:-5])]
+        return sorted(ids, key=lambda profile_id: int(profile_id.split("-")[0]))
+
+    def list(self, call_id: str = None, menu: str = None, action: str = None) -> List[dict]:
+        """Stored profiles' metadata, newest first, optionally filtered."""
+        found = []
+        for profile_id in reversed(self._ids()):
+            try:
+                with open(self._path(profile_id, "json"), encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if all(wanted is None or meta.get(key) == wanted
+                   for key, wanted in (("call_id", call_id), ("menu", menu), ("action", action))):
+                found.append(meta)
+        return found
+
+    def profile_path(self, profile_id: str) -> Optional[str]:
+        if not PROFILE_ID_PATTERN.fullmatch(profile_id):
+            return None # <--- Never turn a request path into an arbitrary file name
+        path = self._path(profile_id, "prof")
+        return path if os.path.exists(path) else None
+
+    def summary(self, profile_id: str, limit: int = 40, sort: str = "cumulative") -> Optional[str]:
+        """pstats text report of one profile."""
+        path = self.profile_path(profile_id)
+        if path is None:
+            return None
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).strip_dirs().sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+def create_profiler() -> RequestProfiler:
+    return RequestProfiler(
+        os.environ.get("PROFILE_DIR", "./ivr_profiles"),
+        enabled=os.environ.get("PROFILE_ENABLED", "false").lower() == "true",
+        sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", "0")),
+        max_files=int(os.environ.get("PROFILE_MAX_FILES", "200")),
+        token=os.environ.get("PROFILE_ADMIN_TOKEN", ""),
+    )
+
+
+# ==================== HTTP ====================
+class ProfilingMiddleware:
+    """Plain ASGI middleware: runs picked /ivr/ requests under cProfile and tags the response with the profile ID."""
+
+    def __init__(self, app, profiler):
+        self.app = app
+        self.profiler = profiler # <--- Looked up per request, so tests / reloads can swap it
+
+    async def __call__(self, scope, receive, send):
+        profiler = self.profiler()
+        trigger = None
+        if scope["type"] == "http" and scope.get("path", "").startswith("/ivr/"):
+            trigger = profiler.trigger(scope)
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def handler(profile_id):
+            async def send_with_id(message):
+                if message["type"] == "http.response.start":
+                    message = {**message, "headers": [*message.get("headers", ()), (PROFILE_ID_HEADER, profile_id.encode())]}
+                await send(message)
+            await self.app(scope, receive, send_with_id)
+
+        await profiler.run(scope, trigger, handler)
@@ -0,0 +1,50 @@
+# stats.py
+# Cheap stats for /stats and the health endpoints.
+#
+# Totals live in the stat_counters table and are bumped by the handlers in
+# the same transaction as the event (call start, call end, booking,
+# cancellation). Reading them never scans call_history or bookings, and the
+# result is cached in-process for STATS_CACHE_SECONDS.
+
+import time
+from typing import Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import StatCounter, STAT_COUNTER_BASELINES
+
+STAT_NAMES = tuple(STAT_COUNTER_BASELINES)
+
+
+async def bump(db: AsyncSession, name: str, by: int = 1) -> None:
+    """Adds `by` to a counter. Does not commit: the caller's commit carries it."""
+    result = await db.execute(
+        update(StatCounter).where(StatCounter.name == name).values(value=StatCounter.value + by)
+    )
+    if result.rowcount == 0:
+        # init_stat_counters() hasn't run on this database (e.g. a fresh test DB)
+        db.add(StatCounter(name=name, value=by))
+
+
+class StatsCache:
+    """Counter snapshot shared by every request of this process, refreshed at most once per TTL."""
+
+    def __init__(self, ttl: float = 5.0):
+        self.ttl = ttl
+        self._snapshot: Optional[dict] = None
+        self._expires_at = 0.0
+
+    def invalidate(self) -> None:
+        self._expires_at = 0.0
+
+    async def get(self, db: AsyncSession) -> dict:
+        now = time.monotonic()
+        if self._snapshot is None or now >= self._expires_at:
+            rows = (await db.execute(select(StatCounter.name, StatCounter.value))).all()
+            counters = dict.fromkeys(STAT_NAMES, 0)
+            counters.update({name: value for name, value in rows})
+            counters["active_calls"] = counters["calls_started"] - counters["calls_ended"]
+            self._snapshot = {"counters": counters, "refreshed_at": time.time()}
+            self._expires_at = now + self.ttl
+        return self._snapshot
@@ -4,34 +4,39 @@
 import os
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select, text
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool # <--- NEW IMPORT
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
 
 # --- CRITICAL: Set TESTING env var BEFORE importing the app ---
 os.environ["TESTING"] = "true" 
 
 # --- Import from your project files ---
-from ivr_simulator_backend import app, MOCK_PNR_DB, MOCK_FF_DB
-from database import Base, get_db, Booking, FrequentFlyer, CallHistory
+from ivr_simulator_backend import app, MOCK_FLIGHT_DB, MOCK_PNR_DB, MOCK_FF_DB, call_state_flusher, history_writer, stats_cache, lookup_cache, admission_controller
+from database import Base, get_db, get_async_db, Flight, Booking, FrequentFlyer, CallHistory, CallEvent, CallArchive, StatCounter, IdBlock, init_stat_counters, instrument_engine, timed_pool, DATABASE_URL, ASYNC_DATABASE_URL
 
 # =================================================================
 # ##### !!!!! THIS IS THE CORRECT, ISOLATED TEST DB SETUP !!!!! #####
 # =================================================================
 
-# 1. Use a Static Connection Pool for the in-memory database
-# This ensures all tests use the SAME connection, so the tables are not lost.
-engine = create_engine(
-    "sqlite:///:memory:",
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
-)
+# 1. Point both engines at the SAME throwaway SQLite file.
+# The seeding code below is sync, the endpoints are async, and an
+# in-memory database can't be shared between the two drivers.
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# 2. Create tables ONCE on this engine
+# NullPool: the TestClient runs each test on its own event loop, so
+# async connections must not be pooled across tests.
+async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=timed_pool(NullPool, "async"))
+instrument_engine(async_engine.sync_engine, "async") # <--- Same /metrics hooks as the app's engine
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+# 2. Create fresh tables ONCE on this database
+Base.metadata.drop_all(bind=engine)
 Base.metadata.create_all(bind=engine)
 
-# 3. Define a function to OVERRIDE the app's 'get_db' dependency
+# 3. Define functions to OVERRIDE the app's 'get_db' dependencies
 def override_get_db():
     try:
         db = TestingSessionLocal()
@@ -39,8 +44,13 @@ def override_get_db():
     finally:
         db.close()
 
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
 # 4. TELL THE APP to use our test database instead of its own
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 
 # =================================================================
 # --- Pytest Fixture ---
@@ -51,6 +61,13 @@ def populate_db():
     
     print("\n--- Populating in-memory test database... ---")
     try:
+        # Manually populate Flights (before the bookings that reference them)
+        if db.query(Flight).count() == 0:
+            print("Populating test Flights table...")
+            for key, data in MOCK_FLIGHT_DB.items():
+                db.add(Flight(flight=key, **data))
+            db.commit()
+
         # Manually populate Bookings
         if db.query(Booking).count() == 0:
             print("Populating test Bookings (PNR) table...")
@@ -66,6 +83,8 @@ def populate_db():
                 db_ff = FrequentFlyer(ff_number=key, **data)
                 db.add(db_ff)
             db.commit()
+
+        init_stat_counters(engine) # <--- Counters start from the seeded data
         print("--- Test database population complete. ---")
     except Exception as e:
         print(f"Error populating test DB: {e}")
@@ -82,15 +101,23 @@ def populate_db():
 def client():
     # We create a new TestClient for each test
     # It will use the override_get_db and the populated DB
+    stats_cache.invalidate() # <--- Don't serve counters cached by an earlier test
+    lookup_cache.clear()
+    if admission_controller.rate_limiter is not None:
+        admission_controller.rate_limiter.reset() # <--- Every test starts with full caller buckets
     with TestClient(app) as c:
         yield c
         
     # After each test, we clear the CallHistory table
     # so tests don't affect each other
     db = TestingSessionLocal()
+    db.query(CallEvent).delete()
     db.query(CallHistory).delete()
+    db.query(CallArchive).delete()
+    db.query(StatCounter).delete() # <--- Counters are rebuilt from what's left
     db.commit()
     db.close()
+    init_stat_counters(engine)
 
 
 ### 🌎 BASIC TESTS ###
@@ -121,6 +148,56 @@ def test_start_call(client):
     health_resp = client.get("/")
     assert health_resp.json()["live_active_calls_in_db"] == 1
 
+def test_liveness_and_readiness_probes(client):
+    assert client.get("/healthz").json() == {"status": "ok"}
+    ready = client.get("/readyz")
+    assert ready.status_code == 200
+    assert ready.json()["status"] == "ready"
+
+def test_stats_counters_are_maintained_and_cached(client):
+    before = client.get("/stats").json()
+    db = TestingSessionLocal()
+    assert before["bookings"] == db.query(Booking).count()
+    db.close()
+
+    call_id = client.post("/ivr/start", json={"caller_number": "+1Stats"}).json()["call_id"]
+    assert client.get("/stats").json()["calls_started"] == before["calls_started"] # <--- Still cached
+
+    stats_cache.invalidate()
+    during = client.get("/stats").json()
+    assert during["calls_started"] == before["calls_started"] + 1
+    assert during["active_calls"] == before["active_calls"] + 1
+
+    client.post("/ivr/end", json={"call_id": call_id})
+    client.portal.call(history_writer.drain) # <--- Call ends are committed in the background
+    stats_cache.invalidate()
+    after = client.get("/stats").json()
+    assert after["calls_ended"] == before["calls_ended"] + 1
+    assert after["active_calls"] == before["active_calls"]
+
+def test_metrics_endpoint_exposes_prometheus_text(client):
+    call_id = client.post("/ivr/start", json={"caller_number": "+1Metrics"}).json()["call_id"]
+    client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "1", "current_menu": "main"})
+    client.post("/ivr/process_voice", json={"call_id": call_id, "text": "two four one two three four", "current_menu": "flight_status_pnr"})
+    client.post("/ivr/start", json={"caller_number": "+1Metrics"})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+
+    def sample(prefix):
+        return [float(line.rsplit(" ", 1)[1]) for line in lines if line.startswith(prefix)]
+
+    assert "# TYPE ivr_http_request_duration_seconds histogram" in lines
+    assert sample('ivr_http_request_duration_seconds_count{endpoint="/ivr/start",method="POST",status="200"}')[0] >= 2
+    assert sample('ivr_menu_inputs_total{menu="main"}')[0] >= 1
+    assert sample('ivr_actions_total{menu="main",action="goto_menu"}')[0] >= 1
+    assert sample('ivr_nlu_duration_seconds_count{result="match"}')[0] >= 1
+    assert sample('ivr_sql_statement_duration_seconds_count{statement="INSERT",table="call_history"}')[0] >= 2
+    assert sample('ivr_db_pool_checkout_wait_seconds_count{engine="async"}')[0] >= 1
+    assert sample("ivr_active_calls ")[0] >= 2
+
 ### 📞 DTMF (KEYPAD) FLOW TESTS ###
 
 def test_dtmf_flow_get_pnr_status(client):
@@ -225,4 +302,1021 @@ def test_nlu_flow_cancel_flight(client):
     # 5. Check result
     assert data_cancel["status"] == "call_ended"
     assert data_cancel["call_action"] == "hangup"
-    assert "has been successfully cancelled" in data_cancel["message"]
\ No newline at end of file
+    assert "has been successfully cancelled" in data_cancel["message"]
+
+### 🗄️ DATABASE LAYER TESTS ###
+
+def test_async_url_uses_async_drivers():
+    """The async engine must never fall back to a blocking driver"""
+    from database import to_async_url
+    assert to_async_url("sqlite:///./ivr.db") == "sqlite+aiosqlite:///./ivr.db"
+    assert to_async_url("postgresql://u:p@host:5432/ivr") == "postgresql+asyncpg://u:p@host:5432/ivr"
+    assert to_async_url("postgresql+psycopg2://u:p@host/ivr") == "postgresql+asyncpg://u:p@host/ivr"
+
+
+def _query_plan(bind, statement):
+    """EXPLAIN output of a SQLAlchemy statement, one string per plan line."""
+    sql = str(statement.compile(bind, compile_kwargs={"literal_binds": True}))
+    with bind.connect() as conn:
+        if bind.dialect.name == "sqlite":
+            return [row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql))]
+        conn.execute(text("SET enable_seqscan = off")) # <--- Tiny tables: only use a seq scan when nothing else is possible
+        return [row[0] for row in conn.execute(text("EXPLAIN " + sql))]
+
+def _assert_flight_lookup_is_index_probe(bind):
+    from sqlalchemy import func
+    plan = " ".join(_query_plan(bind, select(Flight).filter(Flight.flight_code == "AI101")))
+    assert "ix_flights_flight_code" in plan
+    assert "SCAN flights" not in plan and "Seq Scan" not in plan
+    # What the lookup used to do, for contrast: the wrapped column can't use any index
+    legacy = " ".join(_query_plan(bind, select(Flight).filter(func.trim(Flight.flight).ilike(func.trim("AI101")))))
+    assert "SCAN flights" in legacy or "Seq Scan" in legacy
+
+def test_flight_lookup_is_an_index_probe_on_sqlite():
+    _assert_flight_lookup_is_index_probe(engine)
+
+@pytest.mark.skipif(not os.environ.get("TEST_POSTGRES_URL"), reason="set TEST_POSTGRES_URL to run against Postgres")
+def test_flight_lookup_is_an_index_probe_on_postgres():
+    pg_engine = create_engine(os.environ["TEST_POSTGRES_URL"])
+    Flight.__table__.create(pg_engine, checkfirst=True)
+    try:
+        _assert_flight_lookup_is_index_probe(pg_engine)
+    finally:
+        pg_engine.dispose()
+
+def test_backfill_flight_codes_upgrades_old_databases(tmp_path):
+    from database import backfill_flight_codes
+    old = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with old.begin() as conn:
+        conn.execute(text("CREATE TABLE flights (id INTEGER PRIMARY KEY, flight VARCHAR(10) UNIQUE NOT NULL, route VARCHAR(100), "
+                          "time VARCHAR(50), status VARCHAR(20), seats_available INTEGER NOT NULL DEFAULT 0)"))
+        conn.execute(text("INSERT INTO flights (flight, seats_available) VALUES (' ai101 ', 5), ('UK822', 3)"))
+
+    assert backfill_flight_codes(old) == 2
+    assert backfill_flight_codes(old) == 0 # <--- Safe on every startup
+    with old.connect() as conn:
+        assert sorted(conn.execute(text("SELECT flight_code FROM flights")).scalars()) == ["AI101", "UK822"]
+    _assert_flight_lookup_is_index_probe(old)
+    old.dispose()
+
+def test_bulk_loader_streams_files_and_rebuilds_indexes(tmp_path):
+    import bulk_load
+    target = create_engine(f"sqlite:///{tmp_path / 'bulk.db'}")
+    for table_name, rows in bulk_load.synthetic_sources(bookings=300, frequent_flyers=40, seed=7).items():
+        bulk_load.write_rows(str(tmp_path / f"{table_name}.{'csv' if table_name == 'bookings' else 'jsonl'}"), rows)
+
+    sources = {name: bulk_load.read_rows(str(path), name) for name, path in (
+        ("flights", tmp_path / "flights.jsonl"), ("bookings", tmp_path / "bookings.csv"),
+        ("frequent_flyers", tmp_path / "frequent_flyers.jsonl"))}
+    loaded = bulk_load.load_tables(target, sources, chunk_size=64, rebuild_indexes=True)
+    assert loaded == {"flights": 20, "bookings": 300, "frequent_flyers": 40}
+
+    with target.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(DISTINCT pnr_key) FROM bookings")).scalar() == 300
+        assert conn.execute(text("SELECT COUNT(*) FROM bookings WHERE flight NOT IN (SELECT flight FROM flights)")).scalar() == 0
+        assert conn.execute(text("SELECT COUNT(*) FROM flights WHERE flight_code IS NULL")).scalar() == 0
+        assert conn.execute(text("SELECT value FROM stat_counters WHERE name = 'bookings'")).scalar() == 300
+        assert conn.execute(text("SELECT typeof(passenger_age) FROM bookings LIMIT 1")).scalar() == "integer" # <--- CSV typed
+    _assert_flight_lookup_is_index_probe(target) # <--- Dropped index is back
+
+    again = bulk_load.synthetic_sources(bookings=300, frequent_flyers=40, seed=7)
+    assert bulk_load.load_tables(target, again, skip_existing=True)["bookings"] == 300
+    with target.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM bookings")).scalar() == 300
+    target.dispose()
+
+def test_sqlite_engine_profile_pragmas(client):
+    from database import AsyncSessionLocal
+
+    async def read_pragmas():
+        async with AsyncSessionLocal() as db:
+            return [(await db.execute(text(f"PRAGMA {name}"))).scalar() for name in ("journal_mode", "synchronous", "busy_timeout")]
+
+    assert client.portal.call(read_pragmas) == ["wal", 1, 5000] # <--- 1 = NORMAL
+
+def test_postgres_pool_options_from_env(monkeypatch):
+    import database
+    monkeypatch.setenv("DB_POOL_SIZE", "25")
+    monkeypatch.setenv("DB_POOL_PRE_PING", "false")
+    options = database.postgres_pool_options()
+    assert options["pool_size"] == 25 and options["pool_pre_ping"] is False
+    assert options["max_overflow"] == 20 and options["pool_recycle"] == 1800
+    monkeypatch.setattr(database, "ENGINE_PROFILE", "stock")
+    assert database.postgres_pool_options() == {} and database.sqlite_pragmas() == {}
+
+### 🧠 CALL STATE STORE TESTS ###
+
+def _history(client, call_id):
+    """(menu_path, inputs) of a call, rebuilt from call_events"""
+    from call_events import load_history
+
+    async def read():
+        async with TestingAsyncSessionLocal() as db:
+            row = await db.scalar(select(CallHistory).filter(CallHistory.call_id == call_id))
+            return await load_history(db, row)
+
+    return client.portal.call(read)
+
+def test_keypresses_are_written_behind(client):
+    """Digits only touch the call-state store until the background flush"""
+    call_id = client.post("/ivr/start", json={"caller_number": "+1WriteBehind"}).json()["call_id"]
+    client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "1", "current_menu": "main"})
+    client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "2", "current_menu": "flight_status_pnr"})
+
+    db = TestingSessionLocal()
+    row = db.query(CallHistory).filter(CallHistory.call_id == call_id).first()
+    assert row.current_menu == "main" # <--- Not flushed yet
+    db.close()
+
+    assert client.portal.call(call_state_flusher.flush) == 1
+
+    db = TestingSessionLocal()
+    row = db.query(CallHistory).filter(CallHistory.call_id == call_id).first()
+    assert row.current_menu == "flight_status_pnr"
+    assert row.input_buffer == "2"
+    db.close()
+    assert _history(client, call_id)[0] == ["main", "flight_status_pnr"]
+
+def test_flush_drops_a_bad_call_and_writes_the_rest(client):
+    """One call whose rows can't be written must not keep every other call from being flushed"""
+    from datetime import datetime
+    from ivr_simulator_backend import event_buffer
+    good, bad = (client.post("/ivr/start", json={"caller_number": "+1Flush"}).json()["call_id"] for _ in range(2))
+    client.portal.call(call_state_flusher.flush)
+    client.post("/ivr/dtmf", json={"call_id": good, "digit": "3", "current_menu": "main"})
+    bad_pk = client.portal.call(call_state_flusher.store.get, bad).id
+    event_buffer.requeue([{"call_pk": bad_pk, "seq": 99, "kind": None, "menu_id": None, "value": None, "at": datetime.now()}])
+
+    assert client.portal.call(call_state_flusher.flush) == 1
+    assert len(event_buffer) == 0 # <--- Dropped, not retried forever
+    assert client.portal.call(call_state_flusher.flush) == 0
+
+    db = TestingSessionLocal()
+    assert db.query(CallHistory).filter(CallHistory.call_id == good).first().current_menu == "baggage"
+    db.close()
+
+def test_flush_loop_survives_store_errors(client):
+    """A locked sqlite store must not end the background flush for good"""
+    import asyncio
+    import sqlite3
+    from call_state import CallState, CallStateFlusher, InMemoryCallStateStore
+
+    db = TestingSessionLocal()
+    row = CallHistory(call_id="CALL_LOCKED", caller_number="+1Locked")
+    db.add(row)
+    db.commit()
+    state = CallState.from_row(row)
+    db.close()
+
+    class LockedOnceStore(InMemoryCallStateStore):
+        failures = 2
+        async def take_dirty(self):
+            if self.failures:
+                self.failures -= 1
+                raise sqlite3.OperationalError("database is locked")
+            return await super().take_dirty()
+
+    async def scenario():
+        store = LockedOnceStore()
+        state.current_menu = "baggage"
+        await store.put(state)
+        flusher = CallStateFlusher(store, TestingAsyncSessionLocal, interval=0.01)
+        flusher.start()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not store.failures and not store._dirty:
+                break
+        task = flusher._task
+        await flusher.stop()
+        return store.failures, task.done() and not task.cancelled()
+
+    assert client.portal.call(scenario) == (0, False) # <--- Loop kept running past both errors
+    db = TestingSessionLocal()
+    assert db.query(CallHistory).filter(CallHistory.call_id == "CALL_LOCKED").first().current_menu == "baggage"
+    db.close()
+
+def test_call_end_flushes_final_state(client):
+    """Ending a call writes the full live state in the history writer's next batch"""
+    call_id = client.post("/ivr/start", json={"caller_number": "+1EndFlush"}).json()["call_id"]
+    client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "3", "current_menu": "main"})
+    client.post("/ivr/end", json={"call_id": call_id})
+    client.portal.call(history_writer.drain)
+
+    db = TestingSessionLocal()
+    row = db.query(CallHistory).filter(CallHistory.call_id == call_id).first()
+    assert row.end_time is not None
+    db.close()
+    assert _history(client, call_id) == (["main", "baggage"], ["3", "Call ended by user."])
+
+def test_history_of_legacy_calls_comes_from_json_columns(client):
+    """Calls recorded before call_events still read back their JSON history"""
+    db = TestingSessionLocal()
+    db.add(CallHistory(call_id="CALL_LEGACY", caller_number="+1Old", menu_path=["main", "baggage"], inputs=["3"]))
+    db.commit()
+    db.close()
+    assert _history(client, "CALL_LEGACY") == (["main", "baggage"], ["3"])
+
+def test_menu_ids_are_stable_when_menus_are_added(client):
+    from call_events import MenuIds
+    from ivr_simulator_backend import MENU_STRUCTURE
+    before, after = MenuIds(), MenuIds()
+    client.portal.call(before.load, TestingAsyncSessionLocal, MENU_STRUCTURE)
+    client.portal.call(after.load, TestingAsyncSessionLocal, list(MENU_STRUCTURE) + ["new_menu"])
+    assert all(after.by_name[name] == menu_id for name, menu_id in before.by_name.items())
+    assert after.by_name["new_menu"] == max(before.by_id) + 1
+
+def test_history_writer_batches_applies_backpressure_and_drains(client):
+    """Queued call ends are committed in batches; a full queue makes submit() wait; stop() drains"""
+    import asyncio
+    from call_state import CallState
+    from history_writer import CallEndRecord, HistoryWriter
+    from datetime import datetime
+
+    db = TestingSessionLocal()
+    rows = [CallHistory(call_id=f"CALL_GC{i}", caller_number="+1Batch") for i in range(7)]
+    db.add_all(rows)
+    db.commit()
+    states = [CallState.from_row(row) for row in rows]
+    db.close()
+
+    class GatedWriter(HistoryWriter):
+        async def _write(self, batch):
+            await self.gate.wait()
+            self.batches.append(len(batch))
+            await super()._write(batch)
+
+    async def scenario():
+        writer = GatedWriter(TestingAsyncSessionLocal, batch_size=3, flush_interval=0.05, max_queue=2)
+        writer.gate, writer.batches = asyncio.Event(), []
+        writer.start()
+        records = [CallEndRecord(state, datetime.now(), []) for state in states]
+
+        for record in records[:3]: # <--- One full batch, taken by the (blocked) writer
+            await writer.submit(record)
+        await asyncio.sleep(0.01)
+        for record in records[3:5]: # <--- Fills the queue
+            await writer.submit(record)
+        blocked = asyncio.ensure_future(writer.submit(records[5]))
+        await asyncio.sleep(0.1)
+        assert not blocked.done() # <--- Backpressure: queue full
+
+        writer.gate.set()
+        await blocked
+        await writer.submit(records[6])
+        await writer.stop()
+        return writer.batches
+
+    batches = client.portal.call(scenario)
+    assert sum(batches) == 7 and max(batches) <= 3 and len(batches) < 7
+
+    db = TestingSessionLocal()
+    assert db.query(CallHistory).filter(CallHistory.call_id.like("CALL_GC%"), CallHistory.end_time.isnot(None)).count() == 7
+    db.close()
+
+def test_history_writer_drops_a_bad_record_and_counts_only_real_ends(client):
+    """A record that can't be written is dropped without holding up its batch; duplicate ends aren't counted"""
+    import asyncio
+    from call_state import CallState
+    from history_writer import CallEndRecord, HistoryWriter
+    from datetime import datetime
+
+    db = TestingSessionLocal()
+    rows = [CallHistory(call_id=f"CALL_BAD{i}", caller_number="+1Poison") for i in range(3)]
+    db.add_all(rows)
+    db.commit()
+    states = [CallState.from_row(row) for row in rows]
+    ended_before = db.get(StatCounter, "calls_ended").value
+    db.close()
+
+    async def scenario():
+        writer = HistoryWriter(TestingAsyncSessionLocal, batch_size=10, flush_interval=0.05)
+        writer.start()
+        poison = [{"call_pk": states[1].id, "seq": 0, "kind": None, "menu_id": None, "value": None, "at": datetime.now()}]
+        for state in states:
+            await writer.submit(CallEndRecord(state, datetime.now(), poison if state is states[1] else []))
+        await writer.submit(CallEndRecord(states[0], datetime.now(), [])) # <--- Ended twice
+        await writer.stop()
+        return writer.pending_call_pks()
+
+    assert client.portal.call(scenario) == []
+    db = TestingSessionLocal()
+    ended = {row.call_id for row in db.query(CallHistory).filter(CallHistory.call_id.like("CALL_BAD%"), CallHistory.end_time.isnot(None))}
+    assert ended == {"CALL_BAD0", "CALL_BAD2"}
+    assert db.get(StatCounter, "calls_ended").value == ended_before + 2
+    db.close()
+
+def test_call_with_a_queued_end_is_not_revived(client):
+    """A call whose end is still queued must not be reloaded from its (still open) row"""
+    from ivr_simulator_backend import call_store
+    call_id = client.post("/ivr/start", json={"caller_number": "+1Ending"}).json()["call_id"]
+    call_pk = client.portal.call(call_store.get, call_id).id
+    client.portal.call(call_store.delete, call_id) # <--- As end_call_logic does before the write lands
+    history_writer._pending_ends.add(call_pk)
+    try:
+        resp = client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "1", "current_menu": "main"})
+    finally:
+        history_writer._pending_ends.discard(call_pk)
+    assert resp.status_code == 400 and resp.json()["detail"] == "Call has already ended"
+    assert client.portal.call(call_store.get, call_id) is None
+
+def test_sqlite_call_state_store_is_shared(tmp_path):
+    """Two store instances on the same file (i.e. two workers) see the same state"""
+    import asyncio
+    from call_state import CallState, SQLiteCallStateStore
+
+    async def scenario():
+        path = str(tmp_path / "state.db")
+        worker_a, worker_b = SQLiteCallStateStore(path), SQLiteCallStateStore(path)
+        state = CallState(id=1, call_id="CALL_X", caller_number="+1")
+        state.input_buffer = "24"
+        await worker_a.put(state)
+
+        seen = await worker_b.get("CALL_X")
+        assert seen.input_buffer == "24" and seen.current_menu == "main"
+
+        assert [s.call_id for s in await worker_b.take_dirty()] == ["CALL_X"]
+        assert await worker_a.take_dirty() == [] # <--- Claimed exactly once
+
+        await worker_a.delete("CALL_X")
+        assert await worker_b.get("CALL_X") is None
+
+    asyncio.run(scenario())
+
+
+def test_idle_calls_are_reaped_in_one_sweep(client):
+    from datetime import datetime, timedelta
+    from ivr_simulator_backend import call_reaper
+    idle = [client.post("/ivr/start", json={"caller_number": "+1Idle"}).json()["call_id"] for _ in range(3)]
+    busy = client.post("/ivr/start", json={"caller_number": "+1Busy"}).json()["call_id"]
+    client.post("/ivr/dtmf", json={"call_id": idle[0], "digit": "1", "current_menu": "main"})
+    client.portal.call(call_state_flusher.flush)
+
+    db = TestingSessionLocal()
+    db.query(CallHistory).filter(CallHistory.call_id.in_(idle)).update(
+        {"last_activity": datetime.now() - timedelta(seconds=call_reaper.timeout + 60)}, synchronize_session=False)
+    db.commit()
+    db.close()
+
+    assert sorted(client.portal.call(call_reaper.sweep)) == sorted(idle)
+    assert client.portal.call(call_reaper.sweep) == [] # <--- Already ended
+
+    db = TestingSessionLocal()
+    rows = {row.call_id: row for row in db.query(CallHistory).filter(CallHistory.call_id.in_(idle + [busy]))}
+    assert all(rows[call_id].end_time is not None for call_id in idle)
+    assert rows[busy].end_time is None
+    db.close()
+    assert _history(client, idle[0])[1] == ["1", "Idle timeout"] # <--- Note after the call's own events
+    assert client.post("/ivr/dtmf", json={"call_id": idle[1], "digit": "1", "current_menu": "main"}).status_code == 400
+
+    stats_cache.invalidate()
+    counters = client.get("/stats").json()
+    assert counters["active_calls"] == 1
+
+def test_idle_sweep_uses_the_active_call_partial_index():
+    from datetime import datetime
+    plan = " ".join(_query_plan(engine, select(CallHistory.id).where(
+        CallHistory.end_time.is_(None), CallHistory.last_activity < datetime(2024, 1, 1))))
+    assert "ix_call_history_active" in plan and "SCAN call_history" not in plan
+
+### ⌨️ WHOLE-ENTRY DTMF TESTS ###
+
+def _start_in_menu(client, digit):
+    call_id = client.post("/ivr/start", json={"caller_number": "+1Entry"}).json()["call_id"]
+    client.post("/ivr/dtmf", json={"call_id": call_id, "digit": digit, "current_menu": "main"})
+    return call_id
+
+@pytest.mark.parametrize("entry", ["241234#", "24123#", "2412", "2412345#", "#"])
+def test_dtmf_entry_matches_key_by_key(client, entry):
+    """/ivr/dtmf_entry must answer exactly like pressing each key on /ivr/dtmf"""
+    key_call = _start_in_menu(client, "1")
+    for key in entry:
+        key_resp = client.post("/ivr/dtmf", json={"call_id": key_call, "digit": key, "current_menu": "flight_status_pnr"}).json()
+
+    entry_call = _start_in_menu(client, "1")
+    entry_resp = client.post("/ivr/dtmf_entry", json={"call_id": entry_call, "digits": entry, "current_menu": "flight_status_pnr"})
+    assert entry_resp.status_code == 200
+    assert entry_resp.json() == key_resp
+
+def test_dtmf_entry_rejects_bad_input(client):
+    """Only entry menus, and only digits optionally followed by '#'"""
+    call_id = client.post("/ivr/start", json={"caller_number": "+1Entry"}).json()["call_id"]
+    resp = client.post("/ivr/dtmf_entry", json={"call_id": call_id, "digits": "1#", "current_menu": "main"})
+    assert resp.status_code == 400
+
+    client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "6", "current_menu": "main"})
+    for bad in ["", "12*3", "12#3", "abc#"]:
+        resp = client.post("/ivr/dtmf_entry", json={"call_id": call_id, "digits": bad, "current_menu": "frequent_flyer_number"})
+        assert resp.status_code == 422
+
+def test_overlong_entries_start_over(client):
+    """The input buffer never grows past MAX_ENTRY_DIGITS, key by key or as a whole entry"""
+    from ivr_simulator_backend import MAX_ENTRY_DIGITS
+    call_id = _start_in_menu(client, "5")
+    for _ in range(MAX_ENTRY_DIGITS):
+        resp = client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "9", "current_menu": "booking_ask_flight"}).json()
+    assert resp["collected"] == "9" * MAX_ENTRY_DIGITS
+    resp = client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "9", "current_menu": "booking_ask_flight"}).json()
+    assert resp["message"] == "Entry too long. Please try again." and resp["current_menu"] == "booking_ask_flight"
+
+    resp = client.post("/ivr/dtmf_entry", json={"call_id": call_id, "digits": "1" * 200 + "#", "current_menu": "booking_ask_flight"}).json()
+    assert resp["message"] == "Entry too long. Please try again." and resp["current_menu"] == "booking_ask_flight"
+    resp = client.post("/ivr/dtmf_entry", json={"call_id": call_id, "digits": "12", "current_menu": "booking_ask_flight"}).json()
+    assert resp["collected"] == "12" # <--- Buffer was cleared
+
+
+### ✈️ FLIGHT SEAT INVENTORY TESTS ###
+
+def _book_flight_ai900(client, name):
+    """Walks the booking wizard for AI900 up to the confirm step; returns the call_id"""
+    call_id = client.post("/ivr/start", json={"caller_number": "+1Booker"}).json()["call_id"]
+    client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "5", "current_menu": "main"})
+    client.post("/ivr/dtmf_entry", json={"call_id": call_id, "digits": "900#", "current_menu": "booking_ask_flight"})
+    client.post("/ivr/process_voice", json={"call_id": call_id, "text": name, "current_menu": "booking_ask_name"})
+    client.post("/ivr/dtmf_entry", json={"call_id": call_id, "digits": "30#", "current_menu": "booking_ask_age"})
+    resp = client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "1", "current_menu": "booking_ask_gender"})
+    assert resp.json()["current_menu"] == "booking_confirm_details"
+    return call_id
+
+def test_last_seat_can_only_be_booked_once(client):
+    """Two callers at the confirm step for the last seat: one books, one is told it sold out"""
+    db = TestingSessionLocal()
+    db.add(Flight(flight="AI900", route="Pune to Goa", time="Today 9:00 PM", status="On Time", seats_available=1))
+    db.commit()
+    db.close()
+
+    first = _book_flight_ai900(client, "Asha Rao")
+    second = _book_flight_ai900(client, "Vikram Rao")
+
+    resp_1 = client.post("/ivr/dtmf", json={"call_id": first, "digit": "1", "current_menu": "booking_confirm_details"}).json()
+    resp_2 = client.post("/ivr/dtmf", json={"call_id": second, "digit": "1", "current_menu": "booking_confirm_details"}).json()
+    assert resp_1["status"] == "call_ended" and "Booking confirmed" in resp_1["message"]
+    assert "has just sold out" in resp_2["message"]
+
+    db = TestingSessionLocal()
+    assert db.query(Flight).filter(Flight.flight == "AI900").one().seats_available == 0
+    booking = db.query(Booking).filter(Booking.flight == "AI900").one()
+    assert booking.passenger_name == "Asha Rao"
+    assert booking.flight_info.route == "Pune to Goa" # <--- Route comes from the flights table
+    db.close()
+
+def test_migrate_flights_from_legacy_bookings(tmp_path):
+    """Old databases stored route/time/seats on every booking; migration builds one row per flight"""
+    from sqlalchemy import text
+    from database import migrate_flights_from_bookings
+
+    legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with legacy.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE bookings (id INTEGER PRIMARY KEY, pnr_key VARCHAR(6), pnr_display VARCHAR(8), "
+            "flight VARCHAR(10), status VARCHAR(20), route VARCHAR(100), time VARCHAR(50), seats_available INTEGER, "
+            "passenger_name VARCHAR(100), passenger_age INTEGER, passenger_gender VARCHAR(10))"
+        ))
+        conn.execute(text(
+            "INSERT INTO bookings (pnr_key, flight, status, route, time, seats_available) VALUES "
+            "('111111', 'AI101', 'Confirmed', 'Mumbai to Delhi', 'Today', 28), "
+            "('222222', 'AI101', 'Cancelled', 'Mumbai to Delhi', 'Today', 28), "
+            "('333333', 'UK822', 'Delayed', 'Chennai to Bangalore', 'Today', 5)"
+        ))
+    Base.metadata.create_all(bind=legacy)
+
+    assert migrate_flights_from_bookings(legacy) == 2
+    assert migrate_flights_from_bookings(legacy) == 0 # <--- Idempotent
+
+    with sessionmaker(bind=legacy)() as db:
+        flights = {f.flight: f for f in db.query(Flight).all()}
+        assert flights["AI101"].seats_available == 28
+        assert flights["AI101"].status == "Confirmed" # <--- Taken from the first booking
+        assert flights["UK822"].route == "Chennai to Bangalore"
+    legacy.dispose()
+
+
+### 🔤 NLU EXTRACTION TESTS ###
+
+@pytest.mark.parametrize("text, expected", [
+    ("my pnr is 8 5 5 6 7 8", "855678"),
+    ("six three one one one one", "631111"),
+    ("ai one two three four", "241234"), # <--- Letters go through the phone keypad
+    ("my phone is 241234", "241234"),    # <--- "one" inside "phone" is not a number
+    ("12345", None),
+    ("oh my pnr is 241234", "241234"),   # <--- A bare "oh" is not a zero
+])
+def test_nlu_extract_pnr(text, expected):
+    import nlu
+    assert nlu.extract_pnr(text) == expected
+
+@pytest.mark.parametrize("text, expected", [
+    ("book flight one zero one", "AI101"),
+    ("6e204", "6E204"),
+    ("flight number ai one oh one", "AI101"),
+    ("flight oh oh seven", "AI007"),
+])
+def test_nlu_extract_flight_number(text, expected):
+    import nlu
+    assert nlu.extract_flight_number(text) == expected
+
+@pytest.mark.parametrize("text, expected", [
+    ("my age is 30", 30),
+    ("forty five", 45),
+    ("seventy two years old", 72), # <--- "seven" inside "seventy" is not a number
+    ("150", None),
+    ("oh, i am forty", 40),
+    ("i am 150 no sorry 50", 50),   # <--- Out-of-range numbers are skipped
+])
+def test_nlu_extract_age(text, expected):
+    import nlu
+    assert nlu.extract_age(text) == expected
+
+def test_nlu_extract_name_keeps_hyphens_and_short_words():
+    import nlu
+    assert nlu.extract_name("my name is f. al-jaber") == "F. Al-Jaber"
+    assert nlu.extract_name("tom stone") == "Tom Stone" # <--- Filler "to" no longer eats "tom"
+
+@pytest.mark.parametrize("menu, text, expected", [
+    ("main", "check my flight status", "1"),
+    ("main", "I want to manage my booking", "2"),
+    ("main", "go back", None),                           # <--- Nothing to go back to from main
+    ("baggage", "go back to the main menu", "*"),
+    ("manage_booking_options", "cancel, no wait, get me an agent", "0"),  # <--- "agent" beats every menu option
+    ("booking_ask_gender", "female", "2"),               # <--- Not "1" because "male" is inside it
+    ("booking_ask_gender", "male", "1"),
+])
+def test_nlu_resolve_intent(menu, text, expected):
+    import nlu
+    from ivr_simulator_backend import INTENT_INDEX
+    assert nlu.resolve_intent(INTENT_INDEX, text, menu) == expected
+
+
+### 🧭 MENU GRAPH TESTS ###
+
+def _tiny_registry():
+    from menu_graph import ActionRegistry
+    registry = ActionRegistry()
+    registry.register("goto_menu")(lambda *args: None)
+    return registry
+
+def test_menu_graph_compiles_live_menus():
+    from ivr_simulator_backend import MENU_GRAPH, MENU_STRUCTURE
+    assert set(MENU_GRAPH.nodes) == set(MENU_STRUCTURE)
+    assert MENU_GRAPH["flight_status_pnr"].input_length == 6
+    assert MENU_GRAPH["main"].input_length is None
+    assert MENU_GRAPH["booking_ask_gender"].options["2"].params["gender"] == "Female"
+    with pytest.raises(AttributeError):
+        MENU_GRAPH["main"].prompt = "changed" # <--- Compiled graph is read-only
+
+@pytest.mark.parametrize("menus, error", [
+    ({"main": {"prompt": "", "options": {"1": {"action": "goto_menu", "target": "nowhere"}}}}, "unknown menu 'nowhere'"),
+    ({"main": {"prompt": "", "options": {}}, "orphan": {"prompt": "", "options": {}}}, "'orphan' is unreachable"),
+    ({"main": {"prompt": "", "options": {"1": {"action": "fly_away"}}}}, "no handler registered for action 'fly_away'"),
+])
+def test_menu_graph_rejects_broken_menus(menus, error):
+    from menu_graph import MenuGraphError, compile_menu_graph
+    with pytest.raises(MenuGraphError, match=error):
+        compile_menu_graph(menus, _tiny_registry())
+
+
+### 🆔 ID ALLOCATOR TESTS ###
+
+def test_call_ids_are_time_ordered_and_sharded(client):
+    from id_allocator import IdAllocator
+    first, second = IdAllocator(TestingAsyncSessionLocal), IdAllocator(TestingAsyncSessionLocal)
+
+    async def allocate(allocator, n):
+        return [await allocator.next_call_id() for _ in range(n)]
+
+    ids_1 = client.portal.call(allocate, first, 5000)
+    ids_2 = client.portal.call(allocate, second, 5000)
+    assert first.shard != second.shard # <--- Each worker takes its own shard
+    assert ids_1 == sorted(ids_1)      # <--- Time-ordered within a worker
+    assert len(set(ids_1) | set(ids_2)) == 10000
+
+def test_pnr_blocks_are_disjoint_and_skip_existing_keys(client):
+    from id_allocator import IdAllocator, pnr_for_index
+    db = TestingSessionLocal()
+    row = db.query(IdBlock).filter(IdBlock.name == "pnr").first()
+    next_index = row.next_value if row else 0
+    db.add(Booking(pnr_key=pnr_for_index(next_index), pnr_display="XX0000", flight="AI101", status="Confirmed"))
+    db.commit()
+    db.close()
+
+    first, second = IdAllocator(TestingAsyncSessionLocal, 10), IdAllocator(TestingAsyncSessionLocal, 10)
+
+    async def allocate(allocator, n):
+        return [await allocator.next_pnr() for _ in range(n)]
+
+    pnrs_1 = client.portal.call(allocate, first, 15)
+    pnrs_2 = client.portal.call(allocate, second, 15)
+    assert pnrs_1[0] == pnr_for_index(next_index + 1) # <--- Key already booked is skipped
+    assert not set(pnrs_1) & set(pnrs_2)
+    assert all(len(p) == 6 and p.isdigit() for p in pnrs_1 + pnrs_2)
+
+
+### 📝 LOGGING TESTS ###
+
+def test_json_log_lines_are_keyed_by_call_id():
+    import json, logging
+    from ivr_logging import JsonFormatter
+    record = logging.LogRecord("ivr.dtmf", logging.DEBUG, __file__, 1, "dtmf_input", None, None)
+    record.call_id, record.menu, record.digit = "CALL_1", "main", "1"
+    line = json.loads(JsonFormatter().format(record))
+    assert line["subsystem"] == "dtmf" and line["level"] == "DEBUG"
+    assert (line["call_id"], line["event"], line["menu"], line["digit"]) == ("CALL_1", "dtmf_input", "main", "1")
+
+def test_log_levels_are_parsed_per_subsystem():
+    import logging
+    from ivr_logging import parse_levels
+    assert parse_levels("nlu=debug, db=WARNING") == {"nlu": logging.DEBUG, "db": logging.WARNING}
+    assert parse_levels("") == {}
+    for bad in ("voice=DEBUG", "nlu=LOUD"):
+        with pytest.raises(ValueError):
+            parse_levels(bad)
+
+def test_debug_sampling_keeps_whole_calls():
+    import logging
+    from ivr_logging import DebugSampler
+
+    def record(level, call_id):
+        r = logging.LogRecord("ivr.nlu", level, __file__, 1, "event", None, None)
+        r.call_id = call_id
+        return r
+
+    sampler = DebugSampler(0.25)
+    kept = {f"CALL_{i}" for i in range(2000) if sampler.filter(record(logging.DEBUG, f"CALL_{i}"))}
+    assert 300 < len(kept) < 700
+    assert all(sampler.filter(record(logging.DEBUG, call_id)) for call_id in kept) # <--- Same decision every time
+    assert all(sampler.filter(record(logging.INFO, f"CALL_{i}")) for i in range(100)) # <--- INFO is never sampled
+
+
+### ⚡ LOOKUP CACHE TESTS ###
+
+def _pnr_status(client, pnr_key):
+    call_id = _start_in_menu(client, "1")
+    return client.post("/ivr/dtmf_entry", json={"call_id": call_id, "digits": pnr_key + "#", "current_menu": "flight_status_pnr"}).json()
+
+def test_lookup_cache_is_invalidated_by_cancel_and_booking(client):
+    import metrics
+    db = TestingSessionLocal()
+    db.add(Flight(flight="AI901", route="Pune to Delhi", time="Today 10:00 PM", status="On Time", seats_available=7))
+    db.add(Booking(pnr_key="560001", pnr_display="AI0001", flight="AI901", status="Confirmed", passenger_name="Cache Test"))
+    db.commit()
+    db.close()
+
+    hits = metrics.LOOKUP_CACHE.value("bookings", "hit")
+    assert _pnr_status(client, "560001")["pnr_info"]["seats_available"] == 7
+    assert _pnr_status(client, "560001")["pnr_info"]["status"] == "Confirmed"
+    assert metrics.LOOKUP_CACHE.value("bookings", "hit") == hits + 1 # <--- Second lookup never reached the DB
+
+    call_id = _start_in_menu(client, "2")
+    client.post("/ivr/dtmf_entry", json={"call_id": call_id, "digits": "560001#", "current_menu": "manage_booking_pnr"})
+    assert "successfully cancelled" in client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "2", "current_menu": "manage_booking_options"}).json()["message"]
+    after_cancel = _pnr_status(client, "560001")["pnr_info"]
+    assert (after_cancel["status"], after_cancel["seats_available"]) == ("Cancelled", 8)
+
+    call_id = client.post("/ivr/start", json={"caller_number": "+1Booker"}).json()["call_id"]
+    client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "5", "current_menu": "main"})
+    client.post("/ivr/process_voice", json={"call_id": call_id, "text": "flight AI901", "current_menu": "booking_ask_flight"})
+    client.post("/ivr/process_voice", json={"call_id": call_id, "text": "Cache Booker", "current_menu": "booking_ask_name"})
+    client.post("/ivr/dtmf_entry", json={"call_id": call_id, "digits": "30#", "current_menu": "booking_ask_age"})
+    client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "1", "current_menu": "booking_ask_gender"})
+    assert "Booking confirmed" in client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "1", "current_menu": "booking_confirm_details"}).json()["message"]
+    assert _pnr_status(client, "560001")["pnr_info"]["seats_available"] == 7 # <--- Flight entry dropped by the booking
+
+def test_pnr_status_without_a_flight_row_reports_status_only(client):
+    """Bookings whose flight is NULL or unknown (no FK check on SQLite) must not crash the lookup"""
+    db = TestingSessionLocal()
+    db.add(Booking(pnr_key="570001", pnr_display="NF0001", flight=None, status="Confirmed", passenger_name="No Flight"))
+    db.add(Booking(pnr_key="570002", pnr_display="NF0002", flight="XX999", status="Confirmed", passenger_name="Ghost Flight"))
+    db.commit()
+    db.close()
+
+    for pnr_key, flight in (("570001", None), ("570002", "XX999")):
+        resp = _pnr_status(client, pnr_key)
+        assert resp["status"] == "pnr_found"
+        assert resp["pnr_info"]["flight"] == flight and resp["pnr_info"]["status"] == "Confirmed"
+        assert resp["pnr_info"]["route"] is None and resp["pnr_info"]["seats_available"] is None
+        assert " from " not in resp["message"]
+
+def test_lru_ttl_cache_evicts_expires_and_drops_stale_fills():
+    from lookup_cache import LRUTTLCache
+    cache = LRUTTLCache("test", maxsize=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1 # <--- "a" is now the most recently used
+    cache.put("c", 3)
+    assert cache.get("b") is None and cache.get("a") == 1 and cache.get("c") == 3
+
+    epoch = cache.epoch
+    cache.invalidate("a")
+    cache.put("a", "read before the write", epoch)
+    assert cache.get("a") is None
+
+    expired = LRUTTLCache("test", maxsize=2, ttl=0)
+    expired.put("a", 1)
+    assert expired.get("a") is None
+
+
+### 🗃️ CALL ARCHIVE TESTS ###
+
+def _ended_calls(client, count, caller):
+    call_ids = []
+    for _ in range(count):
+        call_id = client.post("/ivr/start", json={"caller_number": caller}).json()["call_id"]
+        client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "3", "current_menu": "main"})
+        client.post("/ivr/end", json={"call_id": call_id})
+        call_ids.append(call_id)
+    client.portal.call(history_writer.drain)
+    return call_ids
+
+def test_old_calls_move_to_the_archive_in_batches(client):
+    from datetime import datetime, timedelta
+    from call_archive import CallArchiver
+    old = _ended_calls(client, 5, "+1Old")
+    recent = _ended_calls(client, 1, "+1Recent")
+    live = client.post("/ivr/start", json={"caller_number": "+1Live"}).json()["call_id"]
+    before = client.get(f"/ivr/history/{old[0]}").json()
+
+    db = TestingSessionLocal()
+    db.query(CallHistory).filter(CallHistory.call_id.in_(old)).update(
+        {"end_time": datetime.now() - timedelta(days=40)}, synchronize_session=False)
+    db.commit()
+    db.close()
+
+    archiver = CallArchiver(TestingAsyncSessionLocal, archive_after_days=30, batch_size=2)
+    assert client.portal.call(archiver.archive_batch) == 2 # <--- Bounded
+    assert client.portal.call(archiver.run_once) == {"archived": 3, "purged": 0}
+
+    db = TestingSessionLocal()
+    assert {row.call_id for row in db.query(CallHistory)} == {recent[0], live}
+    assert db.query(CallArchive).count() == 5
+    assert db.query(CallEvent).join(CallHistory, CallHistory.id == CallEvent.call_pk).count() == db.query(CallEvent).count()
+    db.close()
+
+    after = client.get(f"/ivr/history/{old[0]}").json()
+    assert after["archived"] is True and before["archived"] is False
+    assert (after["menu_path"], after["inputs"]) == (before["menu_path"], before["inputs"]) == (
+        ["main", "baggage"], ["3", "Call ended by user."])
+    assert after["state"]["current_menu"] == before["state"]["current_menu"]
+    assert client.get(f"/ivr/history/{recent[0]}").json()["archived"] is False
+    assert client.get("/ivr/history/CALL_NOPE").status_code == 404
+    plan = " ".join(_query_plan(engine, select(CallHistory.id).where(
+        CallHistory.end_time.is_not(None), CallHistory.end_time < datetime.now())))
+    assert "ix_call_history_ended" in plan
+
+    init_stat_counters(engine) # <--- Baselines still count archived calls
+    stats_cache.invalidate()
+    assert client.get("/stats").json()["calls_started"] == 7
+
+def test_archive_retention_purges_in_batches(client):
+    from datetime import datetime, timedelta
+    from call_archive import CallArchiver
+    db = TestingSessionLocal()
+    now = datetime.now()
+    for i, age in enumerate([400, 400, 400, 100]):
+        db.add(CallArchive(call_id=f"CALL_ARCHIVED_{i}", end_time=now - timedelta(days=age), payload=b"x"))
+    db.commit()
+    db.close()
+
+    keep_forever = CallArchiver(TestingAsyncSessionLocal, retention_days=0, batch_size=2)
+    assert client.portal.call(keep_forever.run_once) == {"archived": 0, "purged": 0}
+    archiver = CallArchiver(TestingAsyncSessionLocal, retention_days=365, batch_size=2)
+    assert client.portal.call(archiver.run_once) == {"archived": 0, "purged": 3}
+
+    db = TestingSessionLocal()
+    assert [row.call_id for row in db.query(CallArchive)] == ["CALL_ARCHIVED_3"]
+    db.close()
+
+
+### 📦 RESPONSE ENCODING TESTS ###
+
+def test_static_transitions_are_served_pre_encoded(client):
+    import fast_json
+    from ivr_simulator_backend import MENU_GRAPH, transition_bodies
+    start = client.post("/ivr/start", json={"caller_number": "+1Encode"})
+    assert start.json()["prompt"] == MENU_GRAPH["main"].prompt and start.headers["content-type"] == "application/json"
+
+    option = MENU_GRAPH["main"].options["1"]
+    prepared = transition_bodies.response(option.target, option.message)
+    assert fast_json.prepared_body(prepared) is not None
+    response = client.post("/ivr/dtmf", json={"call_id": start.json()["call_id"], "digit": "1", "current_menu": "main"})
+    assert response.content == fast_json.prepared_body(prepared) # <--- The startup bytes, as they are
+    assert response.json() == dict(prepared)
+
+    prepared["prompt"] = "Changed by a handler"
+    assert fast_json.prepared_body(prepared) is None # <--- Falls back to the response model
+    assert fast_json.prepared_body(transition_bodies.response("main", "A dynamic message")) is None
+
+    for mutate in (lambda r: r.clear(), lambda r: r.popitem(), lambda r: r.__ior__({"status": "x"})):
+        changed = transition_bodies.response(option.target, option.message)
+        mutate(changed)
+        assert fast_json.prepared_body(changed) is None
+
+def test_response_models_keep_only_the_keys_handlers_set(client):
+    call_id = client.post("/ivr/start", json={"caller_number": "+1Model"}).json()["call_id"]
+    invalid = client.post("/ivr/process_voice", json={"call_id": call_id, "text": "mumble", "current_menu": "main"}).json()
+    assert set(invalid) == {"status", "prompt", "current_menu", "prompt_original"}
+
+    client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "1", "current_menu": "main"})
+    collecting = client.post("/ivr/dtmf", json={"call_id": call_id, "digit": "2", "current_menu": "flight_status_pnr"}).json()
+    assert collecting == {"status": "collecting", "prompt": "You entered 2. Continue entering.", "collected": "2",
+                          "current_menu": "flight_status_pnr"}
+
+
+### 🔌 WEBSOCKET CHANNEL TESTS ###
+
+def test_websocket_call_matches_http_and_skips_store_writes(client):
+    http_id = client.post("/ivr/start", json={"caller_number": "+1Http"}).json()["call_id"]
+    client.post("/ivr/dtmf", json={"call_id": http_id, "digit": "1", "current_menu": "main"})
+    http_answer = client.post("/ivr/dtmf_entry", json={"call_id": http_id, "digits": "241234#", "current_menu": "x"}).json()
+
+    with client.websocket_connect("/ivr/ws") as ws:
+        ws.send_json({"type": "dtmf", "digit": "1"})
+        assert ws.receive_json()["status_code"] == 400 # <--- No call yet
+        ws.send_json({"type": "start", "caller_number": "+1Socket"})
+        started = ws.receive_json()
+        assert started["status"] == "connected" and started["prompt"] == client.post(
+            "/ivr/start", json={"caller_number": "+1Other"}).json()["prompt"]
+
+        ws.send_json({"type": "dtmf", "digit": "1"})
+        assert ws.receive_json()["current_menu"] == "flight_status_pnr"
+        client.portal.call(call_state_flusher.flush)
+        for digit in "2412":
+            ws.send_json({"type": "dtmf", "digit": digit})
+            assert ws.receive_json()["status"] == "collecting"
+        assert client.portal.call(call_state_flusher.flush) == 0 # <--- Digits stayed on the connection
+
+        ws.send_json({"type": "dtmf_entry", "digits": "34#"})
+        assert ws.receive_json() == http_answer # <--- Same body as over HTTP
+        ws.send_json({"type": "voice", "text": "hello"})
+        assert ws.receive_json()["status_code"] == 400 # <--- That call has ended
+
+    client.portal.call(history_writer.drain)
+    db = TestingSessionLocal()
+    row = db.query(CallHistory).filter(CallHistory.call_id == started["call_id"]).first()
+    assert row.end_time is not None
+    db.close()
+
+def test_closing_the_websocket_hangs_up_the_call(client):
+    with client.websocket_connect("/ivr/ws") as ws:
+        ws.send_json({"type": "start", "caller_number": "+1Drop"})
+        call_id = ws.receive_json()["call_id"]
+        ws.send_json({"type": "dtmf", "digit": "3"})
+        assert ws.receive_json()["current_menu"] == "baggage"
+    client.portal.call(history_writer.drain)
+    assert _history(client, call_id) == (["main", "baggage"], ["3", "Caller disconnected."])
+
+
+### 🔁 CALL REPLAY TESTS ###
+
+def test_recorded_calls_replay_without_divergence(client):
+    import sys
+    import httpx
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+    import replay_calls
+    from replay_calls import read_sessions, run_replay
+    from ivr_simulator_backend import INPUT_REQUIRED_MENUS, PNR_INPUT_MENUS, SECRET_ENTRY_MENUS, VOICE_TRANSITIONS
+    assert replay_calls.ENTRY_MENUS == set(INPUT_REQUIRED_MENUS) and replay_calls.PNR_INPUT_MENUS == PNR_INPUT_MENUS
+    assert replay_calls.SECRET_ENTRY_MENUS == SECRET_ENTRY_MENUS
+    assert {replay_calls.NAME_MENU: replay_calls.AFTER_NAME_MENU} == VOICE_TRANSITIONS # <--- The tool's copies are current
+
+    def post(path, call_id=None, **body):
+        return client.post(path, json={"call_id": call_id, "current_menu": "x", **body}).json()
+
+    pnr = post("/ivr/start", caller_number="+1Replay")["call_id"]
+    post("/ivr/dtmf", pnr, digit="1")
+    post("/ivr/dtmf_entry", pnr, digits="241234#") # <--- Hangs itself up
+    booking = post("/ivr/start", caller_number="+1Replay")["call_id"]
+    post("/ivr/dtmf", booking, digit="5")
+    post("/ivr/dtmf_entry", booking, digits="101#")
+    post("/ivr/process_voice", booking, text="my name is Replay Tester")
+    post("/ivr/dtmf_entry", booking, digits="41#")
+    post("/ivr/end", booking)
+    ff = post("/ivr/start", caller_number="+1Replay")["call_id"]
+    post("/ivr/dtmf", ff, digit="6")
+    post("/ivr/dtmf_entry", ff, digits="111222333#")
+    post("/ivr/dtmf_entry", ff, digits="1234#")
+    post("/ivr/dtmf", ff, digit="1")
+    client.portal.call(history_writer.drain)
+
+    sessions = {s["call_id"]: s for s in read_sessions(DATABASE_URL)}
+    assert [step[1:3] for step in sessions[booking]["steps"]] == [
+        ["dtmf", "5"], ["entry", "101"], ["voice", "my name is Replay Tester"], ["entry", "41"]]
+    assert [step[1:3] for step in sessions[ff]["steps"]][1:3] == [["entry", "111222333"], ["pin", None]] # <--- No PIN on record
+    assert not sessions[pnr]["caller_hung_up"] and sessions[booking]["caller_hung_up"]
+    assert _history(client, booking)[1] == ["5", "#", "#", "Call ended by user."] # <--- Entries stay out of `inputs`
+
+    broken = dict(sessions[pnr], call_id="BROKEN", path=["main", "baggage"])
+    admission_controller.rate_limiter.reset() # <--- The tool turns caller limits off on its own server
+    ctx, _ = client.portal.call(run_replay, "http://replay", [*sessions.values(), broken], 0, {"111222333": "1234"}, 10,
+                                httpx.ASGITransport(app=app))
+    diverged = {r["call_id"]: r["diverged_at"] for r in ctx.results}
+    assert diverged == {pnr: None, booking: None, ff: None, "BROKEN": "menu path"}
+    assert not ctx.errors and {sample[0] for sample in ctx.samples} >= {"/ivr/start", "/ivr/dtmf_entry", "/ivr/process_voice"}
+
+
+### 🚦 ADMISSION CONTROL TESTS ###
+
+def test_new_calls_get_503_when_the_worker_is_full(client, monkeypatch):
+    from ivr_simulator_backend import call_store
+    monkeypatch.setattr(admission_controller, "max_live_calls", client.portal.call(call_store.count) + 1) # <--- Room for one more
+    first = client.post("/ivr/start", json={"caller_number": "+1Full"}).json()["call_id"]
+
+    rejected = client.post("/ivr/start", json={"caller_number": "+1Late"})
+    assert rejected.status_code == 503 and rejected.headers["retry-after"] == str(admission_controller.retry_after)
+    with client.websocket_connect("/ivr/ws") as ws:
+        ws.send_json({"type": "start", "caller_number": "+1Late"})
+        assert ws.receive_json()["status_code"] == 503
+    # The call already in progress is unaffected, and a call that hangs itself up frees its place
+    assert client.post("/ivr/dtmf", json={"call_id": first, "digit": "1", "current_menu": "main"}).status_code == 200
+    ended = client.post("/ivr/dtmf_entry", json={"call_id": first, "digits": "241234#", "current_menu": "x"}).json()
+    assert ended["call_action"] == "hangup"
+    assert client.post("/ivr/start", json={"caller_number": "+1Late"}).status_code == 200
+
+def test_in_progress_requests_queue_while_new_calls_are_shed():
+    import asyncio
+    import admission
+
+    async def scenario():
+        async def no_calls():
+            return 0
+        controller = admission.AdmissionController(no_calls, max_in_flight=2, start_max_in_flight=1)
+        release = asyncio.Event()
+
+        async def in_call():
+            await release.wait()
+            return "ok"
+
+        held = [asyncio.create_task(controller.run(False, in_call)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert (controller.in_flight, controller.waiting) == (2, 1) # <--- The third keypress queues
+        with pytest.raises(admission.Rejected) as rejected:
+            await controller.run(True, in_call)
+        assert rejected.value.status_code == 503 and rejected.value.reason == "in_flight"
+
+        release.set()
+        assert await asyncio.gather(*held) == ["ok"] * 3
+        assert await controller.run(True, in_call) == "ok" # <--- Idle again: new calls are welcome
+
+    asyncio.run(scenario())
+
+def test_caller_numbers_are_rate_limited(client):
+    burst = int(admission_controller.rate_limiter.burst)
+    for _ in range(burst):
+        assert client.post("/ivr/start", json={"caller_number": "+1Dialer"}).status_code == 200
+    limited = client.post("/ivr/start", json={"caller_number": "+1Dialer"})
+    assert limited.status_code == 429 and int(limited.headers["retry-after"]) >= 1
+    assert client.post("/ivr/start", json={"caller_number": "+1Someone"}).status_code == 200
+
+def test_sqlite_rate_limiter_is_shared(tmp_path):
+    """Two limiters on the same file (i.e. two workers) draw from the same buckets"""
+    import asyncio
+    from admission import SQLiteRateLimiter
+
+    async def scenario():
+        path = str(tmp_path / "buckets.db")
+        worker_a, worker_b = SQLiteRateLimiter(path, rate=1 / 60, burst=2), SQLiteRateLimiter(path, rate=1 / 60, burst=2)
+        assert await worker_a.acquire("+1") == 0
+        assert await worker_b.acquire("+1") == 0
+        assert 0 < await worker_a.acquire("+1") <= 60 # <--- Empty for both
+        assert await worker_b.acquire("+2") == 0
+        worker_a.close()
+        worker_b.close()
+
+    asyncio.run(scenario())
+
+
+### 🔬 PROFILING TESTS ###
+
+def test_requests_are_profiled_on_demand_into_a_ring_buffer(client, monkeypatch, tmp_path):
+    import pstats
+    import ivr_simulator_backend as backend
+    from profiling import RequestProfiler
+    monkeypatch.setattr(backend, "profiler", RequestProfiler(str(tmp_path), enabled=True, max_files=2, token="s3cret"))
+    trigger, admin = {"X-IVR-Profile": "s3cret"}, {"X-Admin-Token": "s3cret"}
+
+    start = client.post("/ivr/start", json={"caller_number": "+1Profile"})
+    assert "x-ivr-profile-id" not in start.headers # <--- Only when asked
+    call_id = start.json()["call_id"]
+    assert "x-ivr-profile-id" not in client.post("/ivr/dtmf", headers={"X-IVR-Profile": "guess"},
+                                                 json={"call_id": call_id, "digit": "1", "current_menu": "main"}).headers
+    client.post("/ivr/dtmf", headers=trigger, json={"call_id": call_id, "digit": "*", "current_menu": "x"})
+    client.post("/ivr/dtmf", headers=trigger, json={"call_id": call_id, "digit": "1", "current_menu": "x"})
+    lookup = client.post("/ivr/dtmf_entry", headers=trigger, json={"call_id": call_id, "digits": "241234#", "current_menu": "x"})
+    profile_id = lookup.headers["x-ivr-profile-id"]
+
+    assert client.get("/admin/profiles").status_code == 403
+    assert client.get("/admin/profiles", headers={"X-Admin-Token": "s3cre"}).status_code == 403
+    listed = client.get("/admin/profiles", headers=admin).json()["profiles"]
+    assert [(p["menu"], p["action"]) for p in listed] == [("flight_status_pnr", "lookup_pnr_status"), ("main", "goto_menu")] # <--- Oldest dropped
+    assert listed[0]["id"] == profile_id and listed[0]["call_id"] == call_id and listed[0]["trigger"] == "header"
+    assert client.get("/admin/profiles", headers=admin, params={"action": "goto_menu"}).json()["profiles"] == listed[1:]
+
+    download = client.get(f"/admin/profiles/{profile_id}", headers=admin)
+    (tmp_path / "download.prof").write_bytes(download.content)
+    assert pstats.Stats(str(tmp_path / "download.prof")).total_calls > 0
+    report = client.get(f"/admin/profiles/{profile_id}", headers=admin, params={"format": "text", "limit": 1000}).text
+    assert "lookup_pnr_status" in report
+    assert client.get("/admin/profiles/..%2Fsecrets", headers=admin).status_code == 404
+
+    monkeypatch.setattr(backend, "profiler", RequestProfiler(str(tmp_path / "sampled"), enabled=True, sample_rate=1.0))
+    assert "x-ivr-profile-id" in client.post("/ivr/start", json={"caller_number": "+1Sampled"}).headers
+    assert "x-ivr-profile-id" not in client.get("/healthz").headers
+    assert client.get("/admin/profiles", headers=admin).status_code == 404 # <--- No token configured: no admin
\ No newline at end of file